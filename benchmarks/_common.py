@@ -0,0 +1,176 @@
+"""Shared helpers for the server benchmarks.
+
+Each benchmark loads a fresh copy of server/app.py against a throwaway
+database (the same trick tests/test_api.py uses), so configuration read at
+import time can be varied between runs.
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+USERNAME = 'bench'
+PASSWORD = 'benchpass'
+
+
+def load_app(db_path=None, **env):
+    """Import a fresh server/app.py with the given environment. Returns the module.
+
+    db_path defaults to a new throwaway database; pass one to share it
+    between processes.
+    """
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='mindmap-bench-'), 'bench.db')
+    os.environ['DB_PATH'] = db_path
+    os.environ['BASIC_AUTH_USERNAME'] = USERNAME
+    os.environ['BASIC_AUTH_PASSWORD'] = PASSWORD
+    # Its background thread would print outside quiet(); pass ACCESS_LOG='json' to time it
+    env.setdefault('ACCESS_LOG', 'off')
+    for key, value in env.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = str(value)
+    for key in list(sys.modules.keys()):
+        if key == 'app':
+            del sys.modules[key]
+    with quiet():
+        import app as app_module
+    app_module.app.config['TESTING'] = True
+    return app_module
+
+
+def login(app_module):
+    """Return a test client with an authenticated session."""
+    client = app_module.app.test_client()
+    with quiet():
+        client.post('/api/auth/login', json={'username': USERNAME, 'password': PASSWORD})
+    return client
+
+
+@contextlib.contextmanager
+def quiet():
+    """Swallow the server's per-request log lines while timing."""
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = saved
+
+
+def measure(fn, n):
+    """Run fn n times; return (requests/sec, list of per-call seconds)."""
+    timings = []
+    with quiet():
+        start = time.perf_counter()
+        for _ in range(n):
+            t0 = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - start
+    return n / elapsed, timings
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def report(title, rows, columns):
+    """Print a small aligned table. rows is a list of dicts keyed by column."""
+    print(f'\n{title}')
+    widths = [max(len(c), *(len(str(r[c])) for r in rows)) for c in columns]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        print('  '.join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def dump(path, payload):
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent=2)
+
+
+def synthetic_map(n_nodes=1000, images=0, seed=0):
+    """A tree of n_nodes with notes, plus `images` ~40 KB base64 attachments."""
+    import base64
+    import random
+    rng = random.Random(seed)
+    nodes = {'n1': {'id': 'n1', 'parentId': None, 'text': 'Root', 'children': []}}
+    for i in range(2, n_nodes + 1):
+        parent = f'n{rng.randint(max(1, i - 50), i - 1)}'
+        nodes[f'n{i}'] = {
+            'id': f'n{i}', 'parentId': parent, 'text': f'Idea {i} ' + 'word ' * rng.randint(1, 6),
+            'children': [], 'color': rng.choice(['#ff6f59', '#3b82f6', None]),
+            'body': '<p>' + 'Some note text. ' * rng.randint(0, 8) + '</p>',
+        }
+        nodes[parent]['children'].append(f'n{i}')
+    for k in range(images):
+        payload = base64.b64encode(rng.randbytes(30 * 1024)).decode()
+        nodes[f'n{k + 2}']['media'] = [{'type': 'image', 'dataUrl': f'data:image/png;base64,{payload}'}]
+    return {'rootId': 'n1', 'nodes': nodes, 'settings': {'fontSize': 14}}
+
+
+def realistic_map(n_nodes=1000, seed=0, images=None):
+    """A map shaped like real ones: a bushy tree (a few levels deep, where
+    synthetic_map() makes long chains) with notes on some nodes, tags on a
+    third of them, cross links, frames, free bubbles and cards, and images
+    (one per ~2000 nodes unless given)."""
+    import base64
+    import random
+    if images is None:
+        images = max(1, n_nodes // 2000)
+    rng = random.Random(seed)
+    nodes = {'n1': {'id': 'n1', 'parentId': None, 'text': 'Root', 'children': []}}
+    for i in range(2, n_nodes + 1):
+        parent = f'n{rng.randint(max(1, (i - 1) // 6), max(1, (i - 1) // 3))}'
+        node = {'id': f'n{i}', 'parentId': parent, 'text': f'Idea {i} ' + 'word ' * rng.randint(1, 6),
+                'children': [], 'color': rng.choice(['#ff6f59', '#3b82f6', None])}
+        if rng.random() < 0.4:
+            node['body'] = '<p>' + 'Some note text. ' * rng.randint(1, 12) + '</p>'
+        nodes[f'n{i}'] = node
+        nodes[parent]['children'].append(f'n{i}')
+    for k in range(images):
+        payload = base64.b64encode(rng.randbytes(30 * 1024)).decode()
+        nodes[f'n{k + 2}']['media'] = [{'type': 'image', 'dataUrl': f'data:image/png;base64,{payload}'}]
+    content = {'rootId': 'n1', 'nodes': nodes, 'settings': {'fontSize': 14}}
+
+    tags = [{'id': f't{k}', 'name': f'Tag {k}', 'color': rng.choice(['#ef4444', '#22c55e', '#a855f7'])}
+            for k in range(12)]
+    content['settings']['tags'] = tags
+    ids = list(nodes)
+    for node_id in ids[1:]:
+        if rng.random() < 0.33:
+            nodes[node_id]['tags'] = rng.sample([t['id'] for t in tags], rng.randint(1, 3))
+    content['links'] = [
+        {'id': f'l{k}', 'from': rng.choice(ids), 'to': rng.choice(ids), 'label': rng.choice(['', 'voir aussi']),
+         'color': '#94a3b8', 'style': 'dashed'}
+        for k in range(max(1, n_nodes // 50))
+    ]
+    content['frames'] = [
+        {'id': f'f{k}', 'title': f'Zone {k}', 'color': '#dbeafe',
+         'x': rng.randint(-5000, 5000), 'y': rng.randint(-5000, 5000), 'w': 400, 'h': 300}
+        for k in range(max(1, n_nodes // 500))
+    ]
+    for k in range(max(1, n_nodes // 200)):
+        card = k % 2 == 1
+        nodes[f'free{k}'] = {
+            'id': f'free{k}', 'parentId': None, 'text': f'{"Card" if card else "Note"} {k}', 'children': [],
+            'nodeType': 'card' if card else 'bubble', 'placement': 'free',
+            'fx': rng.randint(-5000, 5000), 'fy': rng.randint(-5000, 5000),
+            'color': '#ffffff' if card else '#fef3c7',
+        }
+        if card:
+            nodes[f'free{k}'].update({'body': '<p>' + 'Card body text. ' * rng.randint(2, 20) + '</p>',
+                                      'cardWidth': 280, 'cardExpanded': False})
+    return content
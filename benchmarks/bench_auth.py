@@ -0,0 +1,45 @@
+"""Authentication cost per API call, with and without the auth cache.
+
+    python benchmarks/bench_auth.py [requests]
+
+Times GET /api/auth/me authenticated by HTTP Basic Auth (password KDF),
+X-API-Key and a session cookie, with AUTH_CACHE_TTL=0 and with the default
+cache.
+"""
+import base64
+import sys
+
+from _common import PASSWORD, USERNAME, load_app, login, measure, percentile, quiet, report
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+
+def main():
+    rows = []
+    for label, ttl in (('off', 0), ('on', None)):
+        app_module = load_app(AUTH_CACHE_TTL=ttl)
+        session_client = login(app_module)
+        with quiet():
+            user_id = session_client.get('/api/auth/me').get_json()['id']
+            api_key = session_client.post(f'/api/admin/users/{user_id}/api-key').get_json()['apiKey']
+        anonymous = app_module.app.test_client()
+        basic = {'Authorization': 'Basic ' + base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()}
+        cases = (
+            ('basic auth', lambda: anonymous.get('/api/auth/me', headers=basic)),
+            ('api key', lambda: anonymous.get('/api/auth/me', headers={'X-API-Key': api_key})),
+            ('session', lambda: session_client.get('/api/auth/me')),
+        )
+        for case, call in cases:
+            rate, timings = measure(call, ROUNDS)
+            rows.append({
+                'cache': label,
+                'auth': case,
+                'req/s': f'{rate:.0f}',
+                'p50 ms': f'{percentile(timings, 50) * 1000:.2f}',
+                'p95 ms': f'{percentile(timings, 95) * 1000:.2f}',
+            })
+    report(f'Authenticated GET /api/auth/me, {ROUNDS} requests', rows, list(rows[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Database size and save/load latency per MAP_DATA_CODEC.
+
+    python benchmarks/bench_compression.py [maps] [nodes]
+
+Each map gets an initial save plus a handful of edits (history on, no
+coalescing), then the DB is checkpointed and VACUUMed before measuring.
+"""
+import os
+import sys
+
+from _common import load_app, login, measure, percentile, quiet, report, synthetic_map
+
+MAPS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+NODES = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+EDITS = 5
+
+
+def run(codec):
+    app_module = load_app(MAP_DATA_CODEC=codec, VERSION_COALESCE_SECONDS=0)
+    client = login(app_module)
+    contents = [synthetic_map(NODES, images=2, seed=i) for i in range(MAPS)]
+    ids = []
+
+    def create():
+        i = len(ids)
+        ids.append(client.post('/api/maps', json={'title': f'Map {i}', 'map': contents[i]}).get_json()['id'])
+
+    _, create_times = measure(create, MAPS)
+    edits = iter([(i, k) for k in range(EDITS) for i in range(MAPS)])
+
+    def edit():
+        i, k = next(edits)
+        contents[i]['nodes']['n2']['text'] = f'edit {k}'
+        client.post('/api/maps', json={'id': ids[i], 'title': f'Map {i}', 'map': contents[i]})
+
+    _, save_times = measure(edit, MAPS * EDITS)
+    loads = iter(ids * 5)
+    _, load_times = measure(lambda: client.get(f'/api/maps?id={next(loads)}'), MAPS * 5)
+
+    conn = app_module.get_db()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    with quiet():
+        app_module.reset_db_connections()
+        client.post('/api/admin/vacuum')
+    size = os.path.getsize(app_module.DB_PATH)
+    return {
+        'codec': codec,
+        'db MB': f'{size / 1e6:.2f}',
+        'create p50 ms': f'{percentile(create_times, 50) * 1000:.1f}',
+        'save p50 ms': f'{percentile(save_times, 50) * 1000:.1f}',
+        'load p50 ms': f'{percentile(load_times, 50) * 1000:.1f}',
+    }
+
+
+if __name__ == '__main__':
+    rows = [run(codec) for codec in ('none', 'zlib', 'lzma')]
+    report(f'Map data codecs: {MAPS} maps x {NODES} nodes, {EDITS} edits each', rows, list(rows[0]))
@@ -0,0 +1,108 @@
+"""Throughput and lock errors with several worker processes on one database.
+
+    python benchmarks/bench_concurrency.py [seconds] [threads per worker]
+
+Each worker is a separate process importing server/app.py, like a gunicorn
+worker, with its own request threads. Every thread loops for the given time
+over a mix of 4 map loads for 1 save, saves spread over a few shared maps
+so workers contend for the write lock. Any 5xx or exception (e.g.
+"database is locked") is counted as an error.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from _common import load_app, login, percentile, quiet, report, synthetic_map
+
+SECONDS = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+MAPS = 8
+READS_PER_WRITE = 4
+
+
+def worker(db_path, map_ids, deadline, results):
+    app_module = load_app(db_path)
+    content = synthetic_map(300)
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    write_times = []
+    lock = threading.Lock()
+
+    def loop(seed):
+        client = login(app_module)
+        k = seed
+        while time.time() < deadline:
+            k += 1
+            map_id = map_ids[k % len(map_ids)]
+            try:
+                if k % (READS_PER_WRITE + 1) == 0:
+                    content_k = dict(content, title=f'edit {k}')
+                    t0 = time.perf_counter()
+                    resp = client.post('/api/maps', json={'id': map_id, 'title': map_id, 'map': content_k})
+                    elapsed = time.perf_counter() - t0
+                    kind = 'writes'
+                else:
+                    resp = client.get(f'/api/maps?id={map_id}')
+                    elapsed, kind = None, 'reads'
+                ok = resp.status_code < 500
+            except Exception as e:
+                print(f'[bench] {type(e).__name__}: {e}', file=sys.stderr)
+                ok, kind, elapsed = False, None, None
+            with lock:
+                if not ok:
+                    counts['errors'] += 1
+                else:
+                    counts[kind] += 1
+                    if elapsed is not None:
+                        write_times.append(elapsed)
+
+    with quiet():
+        threads = [threading.Thread(target=loop, args=(i * 1000,)) for i in range(THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    results.put((counts, write_times))
+
+
+def run(workers):
+    db_path = os.path.join(tempfile.mkdtemp(prefix='mindmap-bench-'), 'bench.db')
+    app_module = load_app(db_path)
+    client = login(app_module)
+    with quiet():
+        map_ids = [client.post('/api/maps', json={'title': f'Map {i}', 'map': synthetic_map(300, seed=i)}).get_json()['id']
+                   for i in range(MAPS)]
+    app_module.reset_db_connections()
+
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    deadline = time.time() + 2 + SECONDS  # 2s for the workers to import
+    procs = [ctx.Process(target=worker, args=(db_path, map_ids, deadline, results)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    totals = {'reads': 0, 'writes': 0, 'errors': 0}
+    write_times = []
+    for _ in procs:
+        counts, times = results.get()
+        for key in totals:
+            totals[key] += counts[key]
+        write_times += times
+    for p in procs:
+        p.join()
+    return {
+        'workers': workers,
+        'threads': workers * THREADS,
+        'req/s': f'{(totals["reads"] + totals["writes"]) / SECONDS:.0f}',
+        'writes/s': f'{totals["writes"] / SECONDS:.0f}',
+        'write p50 ms': f'{percentile(write_times, 50) * 1000:.1f}',
+        'write p95 ms': f'{percentile(write_times, 95) * 1000:.1f}',
+        'errors': totals['errors'],
+    }
+
+
+if __name__ == '__main__':
+    rows = [run(workers) for workers in (1, 2, 4)]
+    report(f'Concurrent workers: {SECONDS:.0f}s, {THREADS} threads each, {READS_PER_WRITE} reads per write '
+           f'({os.cpu_count()} CPU)', rows, list(rows[0]))
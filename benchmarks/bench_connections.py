@@ -0,0 +1,40 @@
+"""Requests/sec with connect-per-call vs pooled SQLite connections.
+
+    python benchmarks/bench_connections.py [iterations]
+
+DB_POOL_SIZE=0 reproduces the old behaviour (a fresh connection plus its
+PRAGMAs on every get_db() call).
+"""
+import sys
+
+from _common import load_app, login, measure, quiet, report
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+MAP = {
+    'rootId': 'n1',
+    'nodes': {f'n{i}': {'id': f'n{i}', 'parentId': 'n1' if i > 1 else None,
+                        'text': f'Node {i}', 'children': []} for i in range(1, 51)},
+    'settings': {},
+}
+
+
+def run(pool_size):
+    app_module = load_app(DB_POOL_SIZE=pool_size)
+    client = login(app_module)
+    with quiet():
+        map_id = client.post('/api/maps', json={'title': 'Bench', 'map': MAP}).get_json()['id']
+    read_rps, _ = measure(lambda: client.get(f'/api/maps?id={map_id}'), N)
+    list_rps, _ = measure(lambda: client.get('/api/maps?id=0'), N)
+    save_rps, _ = measure(lambda: client.post('/api/maps', json={'id': map_id, 'title': 'Bench', 'map': MAP}), N // 4)
+    return {
+        'mode': 'pooled' if pool_size else 'connect-per-call',
+        'GET map req/s': f'{read_rps:.0f}',
+        'GET list req/s': f'{list_rps:.0f}',
+        'POST save req/s': f'{save_rps:.0f}',
+    }
+
+
+if __name__ == '__main__':
+    rows = [run(0), run(8)]
+    report(f'Connection management ({N} requests per endpoint)', rows, list(rows[0]))
@@ -0,0 +1,64 @@
+"""Autosave throughput and tail latency with and without group commit.
+
+    python benchmarks/bench_group_commit.py [seconds] [editors] [nodes per map]
+
+Simulates concurrent editors, each autosaving its own map in a loop from
+its own request thread (one process, like a single gunicorn worker with
+many threads). Runs every SAVE_GROUP_COMMIT_MS setting under
+SQLITE_SYNCHRONOUS=FULL (fsync per commit) and NORMAL (WAL default).
+"""
+import sys
+import threading
+import time
+
+from _common import load_app, login, percentile, quiet, report, synthetic_map
+
+SECONDS = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+EDITORS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+NODES = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+
+def run(window_ms, synchronous):
+    app_module = load_app(SAVE_GROUP_COMMIT_MS=window_ms, SQLITE_SYNCHRONOUS=synchronous,
+                          VERSION_COALESCE_SECONDS=0)
+    content = synthetic_map(NODES)
+    clients = [login(app_module) for _ in range(EDITORS)]
+    with quiet():
+        map_ids = [c.post('/api/maps', json={'title': f'Editor {i}', 'map': content}).get_json()['id']
+                   for i, c in enumerate(clients)]
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.time() + SECONDS
+
+    def editor(i):
+        k = 0
+        mine = dict(content, nodes=dict(content['nodes']))
+        while time.time() < deadline:
+            k += 1
+            mine['nodes']['n2'] = dict(content['nodes']['n2'], text=f'editor {i} edit {k}')
+            t0 = time.perf_counter()
+            resp = clients[i].post('/api/maps', json={'id': map_ids[i], 'title': f'Editor {i}', 'map': mine})
+            elapsed = time.perf_counter() - t0
+            with lock:
+                (latencies if resp.status_code == 200 else errors).append(elapsed)
+
+    with quiet():
+        threads = [threading.Thread(target=editor, args=(i,)) for i in range(EDITORS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return {
+        'synchronous': synchronous,
+        'group ms': window_ms or 'off',
+        'saves/s': f'{len(latencies) / SECONDS:.0f}',
+        'p50 ms': f'{percentile(latencies, 50) * 1000:.1f}',
+        'p99 ms': f'{percentile(latencies, 99) * 1000:.1f}',
+        'errors': len(errors),
+    }
+
+
+if __name__ == '__main__':
+    rows = [run(window, sync) for sync in ('FULL', 'NORMAL') for window in (0, 2, 5)]
+    report(f'Group commit: {EDITORS} editors, {SECONDS:.0f}s each', rows, list(rows[0]))
@@ -0,0 +1,46 @@
+"""Folder and user listings with many folders and users.
+
+    python benchmarks/bench_listings.py [folders] [users]
+
+One user with `folders` folders of 20 maps each, plus `users` accounts with
+a few maps, then times GET /api/folders and GET /api/admin/users.
+"""
+import sys
+
+from _common import load_app, login, measure, percentile, quiet, report, synthetic_map
+
+FOLDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+USERS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+ROUNDS = 50
+
+
+def main():
+    app_module = load_app()
+    client = login(app_module)
+    content = synthetic_map(20)
+    with quiet():
+        for f in range(FOLDERS):
+            folder_id = client.post('/api/folders', json={'name': f'Folder {f}'}).get_json()['id']
+            for m in range(20):
+                map_id = client.post('/api/maps', json={'title': f'Map {f}.{m}', 'map': content}).get_json()['id']
+                client.put(f'/api/maps/{map_id}/move', json={'folderId': folder_id})
+        for u in range(USERS):
+            username = f'user{u}'
+            client.post('/api/admin/users', json={'username': username, 'password': 'password1'})
+            other = app_module.app.test_client()
+            other.post('/api/auth/login', json={'username': username, 'password': 'password1'})
+            for m in range(5):
+                other.post('/api/maps', json={'title': f'{username} {m}', 'map': content})
+    rows = []
+    for label, path in (('folders', '/api/folders'), ('users', '/api/admin/users')):
+        _, timings = measure(lambda: client.get(path), ROUNDS)
+        rows.append({
+            'listing': label,
+            'p50 ms': f'{percentile(timings, 50) * 1000:.2f}',
+            'p95 ms': f'{percentile(timings, 95) * 1000:.2f}',
+        })
+    report(f'Listings: {FOLDERS} folders x 20 maps, {USERS} users x 5 maps', rows, list(rows[0]))
+
+
+if __name__ == '__main__':
+    main()
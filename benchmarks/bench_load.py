@@ -0,0 +1,392 @@
+"""Multi-user load test: simulated users against the server, in this process
+or under gunicorn.
+
+    python benchmarks/bench_load.py [--users 20] [--duration 30] [--workers 0] [--threads 4]
+                                    [--autosave 1.2] [--pace 1] [--bots 0.1] [--nodes 300]
+                                    [--env KEY=VALUE ...] [--json FILE]
+
+--workers 0 (default) runs server/app.py in this process behind the Flask
+test client, one thread per user, so no HTTP or gunicorn is involved.
+--workers N starts `gunicorn -c gunicorn.conf.py` with N workers of
+--threads threads on a free local port and talks HTTP to it (needs
+gunicorn from requirements.txt). --env sets server configuration, e.g.
+--env MAP_VERSIONS_KEEP=10 --env SAVE_GROUP_COMMIT_MS=5.
+
+Every user logs in, lists their maps and opens one, then until the end:
+autosaves an edit (PATCH with baseRevision, as the editor does; a 409 is
+counted as a conflict and followed by a reload) every --autosave seconds,
+reopens a map every ~20 s and loads someone's shared link anonymously
+every ~10 s. A --bots share of the users (at least one) instead calls
+/inject with an API key every ~5 s, like an automation. Intervals are
+random (exponential) around these means, scaled by --pace; --pace 0 drops
+the waits to find where the server saturates.
+
+Reports throughput, latency percentiles and error rates per action, plus
+write lock contention from /metrics: waits for a process's write slot,
+SQLITE_BUSY retries and errors, and the time spent waiting.
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from _common import PASSWORD, USERNAME, dump, load_app, percentile, quiet, realistic_map, report
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+USER_PASSWORD = 'loadpass1'
+OPEN_INTERVAL = 20.0
+SHARED_INTERVAL = 10.0
+INJECT_INTERVAL = 5.0
+ACTIONS = ('login', 'open', 'autosave', 'reload', 'shared', 'inject')
+LOCK_SAMPLES = re.compile(r'^(mindmap_db_write_lock_\w+)\{(?:event|stage)="(\w+)"\} (\S+)$', re.M)
+
+
+class _TestClient:
+    """Flask test client with the same call() as _HttpClient."""
+
+    def __init__(self, app_module):
+        self.client = app_module.app.test_client()
+
+    def call(self, method, path, body=None, headers=None):
+        resp = self.client.open(path, method=method, json=body, headers=headers or {})
+        return resp.status_code, resp.get_data()
+
+
+class _HttpClient:
+    """One keep-alive connection with its own session cookie."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        self.cookie = None
+
+    def call(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        for attempt in (0, 1):
+            try:
+                self.conn.request(method, path, payload, headers)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # gunicorn closed the idle keep-alive connection: the request never ran
+                self.conn.close()
+                if attempt:
+                    raise
+        cookie = resp.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return resp.status, data
+
+
+class _Stats:
+    """Per-thread results: latencies and outcome counts by action."""
+
+    def __init__(self):
+        self.times = {action: [] for action in ACTIONS}
+        self.outcomes = {action: {'ok': 0, 'conflict': 0, '4xx': 0, '5xx': 0, 'exception': 0} for action in ACTIONS}
+
+    def record(self, action, started, status):
+        self.times[action].append(time.perf_counter() - started)
+        if status is None:
+            outcome = 'exception'
+        elif status == 409:
+            outcome = 'conflict'
+        elif status >= 500:
+            outcome = '5xx'
+        elif status >= 400:
+            outcome = '4xx'
+        else:
+            outcome = 'ok'
+        self.outcomes[action][outcome] += 1
+        return outcome == 'ok'
+
+    def merge(self, other):
+        for action in ACTIONS:
+            self.times[action] += other.times[action]
+            for outcome, count in other.outcomes[action].items():
+                self.outcomes[action][outcome] += count
+
+
+def _timed(stats, action, client, method, path, body=None, headers=None):
+    """Run one request; returns (status, body bytes), status None on an exception."""
+    started = time.perf_counter()
+    try:
+        status, data = client.call(method, path, body, headers)
+    except Exception as e:
+        print(f'[load] {action}: {type(e).__name__}: {e}', file=sys.stderr)
+        status, data = None, b''
+    stats.record(action, started, status)
+    return status, data
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(args, db_path, env):
+    """Start gunicorn on a free port; returns (process, port, log path)."""
+    if importlib.util.find_spec('gunicorn') is None:
+        raise SystemExit('gunicorn is not installed (pip install -r requirements.txt), or use --workers 0')
+    port = _free_port()
+    log_path = os.path.join(os.path.dirname(db_path), 'gunicorn.log')
+    server_env = dict(os.environ, DB_PATH=db_path, BASIC_AUTH_USERNAME=USERNAME, BASIC_AUTH_PASSWORD=PASSWORD,
+                      SECRET_KEY=secrets.token_hex(32), WEB_CONCURRENCY=str(args.workers),
+                      GUNICORN_THREADS=str(args.threads), METRICS_FLUSH_SECONDS='0.5', ACCESS_LOG='off')
+    server_env.update(env)
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', 'server.app:app'],
+            cwd=ROOT, env=server_env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            status, _ = _HttpClient(port).call('GET', '/login')
+            if status == 200:
+                return proc, port, log_path
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    with open(log_path) as log:
+        raise SystemExit('gunicorn did not start:\n' + log.read()[-2000:])
+
+
+def write_lock_counters(admin):
+    """{name: value} of the write lock samples on /metrics."""
+    status, data = admin.call('GET', '/metrics')
+    if status != 200:
+        return {}
+    return {f'{name}:{label}': float(value) for name, label, value in LOCK_SAMPLES.findall(data.decode())}
+
+
+def setup_users(args, new_client):
+    """Create the users, their maps and share links; return (admin, users, tokens)."""
+    admin = new_client()
+    admin.call('POST', '/api/auth/login', {'username': USERNAME, 'password': PASSWORD})
+    bots = max(1, round(args.users * args.bots)) if args.bots > 0 else 0
+    users, tokens = [], []
+    for i in range(args.users):
+        status, data = admin.call('POST', '/api/admin/users', {'username': f'load{i}', 'password': USER_PASSWORD})
+        if status != 200:
+            raise SystemExit(f'Cannot create user load{i}: HTTP {status} {data[:200]!r}')
+        user = {'id': json.loads(data)['id'], 'username': f'load{i}', 'bot': i < bots, 'maps': []}
+        client = new_client()
+        client.call('POST', '/api/auth/login', {'username': user['username'], 'password': USER_PASSWORD})
+        for k in range(2):
+            content = realistic_map(args.nodes, seed=i * 10 + k, images=0)
+            status, data = client.call('POST', '/api/maps', {'title': f'Load {i}.{k}', 'map': content})
+            if status != 200:
+                raise SystemExit(f'Cannot create a map: HTTP {status} {data[:200]!r}')
+            user['maps'].append(json.loads(data)['id'])
+        status, data = client.call('POST', f"/api/maps/{user['maps'][0]}/share")
+        tokens.append(json.loads(data)['token'])
+        if user['bot']:
+            status, data = admin.call('POST', f"/api/admin/users/{user['id']}/api-keys", {'name': 'load test'})
+            user['api_key'] = json.loads(data)['apiKey']
+        users.append(user)
+    return admin, users, tokens
+
+
+def run_user(user, tokens, new_client, args, deadline, stats, seed):
+    rng = random.Random(seed)
+    client, anonymous = new_client(), new_client()
+    status, _ = _timed(stats, 'login', client, 'POST', '/api/auth/login',
+                       {'username': user['username'], 'password': USER_PASSWORD})
+    if status != 200:
+        return
+    current = {'id': None, 'content': None, 'revision': None}
+
+    def open_map():
+        _timed(stats, 'open', client, 'GET', '/api/maps?id=0')
+        map_id = rng.choice(user['maps'])
+        reload(map_id, 'open')
+
+    def reload(map_id, action):
+        status, data = _timed(stats, action, client, 'GET', f'/api/maps?id={map_id}')
+        if status == 200:
+            body = json.loads(data)
+            current.update(id=map_id, content=body['map'], revision=body['revision'])
+
+    def autosave():
+        if current['content'] is None:
+            return reload(rng.choice(user['maps']), 'reload')
+        nodes = current['content']['nodes']
+        node_id = rng.choice(list(nodes))
+        node = dict(nodes[node_id], text=f'edit {rng.randrange(10 ** 6)}')
+        nodes[node_id] = node
+        status, data = _timed(stats, 'autosave', client, 'PATCH', f"/api/maps/{current['id']}",
+                              {'nodes': {node_id: node}, 'baseRevision': current['revision']})
+        if status == 200:
+            current['revision'] = json.loads(data)['revision']
+        elif status == 409:
+            reload(current['id'], 'reload')
+
+    def shared():
+        _timed(stats, 'shared', anonymous, 'GET', f'/api/shared/{rng.choice(tokens)}')
+
+    def inject():
+        k = rng.randrange(10 ** 6)
+        operations = [{'op': 'add_child', 'parent': 'n1', 'text': f'auto {k}.{j}'} for j in range(5)]
+        operations += [{'op': 'update_node', 'id': f'n{2 + (k + j) % (args.nodes - 1)}', 'text': f'auto {k}'}
+                       for j in range(5)]
+        _timed(stats, 'inject', client, 'POST', f"/api/maps/{user['maps'][1]}/inject",
+               {'operations': operations}, {'X-API-Key': user['api_key']})
+
+    if user['bot']:
+        schedule = {inject: INJECT_INTERVAL}
+    else:
+        open_map()
+        schedule = {autosave: args.autosave, open_map: OPEN_INTERVAL, shared: SHARED_INTERVAL}
+    now = time.monotonic()
+    due = {action: now + rng.uniform(0, mean) * args.pace for action, mean in schedule.items()}
+    while True:
+        action = min(due, key=due.get)
+        wait = due[action] - time.monotonic()
+        if time.monotonic() + max(wait, 0) >= deadline:
+            return
+        if wait > 0:
+            time.sleep(wait)
+        action()
+        due[action] = time.monotonic() + rng.expovariate(1 / schedule[action]) * args.pace
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help='simulated users (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='gunicorn workers; 0 runs in this process (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker (default: %(default)s)')
+    parser.add_argument('--autosave', type=float, default=1.2,
+                        help='mean seconds between autosaves of a user (default: %(default)s, the editor default)')
+    parser.add_argument('--pace', type=float, default=1.0, help='scale of all waits; 0 = none (default: %(default)s)')
+    parser.add_argument('--bots', type=float, default=0.1, help='share of users calling /inject (default: %(default)s)')
+    parser.add_argument('--nodes', type=int, default=300, help='nodes per map (default: %(default)s)')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='server setting, repeatable')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON')
+    args = parser.parse_args()
+    env = dict(item.split('=', 1) for item in args.env)
+
+    db_dir = tempfile.mkdtemp(prefix='mindmap-load-')
+    db_path = os.path.join(db_dir, 'load.db')
+    proc = log_path = None
+    if args.workers:
+        proc, port, log_path = start_gunicorn(args, db_path, env)
+        mode = f'gunicorn, {args.workers} worker(s) x {args.threads} threads'
+
+        def new_client():
+            return _HttpClient(port)
+    else:
+        app_module = load_app(db_path, **env)
+        mode = 'in process (Flask test client), one thread per user'
+
+        def new_client():
+            return _TestClient(app_module)
+
+    try:
+        print(f'Setting up {args.users} users...', flush=True)
+        with quiet():
+            admin, users, tokens = setup_users(args, new_client)
+            before = write_lock_counters(admin)
+        print(f'Running {args.duration:.0f} s ({mode})...', flush=True)
+        per_thread = [_Stats() for _ in users]
+        started = time.monotonic()
+        deadline = started + args.duration
+        with quiet():
+            threads = [threading.Thread(target=run_user, args=(user, tokens, new_client, args, deadline, stats, i))
+                       for i, (user, stats) in enumerate(zip(users, per_thread))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.monotonic() - started
+            if args.workers:
+                # Every worker writes its metrics snapshot when it serves a scrape
+                time.sleep(0.6)
+                for _ in range(args.workers * 4):
+                    write_lock_counters(admin)
+            after = write_lock_counters(admin)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    stats = _Stats()
+    for other in per_thread:
+        stats.merge(other)
+    rows, results = [], {}
+    for action in ACTIONS + ('total',):
+        if action == 'total':
+            times = [t for a in ACTIONS for t in stats.times[a]]
+            outcomes = {k: sum(stats.outcomes[a][k] for a in ACTIONS) for k in stats.outcomes['open']}
+        else:
+            times, outcomes = stats.times[action], stats.outcomes[action]
+        if not times:
+            continue
+        failed = outcomes['5xx'] + outcomes['exception']
+        results[action] = {
+            'requests': len(times), 'per_second': round(len(times) / elapsed, 1),
+            'p50_ms': round(percentile(times, 50) * 1000, 2), 'p95_ms': round(percentile(times, 95) * 1000, 2),
+            'p99_ms': round(percentile(times, 99) * 1000, 2), **outcomes,
+        }
+        rows.append({'action': action, 'requests': len(times), 'req/s': f'{len(times) / elapsed:.1f}',
+                     'p50 ms': f'{percentile(times, 50) * 1000:.1f}', 'p95 ms': f'{percentile(times, 95) * 1000:.1f}',
+                     'p99 ms': f'{percentile(times, 99) * 1000:.1f}',
+                     'errors': f'{failed} ({failed / len(times):.1%})', '409': outcomes['conflict'],
+                     'other 4xx': outcomes['4xx']})
+    settings = ' '.join(args.env) or 'defaults'
+    report(f'{args.users} users for {elapsed:.0f} s, {mode}, server settings: {settings} ({os.cpu_count()} CPU)',
+           rows, list(rows[0]))
+
+    def delta(key):
+        return after.get(key, 0.0) - before.get(key, 0.0)
+    contention = {
+        'slot_waits': int(delta('mindmap_db_write_lock_events_total:slot_wait')),
+        'slot_wait_s': round(delta('mindmap_db_write_lock_wait_seconds_sum:slot'), 3),
+        'slot_timeouts': int(delta('mindmap_db_write_lock_events_total:slot_timeout')),
+        'busy_retries': int(delta('mindmap_db_write_lock_events_total:busy_retry')),
+        'busy_errors': int(delta('mindmap_db_write_lock_events_total:busy_error')),
+        'writes': int(delta('mindmap_db_write_lock_wait_seconds_count:sqlite')),
+        'begin_wait_s': round(delta('mindmap_db_write_lock_wait_seconds_sum:sqlite'), 3),
+    }
+    if not after:
+        print('\nWrite lock contention: /metrics unavailable (METRICS_ENABLED=0?)')
+    else:
+        report('Write lock contention', [{
+            'writes': contention['writes'],
+            'slot waits': f"{contention['slot_waits']} ({contention['slot_wait_s']:.2f} s)",
+            'slot timeouts': contention['slot_timeouts'],
+            'BEGIN IMMEDIATE wait': f"{contention['begin_wait_s']:.2f} s",
+            'busy retries': contention['busy_retries'],
+            'busy errors': contention['busy_errors'],
+        }], ['writes', 'slot waits', 'slot timeouts', 'BEGIN IMMEDIATE wait', 'busy retries', 'busy errors'])
+    if log_path:
+        print(f'\nServer log: {log_path}')
+    if args.json:
+        dump(args.json, {'mode': mode, 'args': vars(args), 'elapsed_s': round(elapsed, 2),
+                         'actions': results, 'write_lock': contention})
+
+
+if __name__ == '__main__':
+    main()
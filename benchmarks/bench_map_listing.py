@@ -0,0 +1,49 @@
+"""Map listing cost as an account grows, whole list versus one page.
+
+    python benchmarks/bench_map_listing.py [maps...]
+
+For each size, times GET /api/maps?id=0 (the whole list), the first page of
+100, a page deep in the list (by cursor) and a title filter.
+"""
+import sys
+
+from _common import load_app, login, measure, percentile, quiet, report, synthetic_map
+
+SIZES = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+ROUNDS = 30
+
+
+def main():
+    rows = []
+    for size in SIZES:
+        app_module = load_app()
+        client = login(app_module)
+        content = synthetic_map(5)
+        with quiet():
+            for i in range(size):
+                client.post('/api/maps', json={'title': f'Map {i}', 'map': content})
+            cursor = None
+            for _ in range(size // 200):  # walk half-way down
+                cursor = client.get('/api/maps', query_string={'id': 0, 'limit': 100, 'cursor': cursor or ''}).headers['X-Next-Cursor']
+        cases = (
+            ('whole list', {'id': 0}),
+            ('first page', {'id': 0, 'limit': 100}),
+            ('middle page', {'id': 0, 'limit': 100, 'cursor': cursor}),
+            ('title filter', {'id': 0, 'limit': 100, 'title': 'Map 99'}),
+        )
+        for label, query in cases:
+            _, timings = measure(lambda: client.get('/api/maps', query_string=query), ROUNDS)
+            with quiet():
+                size_kb = len(client.get('/api/maps', query_string=query).data) / 1024
+            rows.append({
+                'maps': size,
+                'request': label,
+                'KB': f'{size_kb:.1f}',
+                'p50 ms': f'{percentile(timings, 50) * 1000:.2f}',
+                'p95 ms': f'{percentile(timings, 95) * 1000:.2f}',
+            })
+    report('Map listing', rows, list(rows[0]))
+
+
+if __name__ == '__main__':
+    main()
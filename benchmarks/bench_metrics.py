@@ -0,0 +1,62 @@
+"""What the metrics layer adds to a request.
+
+    python benchmarks/bench_metrics.py [batches]
+
+Times a map load, the map listing and a small save in alternating batches
+of 200 with metrics off and on (same app, same data), and reports the
+best and median batch mean of each. On a busy machine the best batch is
+the steadier comparison.
+"""
+import statistics
+import sys
+import time
+
+from _common import load_app, login, quiet, report, synthetic_map
+
+BATCHES = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+BATCH = 200
+
+
+def batch_mean(call):
+    with quiet():
+        start = time.perf_counter()
+        for _ in range(BATCH):
+            call()
+        return (time.perf_counter() - start) / BATCH
+
+
+def main():
+    app_module = load_app()
+    client = login(app_module)
+    content = synthetic_map(50)
+    with quiet():
+        map_id = client.post('/api/maps', json={'title': 'Bench', 'map': content}).get_json()['id']
+        for i in range(50):
+            client.post('/api/maps', json={'title': f'Map {i}', 'map': synthetic_map(5)})
+    cases = (
+        ('load map', lambda: client.get(f'/api/maps?id={map_id}')),
+        ('list maps', lambda: client.get('/api/maps?id=0')),
+        ('save map', lambda: client.post('/api/maps', json={'id': map_id, 'title': 'Bench', 'map': content})),
+    )
+    rows = []
+    for label, call in cases:
+        batch_mean(call)  # warm up
+        means = {False: [], True: []}
+        for _ in range(BATCHES):
+            for enabled in (False, True):
+                app_module.METRICS_ENABLED = enabled
+                means[enabled].append(batch_mean(call))
+        for stat in (min, statistics.median):
+            off, on = stat(means[False]), stat(means[True])
+            rows.append({
+                'request': label,
+                'batch': 'best' if stat is min else 'median',
+                'off us': f'{off * 1e6:.1f}',
+                'on us': f'{on * 1e6:.1f}',
+                'overhead us': f'{(on - off) * 1e6:.1f}',
+            })
+    report(f'Metrics overhead ({BATCHES} x {BATCH} requests per case and setting)', rows, list(rows[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Bytes on the wire and time to first byte per Accept-Encoding.
+
+    python benchmarks/bench_response_compression.py [rounds]
+
+Runs the app on a local werkzeug server and reads responses over a real
+socket, so TTFB covers building and compressing the body. Static files are
+requested once before timing so their precompressed copies exist.
+"""
+import http.client
+import json
+import logging
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from _common import PASSWORD, USERNAME, load_app, percentile, quiet, report, synthetic_map
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+ENCODINGS = ('identity', 'gzip', 'br')
+
+
+def fetch(port, path, encoding, cookie):
+    """Return (status, wire bytes, ttfb seconds, total seconds)."""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    start = time.perf_counter()
+    conn.request('GET', path, headers={'Accept-Encoding': encoding, 'Cookie': cookie})
+    resp = conn.getresponse()
+    first = resp.read(1)
+    ttfb = time.perf_counter() - start
+    body = first + resp.read()
+    total = time.perf_counter() - start
+    conn.close()
+    return resp.status, len(body), ttfb, total
+
+
+def login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/api/auth/login', body=json.dumps({'username': USERNAME, 'password': PASSWORD}),
+                 headers={'Content-Type': 'application/json'})
+    resp = conn.getresponse()
+    resp.read()
+    cookie = resp.getheader('Set-Cookie').split(';', 1)[0]
+    conn.close()
+    return cookie
+
+
+def main():
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app_module = load_app()
+    with quiet():
+        server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    rows = []
+    with quiet():
+        cookie = login(port)
+        client = app_module.app.test_client()
+        client.set_cookie('session', cookie.split('=', 1)[1])
+        targets = {}
+        for nodes in (1000, 10000):
+            saved = client.post('/api/maps', json={'title': f'{nodes} nodes', 'map': synthetic_map(nodes)}).get_json()
+            targets[f'map {nodes} nodes'] = f'/api/maps?id={saved["id"]}'
+        targets['/api/schema'] = '/api/schema'
+        targets['src/main.js'] = '/src/main.js'
+        targets['styles.css'] = '/styles.css'
+        for path in targets.values():
+            for encoding in ENCODINGS:
+                fetch(port, path, encoding, cookie)
+        for name, path in targets.items():
+            for encoding in ENCODINGS:
+                samples = [fetch(port, path, encoding, cookie) for _ in range(ROUNDS)]
+                rows.append({
+                    'resource': name,
+                    'encoding': encoding,
+                    'wire KB': f'{samples[0][1] / 1024:.1f}',
+                    'ttfb p50 ms': f'{percentile([s[2] for s in samples], 50) * 1000:.2f}',
+                    'total p50 ms': f'{percentile([s[3] for s in samples], 50) * 1000:.2f}',
+                })
+    server.shutdown()
+    report(f'Response compression over loopback ({ROUNDS} rounds, brotli {"on" if app_module.brotli else "off"})',
+           rows, list(rows[0]))
+
+
+if __name__ == '__main__':
+    main()
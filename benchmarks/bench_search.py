@@ -0,0 +1,61 @@
+"""Full-text search latency, and what keeping the index current costs a save.
+
+    python benchmarks/bench_search.py [maps] [nodes per map]
+
+Fills one user's account with synthetic maps, then times /api/search for a
+term found in every map, a rarer one and a prefix (first page of 20), and
+the save of a 1000-node map with one edited node with and without the index
+update.
+"""
+import sys
+
+from _common import load_app, login, measure, percentile, quiet, report, synthetic_map
+
+MAPS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+NODES = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+ROUNDS = 50
+
+
+def main():
+    app_module = load_app()
+    client = login(app_module)
+    with quiet():
+        for i in range(MAPS):
+            client.post('/api/maps', json={'title': f'Map {i}', 'map': synthetic_map(NODES, seed=i)})
+    rows = []
+    for label, q in (('common term', 'word'), ('rare term', 'idea 17'), ('prefix', 'ide'), ('no hit', 'zzzz')):
+        _, timings = measure(lambda: client.get('/api/search', query_string={'q': q}), ROUNDS)
+        with quiet():
+            hits = len(client.get('/api/search', query_string={'q': q}).get_json()['results'])
+        rows.append({
+            'case': f'search: {label}',
+            'hits (page)': hits,
+            'p50 ms': f'{percentile(timings, 50) * 1000:.2f}',
+            'p95 ms': f'{percentile(timings, 95) * 1000:.2f}',
+        })
+
+    content = synthetic_map(1000)
+    with quiet():
+        map_id = client.post('/api/maps', json={'title': 'Big', 'map': content}).get_json()['id']
+    edits = iter(range(10 ** 6))
+
+    def save():
+        content['nodes']['n2']['text'] = f'edit {next(edits)}'
+        client.post('/api/maps', json={'id': map_id, 'title': 'Big', 'map': content})
+
+    for label in ('indexed', 'index update off'):
+        if label == 'index update off':
+            app_module._update_search_index = lambda *args: None
+            app_module._search_docs = lambda *args: {}
+        _, timings = measure(save, ROUNDS)
+        rows.append({
+            'case': f'save 1000 nodes: {label}',
+            'hits (page)': '',
+            'p50 ms': f'{percentile(timings, 50) * 1000:.2f}',
+            'p95 ms': f'{percentile(timings, 95) * 1000:.2f}',
+        })
+    report(f'Full-text search over {MAPS} maps x {NODES} nodes', rows, list(rows[0]))
+
+
+if __name__ == '__main__':
+    main()
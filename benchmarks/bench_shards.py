@@ -0,0 +1,118 @@
+"""Write contention with one database file versus one file per user.
+
+    python benchmarks/bench_shards.py [seconds] [threads per worker]
+
+Same setup as bench_concurrency.py (separate worker processes, each with
+its own request threads), but every thread is a different user editing
+their own map: 1 load for 1 save. With a single DB_PATH all saves queue on
+one write lock; with DB_SHARD_DIR each user's saves go to their own file.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from _common import load_app, percentile, quiet, report, synthetic_map
+
+SECONDS = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+PASSWORD = 'benchuser'
+
+
+def worker(db_path, shard_dir, users, deadline, results):
+    app_module = load_app(db_path, DB_SHARD_DIR=shard_dir, VERSION_COALESCE_SECONDS=0)
+    content = synthetic_map(300)
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    write_times = []
+    lock = threading.Lock()
+
+    def loop(username, map_id):
+        client = app_module.app.test_client()
+        client.post('/api/auth/login', json={'username': username, 'password': PASSWORD})
+        mine = dict(content, nodes=dict(content['nodes']))
+        k = 0
+        while time.time() < deadline:
+            k += 1
+            try:
+                if k % 2:
+                    mine['nodes']['n2'] = dict(content['nodes']['n2'], text=f'{username} edit {k}')
+                    t0 = time.perf_counter()
+                    resp = client.post('/api/maps', json={'id': map_id, 'title': username, 'map': mine})
+                    elapsed = time.perf_counter() - t0
+                    kind = 'writes'
+                else:
+                    resp = client.get(f'/api/maps?id={map_id}')
+                    elapsed, kind = None, 'reads'
+                ok = resp.status_code < 500
+            except Exception as e:
+                print(f'[bench] {type(e).__name__}: {e}', file=sys.stderr)
+                ok, kind, elapsed = False, None, None
+            with lock:
+                if not ok:
+                    counts['errors'] += 1
+                else:
+                    counts[kind] += 1
+                    if elapsed is not None:
+                        write_times.append(elapsed)
+
+    with quiet():
+        threads = [threading.Thread(target=loop, args=user) for user in users]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    results.put((counts, write_times))
+
+
+def run(layout, workers):
+    tmp = tempfile.mkdtemp(prefix='mindmap-bench-')
+    db_path = os.path.join(tmp, 'bench.db')
+    shard_dir = os.path.join(tmp, 'users') if layout == 'per-user' else None
+    app_module = load_app(db_path, DB_SHARD_DIR=shard_dir)
+    admin = app_module.app.test_client()
+    users = []
+    with quiet():
+        admin.post('/api/auth/login', json={'username': 'bench', 'password': 'benchpass'})
+        for i in range(workers * THREADS):
+            username = f'user{i}'
+            admin.post('/api/admin/users', json={'username': username, 'password': PASSWORD})
+            client = app_module.app.test_client()
+            client.post('/api/auth/login', json={'username': username, 'password': PASSWORD})
+            saved = client.post('/api/maps', json={'title': username, 'map': synthetic_map(300, seed=i)}).get_json()
+            users.append((username, saved['id']))
+    app_module.reset_db_connections()
+
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    deadline = time.time() + 2 + SECONDS  # 2s for the workers to import
+    procs = [ctx.Process(target=worker, args=(db_path, shard_dir, users[w * THREADS:(w + 1) * THREADS], deadline, results))
+             for w in range(workers)]
+    for p in procs:
+        p.start()
+    totals = {'reads': 0, 'writes': 0, 'errors': 0}
+    write_times = []
+    for _ in procs:
+        counts, times = results.get()
+        for key in totals:
+            totals[key] += counts[key]
+        write_times += times
+    for p in procs:
+        p.join()
+    return {
+        'layout': layout,
+        'workers': workers,
+        'users': workers * THREADS,
+        'req/s': f'{(totals["reads"] + totals["writes"]) / SECONDS:.0f}',
+        'writes/s': f'{totals["writes"] / SECONDS:.0f}',
+        'write p50 ms': f'{percentile(write_times, 50) * 1000:.1f}',
+        'write p95 ms': f'{percentile(write_times, 95) * 1000:.1f}',
+        'errors': totals['errors'],
+    }
+
+
+if __name__ == '__main__':
+    rows = [run(layout, workers) for workers in (1, 2, 4) for layout in ('single file', 'per-user')]
+    report(f'Mixed-user load: {SECONDS:.0f}s, {THREADS} users per worker, 1 read per write '
+           f'({os.cpu_count()} CPU)', rows, list(rows[0]))
@@ -0,0 +1,84 @@
+"""History storage and snapshot rebuild latency, full copies vs keyframes + deltas.
+
+    python benchmarks/bench_versions.py [saves] [nodes]
+
+VERSION_KEYFRAME_INTERVAL=1 stores every version as a full copy (the old
+behaviour). Coalescing is disabled for the storage comparison and measured
+separately: with a 300 s slot a burst of autosaves becomes one version.
+"""
+import sys
+import time
+
+from _common import load_app, login, measure, percentile, quiet, report, synthetic_map
+
+SAVES = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+NODES = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+
+def run(interval):
+    app_module = load_app(VERSION_KEYFRAME_INTERVAL=interval, MAP_VERSIONS_KEEP=SAVES, VERSION_COALESCE_SECONDS=0)
+    client = login(app_module)
+    content = synthetic_map(NODES, images=2)
+    with quiet():
+        map_id = client.post('/api/maps', json={'title': 'History', 'map': content}).get_json()['id']
+
+    def edit_and_save():
+        node = content['nodes'][f'n{(time.perf_counter_ns() % (NODES - 1)) + 2}']
+        node['text'] += '!'
+        client.post('/api/maps', json={'id': map_id, 'title': 'History', 'map': content})
+
+    _, save_times = measure(edit_and_save, SAVES - 1)
+
+    conn = app_module.get_db()
+    stored = conn.execute('SELECT SUM(LENGTH(data)) FROM map_versions WHERE map_id = ?', (map_id,)).fetchone()[0]
+    ids = [r[0] for r in conn.execute('SELECT id FROM map_versions WHERE map_id = ? ORDER BY id', (map_id,))]
+    rebuild_by_depth = {}
+    for version_id in ids:
+        base = conn.execute('SELECT COALESCE(base_id, id) FROM map_versions WHERE id = ?', (version_id,)).fetchone()[0]
+        depth = conn.execute('SELECT COUNT(*) FROM map_versions WHERE map_id = ? AND id > ? AND id <= ?',
+                             (map_id, base, version_id)).fetchone()[0]
+        t0 = time.perf_counter()
+        app_module._load_version(conn, map_id, version_id)
+        rebuild_by_depth.setdefault(depth, []).append(time.perf_counter() - t0)
+    conn.close()
+
+    deepest = max(rebuild_by_depth)
+    return {
+        'keyframe interval': interval,
+        'history MB': f'{stored / 1e6:.2f}',
+        'save p50 ms': f'{percentile(save_times, 50) * 1000:.1f}',
+        'rebuild depth 0 ms': f'{percentile(rebuild_by_depth[0], 50) * 1000:.2f}',
+        f'rebuild deepest ms': f'{percentile(rebuild_by_depth[deepest], 50) * 1000:.2f} (depth {deepest})',
+    }
+
+
+def run_policy(window):
+    app_module = load_app(MAP_VERSIONS_KEEP=SAVES, VERSION_COALESCE_SECONDS=window)
+    client = login(app_module)
+    content = synthetic_map(NODES, images=2)
+    with quiet():
+        map_id = client.post('/api/maps', json={'title': 'Policy', 'map': content}).get_json()['id']
+    conn = app_module.get_db()
+
+    def edit_and_save():
+        content['nodes']['n2']['text'] += '!'
+        client.post('/api/maps', json={'id': map_id, 'title': 'Policy', 'map': content})
+        # every other save re-sends identical content
+        client.post('/api/maps', json={'id': map_id, 'title': 'Policy', 'map': content})
+
+    _, save_times = measure(edit_and_save, SAVES // 2)
+    versions = conn.execute('SELECT COUNT(*) FROM map_versions WHERE map_id = ?', (map_id,)).fetchone()[0]
+    conn.close()
+    return {
+        'coalesce slot s': window,
+        'saves': SAVES,
+        'versions kept': versions,
+        'save pair p50 ms': f'{percentile(save_times, 50) * 1000:.1f}',
+    }
+
+
+if __name__ == '__main__':
+    rows = [run(1), run(10), run(20), run(50)]
+    report(f'Version history: {SAVES} saves of a {NODES}-node map', rows, list(rows[0]))
+    rows = [run_policy(0), run_policy(300)]
+    report('Snapshot policy (half the saves are identical re-saves)', rows, list(rows[0]))
@@ -1,5 +1,29 @@
 import os
+import secrets
+import sys
+import tempfile
 
 bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
-workers = 1  # SQLite doesn't support concurrent writers, keep single worker
+# Readers run concurrently under WAL; writes are serialized per process by
+# get_write_db() and across workers by SQLite's lock (busy_timeout + retry).
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
 timeout = 120
+
+# Workers must sign sessions with the same key: without SECRET_KEY each one
+# would generate its own. Set once here in the master so workers inherit it.
+if not os.environ.get('SECRET_KEY'):
+    print("[WARNING] SECRET_KEY not set — sessions will be invalidated on restart.", flush=True)
+    os.environ['SECRET_KEY'] = secrets.token_hex(32)
+
+# Each worker keeps its own metrics: they write snapshots to a shared
+# directory and /metrics adds them up, whichever worker serves the scrape.
+if not os.environ.get('METRICS_DIR'):
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='mindmap-metrics-')
+
+
+def post_fork(server, worker):
+    """Don't let a worker reuse SQLite connections opened by the master (preload_app)."""
+    app_module = sys.modules.get('server.app')
+    if app_module is not None:
+        app_module.reset_db_connections()
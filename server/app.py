@@ -4,18 +4,46 @@ import json
 import sqlite3
 import uuid
 import time
+import hashlib
+import hmac
 import secrets
+import zlib
+import lzma
+import re
+import tempfile
+import base64
+import binascii
+import atexit
+import bisect
+import cProfile
+import io
+import pstats
+import queue
+import random
 import threading
+import gzip
+import mimetypes
+import html
+import unicodedata
+from collections import OrderedDict, deque
 from functools import wraps
-from flask import Flask, request, jsonify, send_from_directory, Response, session, redirect, url_for, after_this_request
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask.json.provider import DefaultJSONProvider
+from flask import Flask, request, jsonify, send_from_directory, Response, session, redirect, url_for, after_this_request, g, has_request_context
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
 
 # Force unbuffered output for Railway logs
 print("=== Starting MindMap Server ===", flush=True)
 
 # Get the project root (parent of server/)
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-app = Flask(__name__, static_folder=PROJECT_ROOT, static_url_path='')
+# No built-in static route: files go through static_files() (auth allowlist, precompressed variants)
+app = Flask(__name__, static_folder=None)
+app.static_folder = PROJECT_ROOT
 
 # Configuration
 DB_PATH = os.environ.get('DB_PATH', 'mindmap.db')
@@ -34,88 +62,1403 @@ print(f"[CONFIG] DB_PATH={DB_PATH}", flush=True)
 print(f"[CONFIG] PROJECT_ROOT={PROJECT_ROOT}", flush=True)
 
 
+# =============================================================================
+# ACCESS LOG
+# =============================================================================
+# One JSON line per request on stdout: ts (ms), method, path, route, status,
+# ms (duration), user, map, bytes_in, bytes_out (after compression).
+# Request threads only put the entry on a bounded queue; a background thread
+# encodes and writes it, and entries are dropped (and counted in the next
+# line's "dropped") rather than waiting when the queue is full.
+# ACCESS_LOG_SAMPLE keeps a fraction of a busy route's lines, e.g.
+# "PATCH /api/maps/<map_id>=0.1,POST /api/maps=0.1"; errors (status >= 400)
+# and requests of ACCESS_LOG_SLOW_MS or more are always logged. Sampled
+# lines carry "sample": rate. ACCESS_LOG=off disables it. Other events of
+# the request path (slow statements, group commits, write lock retries,
+# failed inject operations, profiles that could not be saved) go through the same queue as lines with a
+# "type" (_log_event), so no request thread writes to stdout itself.
+
+ACCESS_LOG = os.environ.get('ACCESS_LOG', 'json')
+ACCESS_LOG_SLOW_MS = float(os.environ.get('ACCESS_LOG_SLOW_MS', 1000))
+ACCESS_LOG_QUEUE_SIZE = int(os.environ.get('ACCESS_LOG_QUEUE_SIZE', 10000))
+
+
+def _parse_sample_rates(spec):
+    """'METHOD /route=rate,...' -> {(method, route): rate}."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        target, _, rate = item.rpartition('=')
+        method, _, route = target.strip().partition(' ')
+        try:
+            rates[(method.upper(), route.strip())] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            print(f"[CONFIG] Ignoring ACCESS_LOG_SAMPLE entry {item!r}", flush=True)
+    return rates
+
+
+ACCESS_LOG_SAMPLE = _parse_sample_rates(os.environ.get('ACCESS_LOG_SAMPLE', ''))
+
+_access_queue = None
+_access_log_pid = None
+_access_log_lock = threading.Lock()
+_access_log_dropped = 0
+
+
+def _access_log_writer(entries):
+    while True:
+        batch = [entries.get()]
+        while len(batch) < 500:
+            try:
+                batch.append(entries.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in batch
+        lines = [json.dumps(entry, separators=(',', ':')) + '\n' for entry in batch if entry is not None]
+        try:
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            pass
+        if stop:
+            return
+
+
+def _stop_access_log(entries, writer):
+    entries.put(None)
+    writer.join(timeout=2)
+
+
+def _access_log_queue():
+    """This process's queue, with its writer thread started on first use
+    (after a fork, the child starts its own)."""
+    global _access_queue, _access_log_pid
+    if _access_log_pid != os.getpid():
+        with _access_log_lock:
+            if _access_log_pid != os.getpid():
+                entries = queue.Queue(maxsize=ACCESS_LOG_QUEUE_SIZE)
+                writer = threading.Thread(target=_access_log_writer, args=(entries,),
+                                          name='access-log', daemon=True)
+                writer.start()
+                atexit.register(_stop_access_log, entries, writer)
+                _access_queue, _access_log_pid = entries, os.getpid()
+    return _access_queue
+
+
+def _queue_log_line(entry):
+    """Hand entry to the writer thread, or count it as dropped if the queue is full."""
+    global _access_log_dropped
+    if _access_log_dropped:
+        entry['dropped'], _access_log_dropped = _access_log_dropped, 0
+    try:
+        _access_log_queue().put_nowait(entry)
+    except queue.Full:
+        _access_log_dropped += entry.pop('dropped', 0) + 1
+
+
+def _log_event(kind, **fields):
+    """Queue a {"ts", "type": kind, **fields} line; nothing with ACCESS_LOG=off."""
+    if ACCESS_LOG != 'off':
+        _queue_log_line({'ts': int(time.time() * 1000), 'type': kind, **fields})
+
+
+@app.after_request
+def _log_access(response):
+    # Registered first, so it runs after every other after_request hook and
+    # logs the final (compressed) size
+    started = g.get('request_started')
+    if ACCESS_LOG == 'off' or started is None:
+        return response
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    route = request.url_rule.rule if request.url_rule else None
+    rate = ACCESS_LOG_SAMPLE.get((request.method, route), 1.0)
+    if rate < 1.0 and response.status_code < 400 and elapsed_ms < ACCESS_LOG_SLOW_MS:
+        if random.random() >= rate:
+            return response
+    else:
+        rate = 1.0
+    user = getattr(request, 'current_user', None)
+    entry = {
+        'ts': int(time.time() * 1000),
+        'method': request.method,
+        'path': request.path,
+        'route': route,
+        'status': response.status_code,
+        'ms': round(elapsed_ms, 2),
+        'user': user['id'] if user else None,
+        'map': g.get('access_map_id') or (request.view_args or {}).get('map_id'),
+        'bytes_in': request.content_length or 0,
+        'bytes_out': response.content_length,
+    }
+    if rate < 1.0:
+        entry['sample'] = rate
+    _queue_log_line(entry)
+    return response
+
+
+# =============================================================================
+# METRICS
+# =============================================================================
+# In-process counters and histograms, served in Prometheus text format on
+# GET /metrics (admin). Recording is a dict lookup and a list increment
+# under one lock. With several workers, set METRICS_DIR (gunicorn.conf.py
+# does): each worker writes a snapshot there every METRICS_FLUSH_SECONDS and
+# /metrics adds them up. Snapshots of exited workers stay, so totals don't
+# go backwards when a worker is replaced.
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') not in ('0', 'false', 'False', '')
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# name -> (type, help, label names, buckets)
+METRIC_DEFS = {
+    'mindmap_http_requests_total': ('counter', 'HTTP requests by route and status.', ('method', 'route', 'status'), None),
+    'mindmap_http_request_duration_seconds': ('histogram', 'Time spent handling a request.', ('method', 'route'), LATENCY_BUCKETS),
+    'mindmap_http_request_size_bytes': ('histogram', 'Request body size.', ('method', 'route'), SIZE_BUCKETS),
+    'mindmap_http_response_size_bytes': ('histogram', 'Response body size, after compression.', ('method', 'route'), SIZE_BUCKETS),
+    'mindmap_db_query_duration_seconds': ('histogram', 'SQLite statement execution time (pooled connections).', (), FAST_BUCKETS),
+    'mindmap_db_write_lock_wait_seconds': ('histogram', "Wait for a write: this process's write slot when taken (slot), BEGIN IMMEDIATE (sqlite).", ('stage',), LATENCY_BUCKETS),
+    'mindmap_db_write_lock_events_total': ('counter', 'Write lock contention: slot_wait, slot_timeout, busy_retry, busy_error.', ('event',), None),
+    'mindmap_json_duration_seconds': ('histogram', 'JSON encoding and decoding time.', ('op',), FAST_BUCKETS),
+    'mindmap_job_duration_seconds': ('histogram', 'Duration of background and maintenance jobs.', ('job', 'outcome'), JOB_BUCKETS),
+}
+_metric_values = {name: {} for name in METRIC_DEFS}  # name -> {label values: count | [bucket counts..., sum]}
+_metrics_lock = threading.Lock()
+_metrics_flushed_at = time.monotonic()
+
+
+def inc_metric(name, labels=(), amount=1):
+    with _metrics_lock:
+        values = _metric_values[name]
+        values[labels] = values.get(labels, 0) + amount
+
+
+def observe_metric(name, value, labels=()):
+    with _metrics_lock:
+        _observe(name, value, labels)
+
+
+def _observe(name, value, labels):
+    """Add value to a histogram (caller holds _metrics_lock). Its series is
+    a list: one count per bucket (plus +Inf), then the sum."""
+    series = _metric_values[name].get(labels)
+    if series is None:
+        buckets = METRIC_DEFS[name][3]
+        series = _metric_values[name][labels] = [0] * (len(buckets) + 2)
+    series[bisect.bisect_left(METRIC_DEFS[name][3], value)] += 1
+    series[-1] += value
+
+
+def timed_job(job):
+    """Decorator timing a job into mindmap_job_duration_seconds. It failed if
+    it raised, returned False, or returned a (response, 5xx) tuple."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = f(*args, **kwargs)
+                failed = result is False or (isinstance(result, tuple) and len(result) > 1
+                                             and isinstance(result[1], int) and result[1] >= 500)
+                outcome = 'error' if failed else 'ok'
+                return result
+            finally:
+                observe_metric('mindmap_job_duration_seconds', time.perf_counter() - start, (job, outcome))
+        return wrapper
+    return decorator
+
+
+def _json_dumps(obj, **kwargs):
+    start = time.perf_counter()
+    text = json.dumps(obj, **kwargs)
+    if METRICS_ENABLED:
+        observe_metric('mindmap_json_duration_seconds', time.perf_counter() - start, ('encode',))
+    return text
+
+
+def _json_loads(text):
+    start = time.perf_counter()
+    value = json.loads(text)
+    if METRICS_ENABLED:
+        observe_metric('mindmap_json_duration_seconds', time.perf_counter() - start, ('decode',))
+    return value
+
+
+class _TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON (request bodies, jsonify) through the timed helpers."""
+
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault('default', self.default)
+        kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        return _json_dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return _json_loads(s)
+
+
+app.json = _TimedJSONProvider(app)
+
+
 @app.before_request
-def log_request():
-    """Log all incoming requests."""
-    print(f"[REQUEST] {request.method} {request.path}", flush=True)
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    # Registered before the other after_request hooks but the access log's,
+    # so it sees the compressed size
+    started = g.get('request_started')
+    if not METRICS_ENABLED or started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (request.method, route)
+    counter_labels = (request.method, route, str(response.status_code))
+    request_size, response_size = request.content_length or 0, response.content_length
+    with _metrics_lock:
+        counts = _metric_values['mindmap_http_requests_total']
+        counts[counter_labels] = counts.get(counter_labels, 0) + 1
+        _observe('mindmap_http_request_duration_seconds', elapsed, labels)
+        _observe('mindmap_http_request_size_bytes', request_size, labels)
+        if response_size is not None:
+            _observe('mindmap_http_response_size_bytes', response_size, labels)
+    if METRICS_DIR and time.monotonic() - _metrics_flushed_at >= METRICS_FLUSH_SECONDS:
+        _write_metrics_snapshot()
+    return response
+
+
+def _write_metrics_snapshot():
+    """Save this worker's values to METRICS_DIR/<pid>.json."""
+    global _metrics_flushed_at
+    _metrics_flushed_at = time.monotonic()
+    with _metrics_lock:
+        snapshot = {name: [[list(labels), value if isinstance(value, int) else list(value)]
+                           for labels, value in values.items()]
+                    for name, values in _metric_values.items()}
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"[METRICS] Cannot write {path}: {e}", flush=True)
+
+
+def _collect_metrics():
+    """Values of every worker (or just this one without METRICS_DIR)."""
+    if not METRICS_DIR:
+        with _metrics_lock:
+            return {name: {labels: value if isinstance(value, (int, float)) else list(value)
+                           for labels, value in values.items()}
+                    for name, values in _metric_values.items()}
+    _write_metrics_snapshot()
+    merged = {name: {} for name in METRIC_DEFS}
+    for entry in os.listdir(METRICS_DIR):
+        if not entry.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, entry)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, series in snapshot.items():
+            if name not in merged:
+                continue
+            for labels, value in series:
+                labels = tuple(labels)
+                if isinstance(value, list):
+                    current = merged[name].setdefault(labels, [0] * len(value))
+                    merged[name][labels] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[name][labels] = merged[name].get(labels, 0) + value
+    return merged
+
+
+def _label_text(names, values, extra=''):
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    pairs = [f'{n}="{v}"' for n, v in zip(names, escaped)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format (0.0.4)."""
+    lines = []
+    for name, values in _collect_metrics().items():
+        kind, help_text, label_names, buckets = METRIC_DEFS[name]
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(values.items()):
+            if kind == 'counter':
+                lines.append(f'{name}{_label_text(label_names, labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{name}_bucket{_label_text(label_names, labels, le)} {cumulative}')
+            lines.append(f'{name}_sum{_label_text(label_names, labels)} {value[-1]:.6f}')
+            lines.append(f'{name}_count{_label_text(label_names, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint. Admins only: session, API key or Basic Auth."""
+    user = get_current_user() or _try_api_auth()
+    if not user:
+        return Response('Non authentifié\n', 401, {'WWW-Authenticate': 'Basic realm="metrics"'}, mimetype='text/plain')
+    if not user.get('is_admin'):
+        return Response('Accès refusé\n', 403, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 
-def get_db():
-    """Get database connection with row factory."""
-    conn = sqlite3.connect(DB_PATH)
+# =============================================================================
+# SERVER TIMING
+# =============================================================================
+# Per-request phase breakdown (auth, db, decode, write, commit, encode...)
+# sent as a Server-Timing header, which browser devtools show under Timing.
+# SERVER_TIMING=admin (default) adds it to admins' responses only, all to
+# every response, off disables the spans.
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'admin')
+
+
+class timing_span:
+    """with timing_span('db'): ... adds the block's duration to this
+    request's Server-Timing entry of that name."""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timings = g.get('server_timing') if has_request_context() else None
+        if timings is not None:
+            timings[self.name] = timings.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+@app.before_request
+def _start_server_timing():
+    if SERVER_TIMING != 'off':
+        g.server_timing = {}
+
+
+@app.after_request
+def _add_server_timing(response):
+    # Runs after _compress_response, so total includes compression
+    timings = g.pop('server_timing', None)
+    if timings is None or 'request_started' not in g:
+        return response
+    if SERVER_TIMING != 'all':
+        user = getattr(request, 'current_user', None)
+        if not user or not user.get('is_admin'):
+            return response
+    timings['total'] = time.perf_counter() - g.request_started
+    response.headers['Server-Timing'] = ', '.join(
+        f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.items())
+    return response
+
+
+# =============================================================================
+# SLOW QUERY LOG
+# =============================================================================
+# Statements on pooled connections that take SLOW_QUERY_MS or more are kept
+# in a ring buffer of SLOW_QUERY_LOG_SIZE entries per worker, with the shape
+# of their parameters (types and lengths, never the values) and their
+# EXPLAIN QUERY PLAN. The time is that of execute(): for a SELECT it covers
+# finding the first row, not fetching the rest. GET /api/admin/slow-queries
+# lists them, and each one is also written to the access log (by its
+# background thread, never from the request). SLOW_QUERY_MS=0 turns it off.
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', 200))
+SLOW_QUERY_PLAN_CACHE = 256  # statements whose plan is remembered
+
+_slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_slow_query_plans = {}  # sql -> plan lines
+_slow_query_lock = threading.Lock()
+
+
+def _param_shape(value):
+    if isinstance(value, (str, bytes)):
+        return f'{type(value).__name__}({len(value)})'
+    return 'null' if value is None else type(value).__name__
+
+
+def _params_shape(params, many=False):
+    if many:
+        rows = params if isinstance(params, list) else list(params)
+        return f'{len(rows)} x {_params_shape(rows[0])}' if rows else '0 rows'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{k}: {_param_shape(v)}' for k, v in params.items()) + '}'
+    return '(' + ', '.join(_param_shape(v) for v in params) + ')'
+
+
+def _query_plan(conn, sql, params, many):
+    """EXPLAIN QUERY PLAN lines for sql, cached per statement text."""
+    plan = _slow_query_plans.get(sql)
+    if plan is not None:
+        return plan
+    if not re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', sql, re.I):
+        plan = []
+    else:
+        try:
+            if many:
+                params = next(iter(params), ())
+            plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+        except (sqlite3.Error, StopIteration, TypeError) as e:
+            plan = [f'(plan unavailable: {e})']
+    if len(_slow_query_plans) >= SLOW_QUERY_PLAN_CACHE:
+        _slow_query_plans.clear()
+    _slow_query_plans[sql] = plan
+    return plan
+
+
+def _record_slow_query(conn, path, args, elapsed, many=False):
+    sql = args[0]
+    params = args[1] if len(args) > 1 else ()
+    try:
+        shape = _params_shape(params, many)
+        if many and not isinstance(params, (list, tuple)):
+            params = ()  # a consumed iterator can't be explained with its values
+        plan = _query_plan(conn, sql, params, many)
+    except Exception as e:  # never fail the query being logged
+        shape, plan = '?', [f'(plan unavailable: {e})']
+    entry = {
+        'at': int(time.time() * 1000),
+        'ms': round(elapsed * 1000, 2),
+        'sql': ' '.join(sql.split()),
+        'params': shape,
+        'plan': plan,
+        'db': os.path.basename(path),
+        'route': f'{request.method} {request.url_rule.rule}' if has_request_context() and request.url_rule else None,
+    }
+    with _slow_query_lock:
+        _slow_queries.append(entry)
+    _log_event('slow_query', ms=entry['ms'], sql=entry['sql'][:200], params=shape, db=entry['db'], route=entry['route'])
+
+
+# =============================================================================
+# PROFILER
+# =============================================================================
+# An admin request carrying X-Profile: 1 (or ?profile=1) runs under cProfile
+# and its stats are written to PROFILE_DIR as a .pstats file, named in the
+# X-Profile-Id response header. /api/admin/profiles lists them, the newest
+# PROFILE_KEEP are kept. Other requests only pay for the header check.
+# One profile at a time per process: on Python 3.12+ cProfile is
+# process-wide, so calls from other threads can show up in it too.
+# Profiles expose code paths and timings: by default they go to a temp
+# directory per database, outside the static root, and static_files()
+# refuses PROFILE_DIR wherever it is.
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '') or os.path.join(
+    tempfile.gettempdir(), 'mindmap-profiles-' + hashlib.sha256(os.path.abspath(DB_PATH).encode()).hexdigest()[:12])
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50))
+PROFILE_NAME_RE = re.compile(r'^(\d+)-(\d+)ms-([A-Z]+)-([\w.~-]*)\.pstats$')  # path with / as ~
+
+_profile_lock = threading.Lock()
+
+
+def _profile_requested():
+    # The query string is only parsed when it mentions profile=1
+    return (request.headers.get('X-Profile') == '1'
+            or (b'profile=1' in request.query_string and request.args.get('profile') == '1'))
+
+
+@app.before_request
+def _start_profiler():
+    if not _profile_requested():
+        return
+    user = get_current_user() or _try_api_auth()
+    if not user or not user.get('is_admin'):
+        return
+    if not _profile_lock.acquire(blocking=False):
+        g.profile_busy = True
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiling tool (debugger, coverage...) is active
+        _profile_lock.release()
+        g.profile_busy = True
+        return
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+
+
+def _stop_profiler():
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return None
+    profiler.disable()
+    _profile_lock.release()
+    return profiler
+
+
+@app.after_request
+def _save_profile(response):
+    # Runs after _compress_response, so compression is in the profile
+    if g.pop('profile_busy', False):
+        response.headers['X-Profile-Id'] = 'busy'
+    profiler = _stop_profiler()
+    if profiler is None:
+        return response
+    elapsed_ms = int((time.perf_counter() - g.pop('profile_started')) * 1000)
+    slug = re.sub(r'[^\w./-]+', '_', request.path.strip('/')).replace('/', '~')[:80]
+    name = f'{int(time.time() * 1000)}-{elapsed_ms}ms-{request.method}-{slug}.pstats'
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+        _prune_profiles()
+    except OSError as e:
+        _log_event('profile_error', file=name, error=str(e))
+        return response
+    response.headers['X-Profile-Id'] = name
+    return response
+
+
+@app.teardown_request
+def _discard_profiler(exc):
+    # after_request is skipped when the response could not be built
+    _stop_profiler()
+
+
+def _list_profiles():
+    """Saved profiles, newest first."""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names:
+        match = PROFILE_NAME_RE.match(name)
+        if match:
+            at, ms, method, path = match.groups()
+            profiles.append({'id': name, 'at': int(at), 'ms': int(ms), 'method': method,
+                             'path': '/' + path.replace('~', '/'), 'size': os.path.getsize(os.path.join(PROFILE_DIR, name))})
+    profiles.sort(key=lambda p: p['at'], reverse=True)
+    return profiles
+
+
+def _prune_profiles():
+    for profile in _list_profiles()[PROFILE_KEEP:]:
+        try:
+            os.unlink(os.path.join(PROFILE_DIR, profile['id']))
+        except OSError:
+            pass
+
+
+# =============================================================================
+# DATABASE CONNECTIONS
+# =============================================================================
+# Connections are opened and configured once, then reused across requests.
+# get_db() hands out a lease; calling close() on it returns the connection to
+# the pool (rolling back anything left uncommitted) instead of closing it.
+# Set DB_POOL_SIZE=0 to get the old connect-per-call behaviour.
+#
+# Writes go through get_write_db(): one writer at a time per process and
+# database file (other request threads queue on its lock instead of spinning
+# in SQLite's busy handler), and the transaction starts with BEGIN IMMEDIATE so the database
+# lock is taken before the first read. Workers in other processes wait on
+# busy_timeout, then retry with backoff. Readers are never blocked (WAL).
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+SQLITE_PRAGMAS = {
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),  # ms
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -16000)),  # negative = KiB
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024)),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),  # NORMAL is durable enough under WAL
+    'temp_store': 'MEMORY',
+}
+
+DB_WRITE_TIMEOUT = float(os.environ.get('DB_WRITE_TIMEOUT', 30))  # seconds to wait for the write slot
+DB_WRITE_RETRIES = int(os.environ.get('DB_WRITE_RETRIES', 5))  # BEGIN IMMEDIATE attempts after busy_timeout
+
+# Per-user databases (DB_SHARD_DIR set): DB_PATH becomes the catalog (users,
+# blobs, jobs, and map_index: which user owns a map and its share token) and
+# each user's maps, folders and history live in DB_SHARD_DIR/<user id>.db.
+# Every file has its own pool and write slot, so users never wait on each
+# other's writes. Shards get the full schema; the catalog-only tables in
+# them just stay empty. Unset, everything lives in DB_PATH as before.
+DB_SHARD_DIR = os.environ.get('DB_SHARD_DIR', '')
+DB_SHARD_POOL_SIZE = int(os.environ.get('DB_SHARD_POOL_SIZE', 2))  # idle connections kept per user file
+
+_pools = {}  # database path -> idle connections
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
+_write_lock = threading.Lock()  # DB_PATH's write slot
+_shard_write_locks = {}
+_ready_shards = set()  # shard paths migrated by this process
+
+
+def _shard_path(shard):
+    """Database file for shard (a user id); DB_PATH for None or in single-file mode."""
+    if shard is None or not DB_SHARD_DIR:
+        return DB_PATH
+    if not re.fullmatch(r'[\w-]+', shard):
+        raise ValueError(f'invalid shard name: {shard!r}')
+    return os.path.join(DB_SHARD_DIR, f'{shard}.db')
+
+
+def _path_write_lock(path):
+    if path == DB_PATH:
+        return _write_lock
+    with _pool_lock:
+        return _shard_write_locks.setdefault(path, threading.Lock())
+
+
+def _connect(path=None):
+    """Open and configure a new SQLite connection (to DB_PATH by default)."""
+    conn = sqlite3.connect(path or DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
     conn.execute("PRAGMA journal_mode = WAL")
+    for name, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
     return conn
 
 
-def init_db():
-    """Initialize database schema."""
-    print(f"[DB] Initializing database at {DB_PATH}", flush=True)
+class _PooledConnection:
+    """Lease on a pooled connection. close() gives it back to the pool."""
+
+    __slots__ = ('_conn', '_path')
+
+    def __init__(self, conn, path=None):
+        self._conn = conn
+        self._path = path or DB_PATH
+
+    def execute(self, *args):
+        if not METRICS_ENABLED and SLOW_QUERY_MS <= 0:
+            return self._conn.execute(*args)
+        start = time.perf_counter()
+        try:
+            return self._conn.execute(*args)
+        finally:
+            self._timed(args, time.perf_counter() - start, False)
+
+    def executemany(self, *args):
+        if not METRICS_ENABLED and SLOW_QUERY_MS <= 0:
+            return self._conn.executemany(*args)
+        start = time.perf_counter()
+        try:
+            return self._conn.executemany(*args)
+        finally:
+            self._timed(args, time.perf_counter() - start, True)
+
+    def _timed(self, args, elapsed, many):
+        if METRICS_ENABLED:
+            observe_metric('mindmap_db_query_duration_seconds', elapsed)
+        if 0 < SLOW_QUERY_MS <= elapsed * 1000:
+            _record_slow_query(self._conn, self._path, args, elapsed, many)
+
+    def executescript(self, script):
+        return self._conn.executescript(script)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def __getattr__(self, name):
+        conn = object.__getattribute__(self, '_conn')
+        if conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            _release_connection(conn, self._path)
+
+
+class _WriteConnection(_PooledConnection):
+    """Lease that also holds its database's write slot; close() frees both.
+
+    A commit on a user's own database marks that user's counters for the
+    catalog's copy (see flush_user_stats).
+    """
+
+    __slots__ = ('_lock', '_shard', '_dirty')
+
+    def __init__(self, conn, path, lock, shard=None):
+        super().__init__(conn, path)
+        self._lock = lock
+        self._shard = shard if path != DB_PATH else None
+        self._dirty = False
+
+    def commit(self):
+        self._conn.commit()
+        self._dirty = self._shard is not None
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                _release_connection(conn, self._path)
+            finally:
+                self._lock.release()
+            if self._dirty:
+                _note_user_stats(self._shard)
+
+
+def reset_db_connections():
+    """Drop every pooled connection (after fork, or when DB_PATH changes).
+
+    Connections inherited from a parent process are abandoned, not closed:
+    closing them could disturb the parent's file locks.
+    """
+    global _pools, _pool_pid
+    with _pool_lock:
+        if _pool_pid == os.getpid():
+            for idle in _pools.values():
+                for conn in idle:
+                    conn.close()
+        _pools = {}
+        _pool_pid = os.getpid()
+
+
+def _close_pooled(path):
+    """Close the idle connections to one database file (before removing it)."""
+    with _pool_lock:
+        idle = _pools.pop(path, [])
+        _ready_shards.discard(path)
+    for conn in idle:
+        conn.close()
+
+
+def _checkout_connection(path=None):
+    path = path or DB_PATH
+    if _pool_pid != os.getpid():
+        reset_db_connections()
+    conn = None
+    with _pool_lock:
+        idle = _pools.get(path)
+        if idle:
+            conn = idle.pop()
+    if conn is not None:
+        return conn
+    if path != DB_PATH and path not in _ready_shards:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = _connect(path)
+        migrate(conn)
+        with _pool_lock:
+            _ready_shards.add(path)
+        return conn
+    return _connect(path)
+
+
+def get_db(shard=None):
+    """Get a pooled database connection with row factory.
+
+    shard is the user id whose database to open (see DB_SHARD_DIR); None,
+    or any value in single-file mode, opens DB_PATH.
+    """
+    path = _shard_path(shard)
+    return _PooledConnection(_checkout_connection(path), path)
+
+
+def _is_busy(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+def get_write_db(shard=None):
+    """Get a pooled connection for a read-modify-write, inside BEGIN IMMEDIATE.
+
+    Blocks until this process's write slot for that database is free
+    (DB_WRITE_TIMEOUT), then until SQLite grants the write lock
+    (busy_timeout, DB_WRITE_RETRIES). Raises sqlite3.OperationalError if
+    either wait runs out.
+    """
+    path = _shard_path(shard)
+    lock = _path_write_lock(path)
+    if not lock.acquire(blocking=False):
+        # Another thread of this process is writing to that database
+        start = time.perf_counter()
+        acquired = lock.acquire(timeout=DB_WRITE_TIMEOUT)
+        if METRICS_ENABLED:
+            inc_metric('mindmap_db_write_lock_events_total', ('slot_wait' if acquired else 'slot_timeout',))
+            observe_metric('mindmap_db_write_lock_wait_seconds', time.perf_counter() - start, ('slot',))
+        if not acquired:
+            raise sqlite3.OperationalError('database is locked (write queue timeout)')
+    conn = None
     try:
-        conn = get_db()
+        conn = _checkout_connection(path)
+        start = time.perf_counter()
+        for attempt in range(DB_WRITE_RETRIES + 1):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                break
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e) or attempt == DB_WRITE_RETRIES:
+                    if METRICS_ENABLED and _is_busy(e):
+                        inc_metric('mindmap_db_write_lock_events_total', ('busy_error',))
+                    raise
+                if METRICS_ENABLED:
+                    inc_metric('mindmap_db_write_lock_events_total', ('busy_retry',))
+                _log_event('write_busy', db=os.path.basename(path), attempt=attempt + 1, retries=DB_WRITE_RETRIES)
+                time.sleep(min(0.05 * 2 ** attempt, 1.0))
+        if METRICS_ENABLED:
+            observe_metric('mindmap_db_write_lock_wait_seconds', time.perf_counter() - start, ('sqlite',))
+    except BaseException:
+        if conn is not None:
+            _release_connection(conn, path)
+        lock.release()
+        raise
+    lease = _WriteConnection(conn, path, lock, shard)
+    if has_request_context():
+        g.setdefault('write_leases', []).append(lease)
+    return lease
+
+
+@app.teardown_request
+def _release_write_leases(exc):
+    """Free the write slot if a route raised before closing its connection."""
+    for lease in g.pop('write_leases', []):
+        lease.close()
+
+
+def _release_connection(conn, path=None):
+    """Return a connection to the pool, or close it if the pool is full."""
+    path = path or DB_PATH
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        conn.close()
+        return
+    if _pool_pid == os.getpid():
+        limit = DB_POOL_SIZE if path == DB_PATH else min(DB_POOL_SIZE, DB_SHARD_POOL_SIZE)
+        with _pool_lock:
+            idle = _pools.setdefault(path, [])
+            if len(idle) < limit:
+                idle.append(conn)
+                return
+    conn.close()
 
-        # Users table
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                display_name TEXT,
-                is_admin INTEGER DEFAULT 0,
-                created_at INTEGER,
-                updated_at INTEGER
-            )
-        ''')
-
-        # Maps table
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS maps (
-                id TEXT PRIMARY KEY,
-                title TEXT,
-                data TEXT,
-                created_at INTEGER,
-                updated_at INTEGER
-            )
-        ''')
-
-        # Folders table
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS folders (
-                id TEXT PRIMARY KEY,
-                name TEXT,
-                created_at INTEGER,
-                updated_at INTEGER
-            )
-        ''')
-
-        # Map versions table (history)
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS map_versions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                map_id TEXT NOT NULL,
-                data TEXT NOT NULL,
-                created_at INTEGER NOT NULL
-            )
-        ''')
-
-        # Add columns if they don't exist (migration-safe)
-        migrations = [
-            ('maps', 'folder_id', 'ALTER TABLE maps ADD COLUMN folder_id TEXT'),
-            ('maps', 'trashed', 'ALTER TABLE maps ADD COLUMN trashed INTEGER DEFAULT 0'),
-            ('maps', 'user_id', 'ALTER TABLE maps ADD COLUMN user_id TEXT'),
-            ('folders', 'user_id', 'ALTER TABLE folders ADD COLUMN user_id TEXT'),
-            ('maps', 'share_token', 'ALTER TABLE maps ADD COLUMN share_token TEXT'),
-            ('users', 'api_key', 'ALTER TABLE users ADD COLUMN api_key TEXT'),
-        ]
-        for table, col, sql in migrations:
+
+def _user_shard(user):
+    """Shard holding user's own maps and folders."""
+    return user['id'] if DB_SHARD_DIR else None
+
+
+def _map_shard(map_id, user):
+    """Shard to look map_id up in: its owner's (from map_index), else user's own."""
+    if not DB_SHARD_DIR:
+        return None
+    conn = get_db()
+    row = conn.execute('SELECT user_id FROM map_index WHERE map_id = ?', (map_id,)).fetchone()
+    conn.close()
+    return row['user_id'] if row else user['id']
+
+
+def _index_map(map_id, user_id, share_token=None):
+    """Record map_id's owner (and share token) in the catalog. Sharded mode only."""
+    if not DB_SHARD_DIR:
+        return
+    conn = get_write_db()
+    try:
+        conn.execute(
+            'INSERT INTO map_index (map_id, user_id, share_token) VALUES (?, ?, ?) '
+            'ON CONFLICT(map_id) DO UPDATE SET user_id = excluded.user_id, share_token = excluded.share_token',
+            (map_id, user_id, share_token)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# With DB_SHARD_DIR the catalog's user_stats holds a copy of each user
+# file's row, for the admin user list. A commit on a user file only marks
+# the user; a timer copies the marked users' rows every
+# USER_STATS_FLUSH_SECONDS in one catalog transaction, off the request
+# thread, so users' saves don't meet on the catalog's write slot.
+USER_STATS_FLUSH_SECONDS = float(os.environ.get('USER_STATS_FLUSH_SECONDS', 2))
+
+_dirty_user_stats = set()
+_user_stats_lock = threading.Lock()
+_user_stats_timer = None
+
+
+def _note_user_stats(user_id):
+    global _user_stats_timer
+    with _user_stats_lock:
+        _dirty_user_stats.add(user_id)
+        if _user_stats_timer is not None and _user_stats_timer.is_alive():
+            return
+        timer = _user_stats_timer = threading.Timer(USER_STATS_FLUSH_SECONDS, flush_user_stats)
+        timer.daemon = True
+    timer.start()
+
+
+def flush_user_stats():
+    """Copy the marked users' counters from their own files to the catalog."""
+    global _user_stats_timer
+    with _user_stats_lock:
+        users = sorted(_dirty_user_stats)
+        _dirty_user_stats.clear()
+        _user_stats_timer = None
+    if not users:
+        return
+    try:
+        rows = []
+        for user_id in users:
+            if not os.path.exists(_shard_path(user_id)):
+                continue  # user deleted meanwhile
+            conn = get_db(user_id)
             try:
-                conn.execute(sql)
-                print(f"[DB] Added column {table}.{col}", flush=True)
-            except sqlite3.OperationalError:
-                pass  # Column already exists
+                row = conn.execute('SELECT map_count, map_bytes FROM user_stats WHERE user_id = ?', (user_id,)).fetchone()
+            finally:
+                conn.close()
+            if row is not None:
+                rows.append((user_id, row[0], row[1]))
+        conn = get_write_db()
+        try:
+            conn.executemany(
+                'INSERT INTO user_stats (user_id, map_count, map_bytes) VALUES (?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET map_count = excluded.map_count, map_bytes = excluded.map_bytes',
+                rows
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[STATS] Could not copy user counters to the catalog: {e}", flush=True)
+
+
+atexit.register(flush_user_stats)
+
 
+def _unindex_map(map_id):
+    if not DB_SHARD_DIR:
+        return
+    conn = get_write_db()
+    try:
+        conn.execute('DELETE FROM map_index WHERE map_id = ?', (map_id,))
         conn.commit()
+    finally:
+        conn.close()
+
+
+def _data_shards():
+    """Every database holding maps: DB_PATH, then one per user file in DB_SHARD_DIR."""
+    shards = [None]
+    if DB_SHARD_DIR and os.path.isdir(DB_SHARD_DIR):
+        shards += sorted(name[:-3] for name in os.listdir(DB_SHARD_DIR) if name.endswith('.db'))
+    return shards
+
+
+# =============================================================================
+# SCHEMA MIGRATIONS
+# =============================================================================
+# Ordered list of (version, description, step). Each step runs once, inside
+# its own transaction, and is recorded in schema_version. Steps must stay
+# idempotent: databases created before schema_version existed replay them all.
+
+def _has_column(conn, table, column):
+    return any(row[1] == column for row in conn.execute(f'PRAGMA table_info({table})'))
+
+
+def _add_column(conn, table, column, decl):
+    if not _has_column(conn, table, column):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+        print(f"[DB] Added column {table}.{column}", flush=True)
+
+
+def _m001_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            display_name TEXT,
+            is_admin INTEGER DEFAULT 0,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS maps (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            data TEXT,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS folders (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+    # Map versions table (history)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS map_versions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            map_id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def _m002_ownership_columns(conn):
+    _add_column(conn, 'maps', 'folder_id', 'TEXT')
+    _add_column(conn, 'maps', 'trashed', 'INTEGER DEFAULT 0')
+    _add_column(conn, 'maps', 'user_id', 'TEXT')
+    _add_column(conn, 'folders', 'user_id', 'TEXT')
+    _add_column(conn, 'maps', 'share_token', 'TEXT')
+    _add_column(conn, 'users', 'api_key', 'TEXT')
+
+
+def _m003_hot_query_indexes(conn):
+    # Map listings: covering indexes so the list endpoint never touches the data column
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_maps_user_updated
+        ON maps (user_id, updated_at, trashed, folder_id, id, title)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_maps_user_folder
+        ON maps (user_id, folder_id, updated_at, trashed, id, title)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_maps_share_token
+        ON maps (share_token) WHERE share_token IS NOT NULL
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_map_versions_map_created
+        ON map_versions (map_id, created_at)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_api_key
+        ON users (api_key) WHERE api_key IS NOT NULL
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_folders_user_name
+        ON folders (user_id, name)
+    ''')
+
+
+def _m004_delta_version_history(conn):
+    if _has_column(conn, 'map_versions', 'base_id'):
+        return
+    _add_column(conn, 'map_versions', 'base_id', 'INTEGER')
+    for row in conn.execute('SELECT DISTINCT map_id FROM map_versions').fetchall():
+        _encode_version_history(conn, row['map_id'])
+
+
+def _m005_version_content_hash(conn):
+    _add_column(conn, 'map_versions', 'content_hash', 'TEXT')
+
+
+def _m006_blobs(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            mime TEXT NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def _m007_map_revision(conn):
+    _add_column(conn, 'maps', 'revision', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def _m008_normalize_map_data(conn):
+    rewritten = normalize_map_data(conn)
+    if rewritten:
+        print(f"[DB] Normalized {rewritten} double-encoded map(s)", flush=True)
+    _m015_normalize_version_data(conn)
+
+
+def _m009_jobs(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            name TEXT PRIMARY KEY,
+            running INTEGER NOT NULL DEFAULT 0,
+            started_at INTEGER,
+            finished_at INTEGER,
+            result TEXT
+        )
+    ''')
+
+
+def _m010_map_index(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS map_index (
+            map_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            share_token TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_map_index_share_token
+        ON map_index (share_token) WHERE share_token IS NOT NULL
+    ''')
+
+
+def _m011_search_index(conn):
+    # Filled by save, PATCH and inject; existing maps by rebuild_search_index()
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index
+        USING fts5(title, text, body, tags, tokenize = 'unicode61 remove_diacritics 2')
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_docs (
+            rowid INTEGER PRIMARY KEY,
+            map_id TEXT NOT NULL,
+            node_id TEXT NOT NULL,
+            user_id TEXT,
+            digest TEXT NOT NULL,
+            UNIQUE (map_id, node_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_search_docs_user ON search_docs (user_id)')
+
+
+# Denormalized counters, kept by triggers so every write path (saves, inject,
+# trash, moves, deletes, migrate_to_shards) updates them: folders.map_count
+# counts the folder owner's live maps in it, user_stats the live maps and the
+# stored bytes of all maps of each user. check_counters() repairs drift.
+# With DB_SHARD_DIR, the catalog's user_stats holds copies of each user
+# file's row (see flush_user_stats), not counts of its own maps table.
+_LIVE_NEW = 'COALESCE(NEW.trashed, 0) = 0'
+_LIVE_OLD = 'COALESCE(OLD.trashed, 0) = 0'
+_BYTES_NEW = 'COALESCE(length(CAST(NEW.data AS BLOB)), 0)'
+_BYTES_OLD = 'COALESCE(length(CAST(OLD.data AS BLOB)), 0)'
+COUNTER_TRIGGERS = {
+    'maps_counters_insert': f'''
+        AFTER INSERT ON maps BEGIN
+            UPDATE folders SET map_count = map_count + 1
+            WHERE id = NEW.folder_id AND user_id = NEW.user_id AND {_LIVE_NEW};
+            INSERT INTO user_stats (user_id, map_count, map_bytes)
+            SELECT NEW.user_id, {_LIVE_NEW}, {_BYTES_NEW} WHERE NEW.user_id IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET map_count = map_count + excluded.map_count,
+                                               map_bytes = map_bytes + excluded.map_bytes;
+        END''',
+    'maps_counters_delete': f'''
+        AFTER DELETE ON maps BEGIN
+            UPDATE folders SET map_count = map_count - 1
+            WHERE id = OLD.folder_id AND user_id = OLD.user_id AND {_LIVE_OLD};
+            UPDATE user_stats SET map_count = map_count - ({_LIVE_OLD}),
+                                  map_bytes = map_bytes - {_BYTES_OLD}
+            WHERE user_id = OLD.user_id;
+        END''',
+    'maps_counters_update': f'''
+        AFTER UPDATE OF user_id, folder_id, trashed ON maps
+        WHEN OLD.user_id IS NOT NEW.user_id OR OLD.folder_id IS NOT NEW.folder_id
+             OR {_LIVE_OLD} != {_LIVE_NEW}
+        BEGIN
+            UPDATE folders SET map_count = map_count - 1
+            WHERE id = OLD.folder_id AND user_id = OLD.user_id AND {_LIVE_OLD};
+            UPDATE folders SET map_count = map_count + 1
+            WHERE id = NEW.folder_id AND user_id = NEW.user_id AND {_LIVE_NEW};
+            UPDATE user_stats SET map_count = map_count - ({_LIVE_OLD}) WHERE user_id = OLD.user_id;
+            INSERT INTO user_stats (user_id, map_count, map_bytes)
+            SELECT NEW.user_id, {_LIVE_NEW}, 0 WHERE NEW.user_id IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET map_count = map_count + excluded.map_count;
+        END''',
+    'maps_bytes_update': f'''
+        AFTER UPDATE OF data, user_id ON maps BEGIN
+            UPDATE user_stats SET map_bytes = map_bytes - {_BYTES_OLD} WHERE user_id = OLD.user_id;
+            INSERT INTO user_stats (user_id, map_count, map_bytes)
+            SELECT NEW.user_id, 0, {_BYTES_NEW} WHERE NEW.user_id IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET map_bytes = map_bytes + excluded.map_bytes;
+        END''',
+}
+
+
+def _m012_counters(conn):
+    _add_column(conn, 'folders', 'map_count', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id TEXT PRIMARY KEY,
+            map_count INTEGER NOT NULL DEFAULT 0,
+            map_bytes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for name, body in COUNTER_TRIGGERS.items():
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+    check_counters(conn)
+
+
+def check_counters(conn, users=True):
+    """Recompute folders.map_count and user_stats from the maps table with two
+    aggregate queries, and rewrite the rows that drifted. users=False leaves
+    user_stats alone (the catalog's copies with DB_SHARD_DIR).
+
+    Runs inside the caller's transaction. Returns the number of rows fixed.
+    """
+    fixed = {'folders': 0, 'users': 0}
+    live = {(row[0], row[1]): row[2] for row in conn.execute(
+        'SELECT folder_id, user_id, COUNT(*) FROM maps '
+        'WHERE folder_id IS NOT NULL AND COALESCE(trashed, 0) = 0 GROUP BY folder_id, user_id'
+    )}
+    for folder_id, user_id, stored in conn.execute('SELECT id, user_id, map_count FROM folders').fetchall():
+        count = live.get((folder_id, user_id), 0)
+        if stored != count:
+            conn.execute('UPDATE folders SET map_count = ? WHERE id = ?', (count, folder_id))
+            fixed['folders'] += 1
+    if not users:
+        return fixed
+    actual = {row[0]: (row[1], row[2]) for row in conn.execute(
+        'SELECT user_id, SUM(COALESCE(trashed, 0) = 0), COALESCE(SUM(length(CAST(data AS BLOB))), 0) '
+        'FROM maps WHERE user_id IS NOT NULL GROUP BY user_id'
+    )}
+    stored = {row[0]: (row[1], row[2]) for row in conn.execute('SELECT user_id, map_count, map_bytes FROM user_stats')}
+    for user_id in actual.keys() | stored.keys():
+        expected = actual.get(user_id, (0, 0))
+        if stored.get(user_id) != expected:
+            conn.execute('INSERT OR REPLACE INTO user_stats (user_id, map_count, map_bytes) VALUES (?, ?, ?)',
+                         (user_id, *expected))
+            fixed['users'] += 1
+    return fixed
+
+
+def _m013_keyset_indexes(conn):
+    # Listings page on (updated_at, id): index both so a page is a range scan
+    # with no sort, and give the trash its own partial index
+    conn.execute('DROP INDEX IF EXISTS idx_maps_user_updated')
+    conn.execute('DROP INDEX IF EXISTS idx_maps_user_folder')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_maps_user_keyset
+        ON maps (user_id, updated_at, id, trashed, folder_id, title)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_maps_user_folder_keyset
+        ON maps (user_id, folder_id, updated_at, id, trashed, title)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_maps_user_trash
+        ON maps (user_id, updated_at, id, folder_id, title) WHERE trashed = 1
+    ''')
+
+
+def _m014_api_keys(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            prefix TEXT NOT NULL UNIQUE,
+            key_hash TEXT NOT NULL,
+            created_at INTEGER,
+            last_used_at INTEGER
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_api_keys_user ON api_keys (user_id, created_at)')
+    # Existing plaintext keys keep working: same prefix/hash scheme as new ones
+    for user_id, api_key, updated_at in conn.execute(
+        'SELECT id, api_key, updated_at FROM users WHERE api_key IS NOT NULL'
+    ).fetchall():
+        conn.execute(
+            'INSERT OR IGNORE INTO api_keys (id, user_id, name, prefix, key_hash, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (f'key-{uuid.uuid4().hex[:12]}', user_id, 'default', _api_key_prefix(api_key), _api_key_hash(api_key), updated_at)
+        )
+    conn.execute('UPDATE users SET api_key = NULL WHERE api_key IS NOT NULL')
+    conn.execute('DROP INDEX IF EXISTS idx_users_api_key')
+
+
+def _m015_normalize_version_data(conn):
+    # Databases migrated to version 8 before it covered map_versions
+    rewritten = normalize_version_data(conn)
+    if rewritten:
+        print(f"[DB] Normalized the history of {rewritten} double-encoded map(s)", flush=True)
+
+
+MIGRATIONS = [
+    (1, 'base tables', _m001_base_tables),
+    (2, 'folder, trash, ownership, share and API key columns', _m002_ownership_columns),
+    (3, 'indexes for map listing, history, share tokens and API keys', _m003_hot_query_indexes),
+    (4, 'delta-encoded map history', _m004_delta_version_history),
+    (5, 'content hash on map versions', _m005_version_content_hash),
+    (6, 'content-addressed image blobs', _m006_blobs),
+    (7, 'map revision counter for optimistic concurrency', _m007_map_revision),
+    (8, 'single-encoded map data', _m008_normalize_map_data),
+    (9, 'background job claims shared by all workers', _m009_jobs),
+    (10, 'catalog of map owners for per-user databases', _m010_map_index),
+    (11, 'full-text search index', _m011_search_index),
+    (12, 'map counters per folder and per user', _m012_counters),
+    (13, 'keyset pagination indexes for map listings', _m013_keyset_indexes),
+    (14, 'hashed API keys, several per user', _m014_api_keys),
+    (15, 'single-encoded map history', _m015_normalize_version_data),
+]
+
+
+def get_schema_version(conn):
+    """Highest migration version applied to this database (0 if none)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at INTEGER
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """Apply pending migrations in order. Returns the resulting schema version."""
+    current = get_schema_version(conn)
+    conn.commit()
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-check under the write lock: another worker may have got here first
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute(
+                'INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                (version, description, int(time.time() * 1000))
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"[DB] Migrated to schema version {version}: {description}", flush=True)
+        current = version
+    return current
+
+
+def init_db():
+    """Initialize database schema."""
+    print(f"[DB] Initializing database at {DB_PATH}", flush=True)
+    try:
+        conn = get_db()
+        migrate(conn)
 
         # Create or update admin user from env
         cursor = conn.execute('SELECT id, password_hash FROM users WHERE username = ?', (ADMIN_USERNAME,))
@@ -145,17 +1488,281 @@ def init_db():
 
         conn.commit()
         conn.close()
+        invalidate_auth_cache()  # workers still running the previous deploy may cache the old admin password
+        if DB_SHARD_DIR:
+            print(f"[DB] Per-user databases in {DB_SHARD_DIR}", flush=True)
         print(f"[DB] Database initialized successfully", flush=True)
     except Exception as e:
         print(f"[DB] ERROR initializing database: {e}", flush=True)
         sys.exit(1)
 
 
+# =============================================================================
+# PER-USER DATABASES
+# =============================================================================
+# Moving to DB_SHARD_DIR: set it, then run `python server/app.py migrate-shards`
+# once with the server stopped. Each user's rows are copied into their file in
+# one transaction, then deleted from DB_PATH in another, so an interrupted run
+# can simply be started again. Run POST /api/admin/vacuum afterwards to shrink
+# DB_PATH.
+
+def _copy_rows(conn, table, src, dst, where='', params=(), verb='INSERT OR IGNORE', exprs=None):
+    """Copy table rows between two attached databases, by column name.
+
+    exprs maps a column to the SQL expression to select for it. Returns the
+    number of rows copied.
+    """
+    src_columns = {row[1] for row in conn.execute(f'PRAGMA {src}.table_info({table})')}
+    columns = [row[1] for row in conn.execute(f'PRAGMA {dst}.table_info({table})') if row[1] in src_columns]
+    selected = ', '.join((exprs or {}).get(column, column) for column in columns)
+    return conn.execute(
+        f'{verb} INTO {dst}.{table} ({", ".join(columns)}) SELECT {selected} FROM {src}.{table} {where}', params
+    ).rowcount
+
+
+def migrate_to_shards():
+    """Move every user's maps, folders and history from DB_PATH into their own
+    database in DB_SHARD_DIR. Returns counts of what was moved."""
+    if not DB_SHARD_DIR:
+        raise RuntimeError('DB_SHARD_DIR is not set')
+    stats = {'users': 0, 'maps': 0, 'folders': 0, 'versions': 0}
+    conn = get_db()
+    owners = [row[0] for row in conn.execute(
+        'SELECT user_id FROM maps WHERE user_id IS NOT NULL UNION SELECT user_id FROM folders WHERE user_id IS NOT NULL'
+    )]
+    conn.close()
+    for user_id in owners:
+        path = _shard_path(user_id)
+        get_db(user_id).close()  # creates and migrates the file
+        conn = _connect(path)
+        try:
+            conn.execute('ATTACH DATABASE ? AS catalog', (os.path.abspath(DB_PATH),))
+            with _path_write_lock(path), _write_lock:
+                conn.execute('BEGIN IMMEDIATE')
+                # Rows already in the user's file are newer: keep them, and
+                # shift copied version ids past the file's own
+                offset = conn.execute('SELECT COALESCE(MAX(id), 0) FROM main.map_versions').fetchone()[0]
+                owned = 'WHERE user_id = ?'
+                # Folders first, so the insert triggers count their maps
+                stats['folders'] += _copy_rows(conn, 'folders', 'catalog', 'main', owned, (user_id,),
+                                               exprs={'map_count': '0'})
+                stats['maps'] += _copy_rows(conn, 'maps', 'catalog', 'main', owned, (user_id,))
+                stats['versions'] += _copy_rows(
+                    conn, 'map_versions', 'catalog', 'main',
+                    'WHERE map_id IN (SELECT id FROM catalog.maps WHERE user_id = ?)', (user_id,),
+                    exprs={'id': f'id + {offset}', 'base_id': f'base_id + {offset}'}
+                )
+                conn.commit()
+                # Separate transaction: under WAL a commit is only atomic per file
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute(
+                    'INSERT OR REPLACE INTO catalog.map_index (map_id, user_id, share_token) '
+                    'SELECT id, user_id, share_token FROM main.maps WHERE user_id = ?', (user_id,)
+                )
+                conn.execute(
+                    'DELETE FROM catalog.map_versions WHERE map_id IN (SELECT id FROM catalog.maps WHERE user_id = ?)',
+                    (user_id,)
+                )
+                conn.execute('DELETE FROM catalog.maps WHERE user_id = ?', (user_id,))
+                conn.execute('DELETE FROM catalog.folders WHERE user_id = ?', (user_id,))
+                conn.execute('DELETE FROM catalog.search_index WHERE rowid IN '
+                             '(SELECT rowid FROM catalog.search_docs WHERE user_id = ?)', (user_id,))
+                conn.execute('DELETE FROM catalog.search_docs WHERE user_id = ?', (user_id,))
+                # The catalog keeps a copy of the counters for the admin user list
+                conn.execute('INSERT OR REPLACE INTO catalog.user_stats (user_id, map_count, map_bytes) '
+                             'SELECT user_id, map_count, map_bytes FROM main.user_stats WHERE user_id = ?', (user_id,))
+                conn.commit()
+        finally:
+            conn.close()
+        stats['users'] += 1
+        print(f"[SHARDS] Moved data of {user_id} to {path}", flush=True)
+    if stats['users']:
+        stats['search'] = rebuild_search_index()  # index rows stay behind: rebuild them in the user files
+    return stats
+
+
+def _merge_shards_into(backup_path):
+    """Copy every user's maps and folders into a copy of DB_PATH, giving a
+    single-file database (without history) that restores anywhere."""
+    conn = sqlite3.connect(backup_path)
+    try:
+        for shard in _data_shards()[1:]:
+            conn.execute('ATTACH DATABASE ? AS shard', (os.path.abspath(_shard_path(shard)),))
+            try:
+                for table in ('maps', 'folders'):
+                    _copy_rows(conn, table, 'shard', 'main', verb='INSERT OR REPLACE')
+                conn.commit()
+            finally:
+                conn.execute('DETACH DATABASE shard')
+        check_counters(conn)  # REPLACE skips the delete triggers
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# =============================================================================
+# API KEYS
+# =============================================================================
+# A key is shown once, at creation. The server keeps its first
+# API_KEY_PREFIX_LEN characters (unique, indexed, safe to display) and a
+# SHA-256 of the whole key: lookup is one index probe plus one hash
+# comparison. Keys are 256 random bits, so a fast hash is enough.
+#
+# last_used_at is buffered in memory and written for all keys at once, at
+# most every API_KEY_TOUCH_SECONDS per worker, instead of on every call.
+
+API_KEY_PREFIX_LEN = 12  # 'mk_' + 9 random characters
+API_KEY_TOUCH_SECONDS = float(os.environ.get('API_KEY_TOUCH_SECONDS', 60))
+_api_key_uses = {}  # key id -> last use (ms)
+_api_key_uses_lock = threading.Lock()
+_api_key_flushed_at = time.monotonic()
+
+
+def _api_key_prefix(api_key):
+    return api_key[:API_KEY_PREFIX_LEN]
+
+
+def _api_key_hash(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def create_api_key(conn, user_id, name):
+    """Insert a new key for user_id in conn's transaction. Returns (id, key)."""
+    for _ in range(5):
+        api_key = f'mk_{secrets.token_urlsafe(32)}'
+        key_id = f'key-{uuid.uuid4().hex[:12]}'
+        try:
+            conn.execute(
+                'INSERT INTO api_keys (id, user_id, name, prefix, key_hash, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (key_id, user_id, name, _api_key_prefix(api_key), _api_key_hash(api_key), int(time.time() * 1000))
+            )
+            return key_id, api_key
+        except sqlite3.IntegrityError:
+            continue  # prefix already taken
+    raise RuntimeError('Could not generate a unique API key prefix')
+
+
+def _note_api_key_use(key_id):
+    global _api_key_flushed_at
+    with _api_key_uses_lock:
+        _api_key_uses[key_id] = int(time.time() * 1000)
+        due = time.monotonic() - _api_key_flushed_at >= API_KEY_TOUCH_SECONDS
+        if due:
+            _api_key_flushed_at = time.monotonic()
+    if due:
+        flush_api_key_uses()
+
+
+def flush_api_key_uses():
+    """Write the buffered last_used_at timestamps in one transaction."""
+    with _api_key_uses_lock:
+        uses = list(_api_key_uses.items())
+        _api_key_uses.clear()
+    if not uses:
+        return
+    try:
+        conn = get_write_db()
+        try:
+            conn.executemany(
+                'UPDATE api_keys SET last_used_at = MAX(COALESCE(last_used_at, 0), ?) WHERE id = ?',
+                [(used_at, key_id) for key_id, used_at in uses]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[API KEYS] Could not record key use: {e}", flush=True)
+
+
+def _api_key_summary(row):
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'preview': row['prefix'] + '…',
+        'createdAt': row['created_at'],
+        'lastUsedAt': row['last_used_at'],
+    }
+
+
+# =============================================================================
+# AUTH CACHE
+# =============================================================================
+# Verified credentials (session user id, Basic Auth pair, API key) are kept
+# for AUTH_CACHE_TTL seconds so a request doesn't re-read the users table or
+# re-run the password KDF. Entries are keyed by an HMAC of the credential
+# with a per-process key, so no password or API key is held in memory.
+# Failed lookups are never cached.
+#
+# Changing a user bumps the mtime of a stamp file next to DB_PATH, after the
+# commit; every worker stats it on each lookup and ignores entries stored
+# under an older stamp, so a revoked key stops working everywhere at once.
+
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 60))  # 0 disables the cache
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 1024))
+_AUTH_CACHE_KEY = secrets.token_bytes(32)
+_auth_cache = OrderedDict()  # digest -> (expires, stamp, user dict)
+_auth_cache_lock = threading.Lock()
+
+
+def _auth_stamp_path():
+    return DB_PATH + '-auth'
+
+
+def _auth_stamp():
+    try:
+        return os.stat(_auth_stamp_path()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def invalidate_auth_cache():
+    """Drop every cached credential, in this worker and the others."""
+    path = _auth_stamp_path()
+    with open(path, 'a'):
+        pass
+    # Strictly later than the current stamp, even within one clock tick
+    stamp = max(time.time_ns(), os.stat(path).st_mtime_ns + 1)
+    os.utime(path, ns=(stamp, stamp))
+    with _auth_cache_lock:
+        _auth_cache.clear()
+
+
+def _auth_cache_digest(kind, *parts):
+    message = '\x00'.join((kind,) + parts).encode('utf-8')
+    return hmac.new(_AUTH_CACHE_KEY, message, hashlib.sha256).digest()
+
+
+def _cached_auth(digest, lookup):
+    """User dict for a credential: from the cache, or lookup() (None when
+    the credential is invalid). Returns a copy the caller may modify."""
+    if AUTH_CACHE_TTL <= 0:
+        return lookup()
+    stamp = _auth_stamp()
+    now = time.monotonic()
+    with _auth_cache_lock:
+        entry = _auth_cache.get(digest)
+        if entry and entry[0] > now and entry[1] == stamp:
+            _auth_cache.move_to_end(digest)
+            return dict(entry[2])
+    user = lookup()  # stamp was read first: a change committed meanwhile invalidates this entry
+    if user is not None:
+        with _auth_cache_lock:
+            _auth_cache[digest] = (now + AUTH_CACHE_TTL, stamp, dict(user))
+            _auth_cache.move_to_end(digest)
+            while len(_auth_cache) > AUTH_CACHE_SIZE:
+                _auth_cache.popitem(last=False)
+    return user
+
+
 def get_current_user():
     """Get the current logged-in user from session."""
     user_id = session.get('user_id')
     if not user_id:
         return None
+    return _cached_auth(_auth_cache_digest('session', user_id), lambda: _load_session_user(user_id))
+
+
+def _load_session_user(user_id):
     conn = get_db()
     cursor = conn.execute('SELECT id, username, display_name, is_admin FROM users WHERE id = ?', (user_id,))
     user = cursor.fetchone()
@@ -169,9 +1776,10 @@ def requires_login(f):
     """Decorator requiring session-based login (with Basic Auth fallback for API routes)."""
     @wraps(f)
     def decorated(*args, **kwargs):
-        user = get_current_user()
-        if not user and request.path.startswith('/api/'):
-            user = _try_api_auth()
+        with timing_span('auth'):
+            user = get_current_user()
+            if not user and request.path.startswith('/api/'):
+                user = _try_api_auth()
         if not user:
             if request.path.startswith('/api/'):
                 return jsonify({'error': 'Non authentifié'}), 401
@@ -186,28 +1794,41 @@ def _try_api_auth():
     # 1. Try API key
     api_key = request.headers.get('X-API-Key')
     if api_key:
-        conn = get_db()
-        row = conn.execute(
-            'SELECT id, username, display_name, password_hash, is_admin FROM users WHERE api_key = ?',
-            (api_key,)
-        ).fetchone()
-        conn.close()
-        if row:
-            user_dict = dict(row)
-            user_dict.pop('password_hash', None)
-            return user_dict
-        return None
+        user = _cached_auth(_auth_cache_digest('api_key', api_key), lambda: _load_api_key_user(api_key))
+        if user:
+            _note_api_key_use(user.pop('api_key_id'))
+        return user
     # 2. Fallback to Basic Auth
     auth = request.authorization
     if not auth or not auth.username or not auth.password:
         return None
+    return _cached_auth(_auth_cache_digest('basic', auth.username, auth.password),
+                        lambda: _load_basic_auth_user(auth.username, auth.password))
+
+
+def _load_api_key_user(api_key):
+    conn = get_db()
+    row = conn.execute(
+        'SELECT k.id AS api_key_id, k.key_hash, u.id, u.username, u.display_name, u.is_admin '
+        'FROM api_keys k JOIN users u ON u.id = k.user_id WHERE k.prefix = ?',
+        (_api_key_prefix(api_key),)
+    ).fetchone()
+    conn.close()
+    if row and hmac.compare_digest(row['key_hash'], _api_key_hash(api_key)):
+        user_dict = dict(row)
+        user_dict.pop('key_hash')
+        return user_dict
+    return None
+
+
+def _load_basic_auth_user(username, password):
     conn = get_db()
     row = conn.execute(
         'SELECT id, username, display_name, password_hash, is_admin FROM users WHERE username = ?',
-        (auth.username,)
+        (username,)
     ).fetchone()
     conn.close()
-    if not row or not check_password_hash(row['password_hash'], auth.password):
+    if not row or not check_password_hash(row['password_hash'], password):
         return None
     user_dict = dict(row)
     user_dict.pop('password_hash', None)
@@ -218,9 +1839,10 @@ def requires_api_auth(f):
     """Decorator accepting session-based login OR HTTP Basic Auth."""
     @wraps(f)
     def decorated(*args, **kwargs):
-        user = get_current_user()
-        if not user:
-            user = _try_api_auth()
+        with timing_span('auth'):
+            user = get_current_user()
+            if not user:
+                user = _try_api_auth()
         if not user:
             return jsonify({'error': 'Non authentifié'}), 401
         request.current_user = user
@@ -232,9 +1854,10 @@ def requires_admin(f):
     """Decorator requiring admin privileges (with Basic Auth/API key fallback for API routes)."""
     @wraps(f)
     def decorated(*args, **kwargs):
-        user = get_current_user()
-        if not user and request.path.startswith('/api/'):
-            user = _try_api_auth()
+        with timing_span('auth'):
+            user = get_current_user()
+            if not user and request.path.startswith('/api/'):
+                user = _try_api_auth()
         if not user:
             if request.path.startswith('/api/'):
                 return jsonify({'error': 'Non authentifié'}), 401
@@ -325,9 +1948,15 @@ def admin_page():
 @app.route('/api/admin/backup', methods=['GET'])
 @requires_admin
 def backup_db():
-    """Download the SQLite database file."""
-    import tempfile
-    db_path = os.path.abspath(DB_PATH)
+    """Download the SQLite database file.
+
+    With per-user databases, the maps and folders of every user are merged
+    into the copy (history stays in the user files, see export_user_db).
+    """
+    return _send_database_copy(os.path.abspath(DB_PATH), 'mindmap-backup', merge_shards=bool(DB_SHARD_DIR))
+
+
+def _send_database_copy(db_path, name, merge_shards=False):
     # Copy to temp file to avoid locking issues
     tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
     tmp.close()
@@ -336,6 +1965,8 @@ def backup_db():
     src_conn.backup(dst_conn)
     src_conn.close()
     dst_conn.close()
+    if merge_shards:
+        _merge_shards_into(tmp.name)
     from flask import send_file
     timestamp = time.strftime('%Y%m%d-%H%M%S')
     tmp_path = tmp.name
@@ -343,7 +1974,7 @@ def backup_db():
         tmp_path,
         mimetype='application/x-sqlite3',
         as_attachment=True,
-        download_name=f'mindmap-backup-{timestamp}.db'
+        download_name=f'{name}-{timestamp}.db'
     )
     @after_this_request
     def cleanup(response):
@@ -357,14 +1988,22 @@ def backup_db():
 
 @app.route('/api/admin/vacuum', methods=['POST'])
 @requires_admin
+@timed_job('vacuum')
 def vacuum_db():
     """Compact the live SQLite database in place (reclaims space from deleted rows)."""
     try:
-        size_before = os.path.getsize(DB_PATH)
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute('VACUUM')
-        conn.close()
-        size_after = os.path.getsize(DB_PATH)
+        size_before = size_after = 0
+        # One file at a time: with per-user databases the others stay writable
+        for path in map(_shard_path, _data_shards()):
+            size_before += os.path.getsize(path)
+            conn = _connect(path)
+            try:
+                # VACUUM blocks every writer anyway: queue this process's behind it
+                with _path_write_lock(path):
+                    conn.execute('VACUUM')
+            finally:
+                conn.close()
+            size_after += os.path.getsize(path)
         return jsonify({
             'success': True,
             'size_before': size_before,
@@ -376,6 +2015,228 @@ def vacuum_db():
         return jsonify({'error': 'Erreur lors du VACUUM'}), 500
 
 
+# Background jobs are claimed in the jobs table, not in process memory, so
+# that with several workers only one runs a job and any worker can report it.
+JOB_STALE_MS = 6 * 3600 * 1000  # a claim older than this belongs to a dead worker
+
+
+def _claim_job(name, min_interval_ms=0):
+    """Mark job `name` as running here. False if it is already running, or
+    last started less than min_interval_ms ago."""
+    now = int(time.time() * 1000)
+    conn = get_write_db()
+    try:
+        row = conn.execute('SELECT running, started_at FROM jobs WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            if row['running'] and now - row['started_at'] < JOB_STALE_MS:
+                return False
+            if not row['running'] and now - row['started_at'] < min_interval_ms:
+                return False
+        conn.execute(
+            'INSERT INTO jobs (name, running, started_at, finished_at, result) VALUES (?, 1, ?, NULL, NULL) '
+            'ON CONFLICT(name) DO UPDATE SET running = 1, started_at = excluded.started_at, finished_at = NULL, result = NULL',
+            (name, now)
+        )
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+
+def _finish_job(name, result):
+    conn = get_write_db()
+    try:
+        conn.execute(
+            'UPDATE jobs SET running = 0, finished_at = ?, result = ? WHERE name = ?',
+            (int(time.time() * 1000), json.dumps(result), name)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _job_state(name):
+    conn = get_db()
+    row = conn.execute('SELECT running, started_at, result FROM jobs WHERE name = ?', (name,)).fetchone()
+    conn.close()
+    if row is None:
+        return {'running': False, 'started_at': None, 'result': None}
+    return {
+        'running': bool(row['running']),
+        'started_at': row['started_at'],
+        'result': json.loads(row['result']) if row['result'] else None,
+    }
+
+
+@app.route('/api/admin/reencode', methods=['POST'])
+@requires_admin
+def start_reencode():
+    """Re-encode every stored map and version with the current codec, in the background."""
+    if not _claim_job('reencode'):
+        return jsonify({'error': 'Ré-encodage déjà en cours'}), 409
+    threading.Thread(target=_run_reencode, daemon=True).start()
+    return jsonify({'started': True, 'codec': MAP_DATA_CODEC}), 202
+
+
+@app.route('/api/admin/reencode', methods=['GET'])
+@requires_admin
+def reencode_status():
+    """Progress of the background re-encode job."""
+    return jsonify(_job_state('reencode'))
+
+
+def _run_reencode():
+    result = None
+    try:
+        result = reencode_map_data()
+        print(f'[REENCODE] Done: {result}', flush=True)
+    except Exception as e:
+        print(f'[REENCODE] Error: {e}', flush=True)
+        result = {'error': str(e)}
+    finally:
+        _finish_job('reencode', result)
+
+
+@app.route('/api/admin/counters/check', methods=['POST'])
+@requires_admin
+def start_counters_check():
+    """Recount maps per folder and per user and repair the stored counters, in the background."""
+    if not _claim_job('counters_check'):
+        return jsonify({'error': 'Vérification déjà en cours'}), 409
+    threading.Thread(target=_run_counters_check, daemon=True).start()
+    return jsonify({'started': True}), 202
+
+
+@app.route('/api/admin/counters/check', methods=['GET'])
+@requires_admin
+def counters_check_status():
+    """Progress of the background counter check."""
+    return jsonify(_job_state('counters_check'))
+
+
+def _run_counters_check():
+    result = None
+    try:
+        result = check_all_counters()
+        print(f'[COUNTERS] Done: {result}', flush=True)
+    except Exception as e:
+        print(f'[COUNTERS] Error: {e}', flush=True)
+        result = {'error': str(e)}
+    finally:
+        _finish_job('counters_check', result)
+
+
+@timed_job('counters_check')
+def check_all_counters():
+    """check_counters() on every database file, one write transaction each,
+    then refresh the catalog's copies of the users' counters."""
+    stats = {'files': 0, 'folders': 0, 'users': 0}
+    for shard in _data_shards():
+        conn = get_write_db(shard)
+        try:
+            fixed = check_counters(conn, users=not (DB_SHARD_DIR and shard is None))
+            conn.commit()
+        finally:
+            conn.close()
+        stats['files'] += 1
+        for key in fixed:
+            stats[key] += fixed[key]
+    flush_user_stats()
+    return stats
+
+
+@app.route('/api/admin/search/rebuild', methods=['POST'])
+@requires_admin
+def start_search_rebuild():
+    """Rebuild the full-text search index of every map, in the background."""
+    if not _claim_job('search_rebuild'):
+        return jsonify({'error': 'Reconstruction déjà en cours'}), 409
+    threading.Thread(target=_run_search_rebuild, daemon=True).start()
+    return jsonify({'started': True}), 202
+
+
+@app.route('/api/admin/search/rebuild', methods=['GET'])
+@requires_admin
+def search_rebuild_status():
+    """Progress of the background search index rebuild."""
+    return jsonify(_job_state('search_rebuild'))
+
+
+def _run_search_rebuild():
+    result = None
+    try:
+        result = rebuild_search_index()
+        print(f'[SEARCH] Rebuilt: {result}', flush=True)
+    except Exception as e:
+        print(f'[SEARCH] Error: {e}', flush=True)
+        result = {'error': str(e)}
+    finally:
+        _finish_job('search_rebuild', result)
+
+
+@app.route('/api/admin/blobs/gc', methods=['POST'])
+@requires_admin
+def blob_gc():
+    """Delete image blobs no longer referenced by any map or version."""
+    removed = collect_blob_garbage()
+    return jsonify({'success': True, 'removed': removed})
+
+
+@app.route('/api/admin/slow-queries', methods=['GET'])
+@requires_admin
+def slow_queries():
+    """This worker's slow-query log, newest first."""
+    with _slow_query_lock:
+        queries = list(_slow_queries)[::-1]
+    return jsonify({'thresholdMs': SLOW_QUERY_MS, 'worker': os.getpid(), 'queries': queries})
+
+
+@app.route('/api/admin/slow-queries', methods=['DELETE'])
+@requires_admin
+def clear_slow_queries():
+    with _slow_query_lock:
+        _slow_queries.clear()
+    return jsonify({'success': True})
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@requires_admin
+def list_profiles():
+    """Request profiles saved with X-Profile: 1, newest first."""
+    return jsonify(_list_profiles())
+
+
+@app.route('/api/admin/profiles/<name>', methods=['GET'])
+@requires_admin
+def get_profile(name):
+    """Download a profile (.pstats, for snakeviz or pstats), or ?format=text
+    for the top functions by cumulative time."""
+    if not PROFILE_NAME_RE.match(name) or not os.path.exists(os.path.join(PROFILE_DIR, name)):
+        return jsonify({'error': 'Profil introuvable'}), 404
+    path = os.path.join(PROFILE_DIR, name)
+    if request.args.get('format') == 'text':
+        sort = request.args.get('sort')
+        if sort not in ('cumulative', 'tottime', 'ncalls'):
+            sort = 'cumulative'
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats(sort).print_stats(60)
+        return Response(out.getvalue(), mimetype='text/plain')
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True,
+                               mimetype='application/octet-stream')
+
+
+@app.route('/api/admin/profiles/<name>', methods=['DELETE'])
+@requires_admin
+def delete_profile(name):
+    if not PROFILE_NAME_RE.match(name):
+        return jsonify({'error': 'Profil introuvable'}), 404
+    try:
+        os.unlink(os.path.join(PROFILE_DIR, name))
+    except FileNotFoundError:
+        return jsonify({'error': 'Profil introuvable'}), 404
+    return jsonify({'success': True})
+
+
 def _strip_versions_from_backup(backup_path):
     """Remove map_versions history from a backup copy and compact it.
     Local DB keeps history; only uploaded backup is slimmed."""
@@ -391,10 +2252,10 @@ def _strip_versions_from_backup(backup_path):
 
 @app.route('/api/admin/backup', methods=['POST'])
 @requires_admin
+@timed_job('r2_backup')
 def backup_to_r2():
     """Upload SQLite backup to Cloudflare R2."""
     import shutil
-    import tempfile
     try:
         import boto3
         from botocore.config import Config
@@ -430,6 +2291,8 @@ def backup_to_r2():
             import shutil
             shutil.copy2(db_path, tmp.name)
 
+        if DB_SHARD_DIR:
+            _merge_shards_into(tmp.name)
         _strip_versions_from_backup(tmp.name)
 
         # Upload to R2
@@ -468,19 +2331,31 @@ def backup_to_r2():
 def list_users():
     """List all users."""
     conn = get_db()
-    cursor = conn.execute('SELECT id, username, display_name, is_admin, api_key, created_at FROM users ORDER BY created_at')
+    cursor = conn.execute('''
+        SELECT u.id, u.username, u.display_name, u.is_admin, u.created_at,
+               COALESCE(s.map_count, 0) AS map_count, COALESCE(s.map_bytes, 0) AS map_bytes
+        FROM users u LEFT JOIN user_stats s ON s.user_id = u.id
+        ORDER BY u.created_at
+    ''')
+    rows = cursor.fetchall()
+    flush_api_key_uses()
+    keys = {}
+    for key in conn.execute('SELECT id, user_id, name, prefix, created_at, last_used_at FROM api_keys ORDER BY created_at'):
+        keys.setdefault(key['user_id'], []).append(_api_key_summary(key))
     users = []
-    for row in cursor:
-        map_count = conn.execute('SELECT COUNT(*) FROM maps WHERE user_id = ? AND (trashed IS NULL OR trashed = 0)', (row['id'],)).fetchone()[0]
+    for row in rows:
+        api_keys = keys.get(row['id'], [])
         users.append({
             'id': row['id'],
             'username': row['username'],
             'displayName': row['display_name'],
             'isAdmin': bool(row['is_admin']),
-            'hasApiKey': bool(row['api_key']),
-            'apiKeyPreview': ('••••' + row['api_key'][-8:]) if row['api_key'] else None,
+            'hasApiKey': bool(api_keys),
+            'apiKeyPreview': api_keys[0]['preview'] if api_keys else None,
+            'apiKeys': api_keys,
             'createdAt': row['created_at'],
-            'mapCount': map_count
+            'mapCount': row['map_count'],
+            'storageBytes': row['map_bytes']
         })
     conn.close()
     return jsonify(users)
@@ -504,7 +2379,8 @@ def create_user():
     if len(password) < 8:
         return jsonify({'error': 'Le mot de passe doit faire au moins 8 caractères'}), 400
 
-    conn = get_db()
+    password_hash = generate_password_hash(password)  # slow: keep it out of the write slot
+    conn = get_write_db()
     existing = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
     if existing:
         conn.close()
@@ -514,7 +2390,7 @@ def create_user():
     user_id = f'user-{uuid.uuid4().hex[:12]}'
     conn.execute(
         'INSERT INTO users (id, username, password_hash, display_name, is_admin, created_at, updated_at) VALUES (?, ?, ?, ?, 0, ?, ?)',
-        (user_id, username, generate_password_hash(password), display_name, now, now)
+        (user_id, username, password_hash, display_name, now, now)
     )
     conn.commit()
     conn.close()
@@ -536,12 +2412,6 @@ def update_user(user_id):
     if not data:
         return jsonify({'error': 'Données invalides'}), 400
 
-    conn = get_db()
-    user = conn.execute('SELECT id, is_admin FROM users WHERE id = ?', (user_id,)).fetchone()
-    if not user:
-        conn.close()
-        return jsonify({'error': 'Utilisateur introuvable'}), 404
-
     now = int(time.time() * 1000)
     updates = []
     params = []
@@ -554,10 +2424,15 @@ def update_user(user_id):
     password = data.get('password')
     if password:
         if len(password) < 8:
-            conn.close()
             return jsonify({'error': 'Le mot de passe doit faire au moins 8 caractères'}), 400
         updates.append('password_hash = ?')
-        params.append(generate_password_hash(password))
+        params.append(generate_password_hash(password))  # slow: keep it out of the write slot
+
+    conn = get_write_db()
+    user = conn.execute('SELECT id, is_admin FROM users WHERE id = ?', (user_id,)).fetchone()
+    if not user:
+        conn.close()
+        return jsonify({'error': 'Utilisateur introuvable'}), 404
 
     if updates:
         updates.append('updated_at = ?')
@@ -565,38 +2440,82 @@ def update_user(user_id):
         params.append(user_id)
         conn.execute(f'UPDATE users SET {", ".join(updates)} WHERE id = ?', params)
         conn.commit()
+        invalidate_auth_cache()
 
     conn.close()
     return jsonify({'success': True})
 
 
+@app.route('/api/admin/users/<user_id>/api-keys', methods=['GET'])
+@requires_admin
+def list_api_keys(user_id):
+    """A user's API keys (names, prefixes and last use; never the keys)."""
+    flush_api_key_uses()
+    conn = get_db()
+    rows = conn.execute(
+        'SELECT id, name, prefix, created_at, last_used_at FROM api_keys WHERE user_id = ? ORDER BY created_at', (user_id,)
+    ).fetchall()
+    conn.close()
+    return jsonify([_api_key_summary(row) for row in rows])
+
+
+@app.route('/api/admin/users/<user_id>/api-keys', methods=['POST'])
+@requires_admin
+def add_api_key(user_id):
+    """Create a named API key. The key is only returned here."""
+    name = ((request.get_json(silent=True) or {}).get('name') or '').strip() or 'default'
+    conn = get_write_db()
+    try:
+        if not conn.execute('SELECT id FROM users WHERE id = ?', (user_id,)).fetchone():
+            return jsonify({'error': 'Utilisateur introuvable'}), 404
+        key_id, api_key = create_api_key(conn, user_id, name)
+        conn.commit()
+    finally:
+        conn.close()
+    return jsonify({'id': key_id, 'name': name, 'apiKey': api_key})
+
+
+@app.route('/api/admin/users/<user_id>/api-keys/<key_id>', methods=['DELETE'])
+@requires_admin
+def delete_api_key(user_id, key_id):
+    """Revoke one API key."""
+    conn = get_write_db()
+    deleted = conn.execute('DELETE FROM api_keys WHERE id = ? AND user_id = ?', (key_id, user_id)).rowcount
+    conn.commit()
+    conn.close()
+    if not deleted:
+        return jsonify({'error': 'Clé introuvable'}), 404
+    invalidate_auth_cache()
+    return jsonify({'success': True})
+
+
 @app.route('/api/admin/users/<user_id>/api-key', methods=['POST'])
 @requires_admin
 def generate_api_key(user_id):
-    """Generate or regenerate an API key for a user."""
-    conn = get_db()
+    """Generate or regenerate a user's key named "default" (the single-key API)."""
+    conn = get_write_db()
     user = conn.execute('SELECT id FROM users WHERE id = ?', (user_id,)).fetchone()
     if not user:
         conn.close()
         return jsonify({'error': 'Utilisateur introuvable'}), 404
 
-    api_key = f'mk_{secrets.token_urlsafe(32)}'
-    now = int(time.time() * 1000)
-    conn.execute('UPDATE users SET api_key = ?, updated_at = ? WHERE id = ?', (api_key, now, user_id))
+    conn.execute("DELETE FROM api_keys WHERE user_id = ? AND name = 'default'", (user_id,))
+    _, api_key = create_api_key(conn, user_id, 'default')
     conn.commit()
     conn.close()
+    invalidate_auth_cache()
     return jsonify({'apiKey': api_key})
 
 
 @app.route('/api/admin/users/<user_id>/api-key', methods=['DELETE'])
 @requires_admin
 def revoke_api_key(user_id):
-    """Revoke a user's API key."""
-    conn = get_db()
-    now = int(time.time() * 1000)
-    conn.execute('UPDATE users SET api_key = NULL, updated_at = ? WHERE id = ?', (now, user_id))
+    """Revoke all of a user's API keys."""
+    conn = get_write_db()
+    conn.execute('DELETE FROM api_keys WHERE user_id = ?', (user_id,))
     conn.commit()
     conn.close()
+    invalidate_auth_cache()
     return jsonify({'success': True})
 
 
@@ -604,7 +2523,7 @@ def revoke_api_key(user_id):
 @requires_admin
 def delete_user(user_id):
     """Delete a user and all their data."""
-    conn = get_db()
+    conn = get_write_db()
     user = conn.execute('SELECT id, is_admin FROM users WHERE id = ?', (user_id,)).fetchone()
     if not user:
         conn.close()
@@ -618,63 +2537,467 @@ def delete_user(user_id):
     conn.execute('DELETE FROM map_versions WHERE map_id IN (SELECT id FROM maps WHERE user_id = ?)', (user_id,))
     conn.execute('DELETE FROM maps WHERE user_id = ?', (user_id,))
     conn.execute('DELETE FROM folders WHERE user_id = ?', (user_id,))
+    _drop_search_docs(conn, 'user_id = ?', (user_id,))
+    conn.execute('DELETE FROM map_index WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM user_stats WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM api_keys WHERE user_id = ?', (user_id,))
     conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
     conn.commit()
     conn.close()
+    invalidate_auth_cache()
+    if DB_SHARD_DIR:
+        _remove_shard(user_id)
     return jsonify({'success': True})
 
 
+def _remove_shard(user_id):
+    """Delete a user's database file (and its WAL) once the user is gone."""
+    path = _shard_path(user_id)
+    with _path_write_lock(path):
+        _close_pooled(path)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(path + suffix)
+            except FileNotFoundError:
+                pass
+    print(f"[DB] Removed database of {user_id}", flush=True)
+
+
+@app.route('/api/admin/users/<user_id>/export', methods=['GET'])
+@requires_admin
+def export_user_db(user_id):
+    """Download one user's database file (per-user storage only)."""
+    if not DB_SHARD_DIR:
+        return jsonify({'error': 'Stockage par utilisateur désactivé (DB_SHARD_DIR)'}), 400
+    try:
+        path = _shard_path(user_id)
+    except ValueError:
+        return jsonify({'error': 'Utilisateur introuvable'}), 404
+    if not os.path.exists(path):
+        return jsonify({'error': 'Utilisateur introuvable'}), 404
+    return _send_database_copy(path, f'mindmap-{user_id}')
+
+
+# =============================================================================
+# VERSION HISTORY
+# =============================================================================
+# map_versions rows come in segments: a keyframe (base_id NULL, data = full
+# map JSON) followed by deltas (base_id = keyframe id, data = JSON list of
+# ops turning the previous version into this one). An op is [path, value] to
+# set a key or [path] to delete it; path is a list of object keys, and lists
+# are replaced whole. Replaying a delta list is plain concatenation, so
+# dropping a delta just means prepending its ops to the next one.
+
+#
+# Snapshot policy: a save whose content hash matches the latest version adds
+# nothing; saves falling in the same VERSION_COALESCE_SECONDS slot as the
+# latest version replace it; and older history is thinned to one version per
+# slot of a coarser size (VERSION_THINNING = "age:slot,..." in seconds).
+
+VERSION_KEYFRAME_INTERVAL = int(os.environ.get('VERSION_KEYFRAME_INTERVAL', 20))
+VERSION_DELTA_MAX_RATIO = 0.5  # store a keyframe when the delta isn't at least 2x smaller
+VERSION_COALESCE_SECONDS = int(os.environ.get('VERSION_COALESCE_SECONDS', 300))
+
+
+def _parse_thinning(spec):
+    """'86400:3600,604800:86400' -> [(86400000, 3600000), (604800000, 86400000)] in ms."""
+    tiers = []
+    for part in spec.split(','):
+        if part.strip():
+            age, slot = part.split(':')
+            tiers.append((int(age) * 1000, int(slot) * 1000))
+    return sorted(tiers)
+
+
+# Older than a day: hourly. Older than a week: daily.
+VERSION_THINNING = _parse_thinning(os.environ.get('VERSION_THINNING', '86400:3600,604800:86400'))
+
+
+def _content_hash(serialized):
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def _json_diff(old, new, path=(), ops=None):
+    """Ops that turn old into new (see section comment for the format)."""
+    if ops is None:
+        ops = []
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.items():
+            if key not in old:
+                ops.append([[*path, key], value])
+            elif type(old[key]) is not type(value) or old[key] != value:
+                _json_diff(old[key], value, (*path, key), ops)
+        for key in old:
+            if key not in new:
+                ops.append([[*path, key]])
+    else:
+        ops.append([list(path), new])
+    return ops
+
+
+def _json_patch(doc, ops):
+    """Apply ops produced by _json_diff to doc (mutated in place) and return it."""
+    for op in ops:
+        path = op[0]
+        if not path:
+            doc = op[1]
+            continue
+        target = doc
+        for key in path[:-1]:
+            target = target[key]
+        if len(op) == 2:
+            target[path[-1]] = op[1]
+        else:
+            target.pop(path[-1], None)
+    return doc
+
+
+def _compact_ops(ops):
+    """Drop ops made redundant by a later op on the same path or an ancestor."""
+    compacted = {}
+    for op in ops:
+        path = tuple(op[0])
+        for key in [k for k in compacted if k[:len(path)] == path]:
+            del compacted[key]
+        compacted[path] = op
+    return list(compacted.values())
+
+
+def _load_version(conn, map_id, version_id):
+    """Rebuild a version's content (json.loads of what was saved) from its segment."""
+    row = conn.execute(
+        'SELECT base_id, data FROM map_versions WHERE id = ? AND map_id = ?', (version_id, map_id)
+    ).fetchone()
+    if row is None:
+        return None
+    if row['base_id'] is None:
+        return _load_json(row['data'])
+    cursor = conn.execute(
+        'SELECT data FROM map_versions WHERE map_id = ? AND id >= ? AND id <= ? ORDER BY id',
+        (map_id, row['base_id'], version_id)
+    )
+    content = _load_json(next(cursor)['data'])
+    for delta in cursor:
+        content = _json_patch(content, _load_json(delta['data']))
+    return content
+
+
+def _record_version(conn, map_id, content, serialized, now, previous=None, stored=None, ops=None):
+    """Record a save in the history according to the snapshot policy.
+
+    content is the saved value, serialized its json.dumps() form and stored
+    the already encoded form of serialized, if the caller has it;
+    previous is (data, updated_at) of the maps row before this save, which
+    spares replaying the segment when it matches the latest version.
+    ops, when the caller knows them, turn the previous row's content into
+    content and replace the diff if that row is the latest version.
+    Returns True when a new version row was added.
+    """
+    content_hash = _content_hash(serialized)
+    if stored is None:
+        stored = _encode_data(serialized)
+    latest = conn.execute(
+        'SELECT id, base_id, data, created_at, content_hash FROM map_versions WHERE map_id = ? ORDER BY id DESC LIMIT 1',
+        (map_id,)
+    ).fetchone()
+    if latest is None:
+        _insert_version(conn, map_id, stored, content_hash, now)
+        return True
+    if latest['content_hash'] == content_hash:
+        return False
+
+    def diff_from_latest():
+        if ops is not None and previous is not None and previous[1] == latest['created_at']:
+            return ops
+        previous_text = _decode_data(previous[0]) if previous is not None else None
+        if previous is not None and (
+            previous[1] == latest['created_at'] or _content_hash(previous_text) == latest['content_hash']
+        ):
+            latest_content = json.loads(previous_text)
+        else:
+            latest_content = _load_version(conn, map_id, latest['id'])
+        return _json_diff(latest_content, content)
+
+    slot = VERSION_COALESCE_SECONDS * 1000
+    if slot > 0 and now // slot == latest['created_at'] // slot:
+        # Same slot: this save replaces the latest version
+        data, base_id = stored, None
+        if latest['base_id'] is not None:
+            delta = json.dumps(_compact_ops(_load_json(latest['data']) + diff_from_latest()), separators=(',', ':'))
+            if len(delta) <= len(serialized) * VERSION_DELTA_MAX_RATIO:
+                data, base_id = _encode_data(delta), latest['base_id']
+        conn.execute(
+            'UPDATE map_versions SET data = ?, base_id = ?, created_at = ?, content_hash = ? WHERE id = ?',
+            (data, base_id, now, content_hash, latest['id'])
+        )
+        return False
+
+    base_id = latest['base_id'] or latest['id']
+    segment_len = conn.execute(
+        'SELECT COUNT(*) FROM map_versions WHERE map_id = ? AND id >= ?', (map_id, base_id)
+    ).fetchone()[0]
+    if segment_len < VERSION_KEYFRAME_INTERVAL:
+        delta = json.dumps(diff_from_latest(), separators=(',', ':'))
+        if len(delta) <= len(serialized) * VERSION_DELTA_MAX_RATIO:
+            _insert_version(conn, map_id, _encode_data(delta), content_hash, now, base_id)
+            return True
+    _insert_version(conn, map_id, stored, content_hash, now)
+    return True
+
+
+def _insert_version(conn, map_id, stored, content_hash, now, base_id=None):
+    conn.execute(
+        'INSERT INTO map_versions (map_id, data, created_at, base_id, content_hash) VALUES (?, ?, ?, ?, ?)',
+        (map_id, stored, now, base_id, content_hash)
+    )
+
+
+def _drop_version(conn, map_id, version_id):
+    """Delete one version, folding it into the next version of its segment."""
+    row = conn.execute(
+        'SELECT id, base_id, data FROM map_versions WHERE id = ? AND map_id = ?', (version_id, map_id)
+    ).fetchone()
+    if row is None:
+        return
+    segment = row['base_id'] or row['id']
+    nxt = conn.execute(
+        'SELECT id, data FROM map_versions WHERE map_id = ? AND base_id = ? AND id > ? ORDER BY id LIMIT 1',
+        (map_id, segment, row['id'])
+    ).fetchone()
+    if nxt is not None:
+        if row['base_id'] is None:
+            # Dropping a keyframe: the next version becomes the segment's keyframe
+            content = _json_patch(_load_json(row['data']), _load_json(nxt['data']))
+            conn.execute('UPDATE map_versions SET data = ?, base_id = NULL WHERE id = ?', (_encode_data(json.dumps(content)), nxt['id']))
+            conn.execute('UPDATE map_versions SET base_id = ? WHERE map_id = ? AND base_id = ?', (nxt['id'], map_id, row['id']))
+        else:
+            ops = _compact_ops(_load_json(row['data']) + _load_json(nxt['data']))
+            conn.execute('UPDATE map_versions SET data = ? WHERE id = ?', (_encode_data(json.dumps(ops, separators=(',', ':'))), nxt['id']))
+    conn.execute('DELETE FROM map_versions WHERE id = ?', (row['id'],))
+
+
+def _thin_versions(conn, map_id, now, tiers=None):
+    """Keep only the newest version per slot in each VERSION_THINNING age tier."""
+    tiers = VERSION_THINNING if tiers is None else tiers
+    if not tiers:
+        return
+    rows = conn.execute(
+        'SELECT id, created_at FROM map_versions WHERE map_id = ? AND created_at <= ? ORDER BY id DESC',
+        (map_id, now - tiers[0][0])
+    ).fetchall()
+    seen = set()
+    for row in rows:
+        age = now - row['created_at']
+        slot = [size for threshold, size in tiers if age >= threshold][-1]
+        key = (slot, row['created_at'] // slot)
+        if key in seen:
+            _drop_version(conn, map_id, row['id'])
+        else:
+            seen.add(key)
+
+
+def _trim_versions(conn, map_id, keep):
+    """Drop whole segments that lie entirely outside the newest `keep` versions.
+
+    A segment is only removed once none of its versions are needed, so up to
+    keep + VERSION_KEYFRAME_INTERVAL - 1 versions may be retained.
+    """
+    oldest_kept = conn.execute(
+        'SELECT id, base_id FROM map_versions WHERE map_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+        (map_id, max(keep, 1) - 1)
+    ).fetchone()
+    if oldest_kept is None:
+        return
+    segment_start = oldest_kept['base_id'] or oldest_kept['id']
+    conn.execute('DELETE FROM map_versions WHERE map_id = ? AND id < ?', (map_id, segment_start))
+
+
+def _encode_version_history(conn, map_id):
+    """Rewrite a map's full-copy history as keyframes + deltas."""
+    rows = conn.execute(
+        'SELECT id, data FROM map_versions WHERE map_id = ? ORDER BY id', (map_id,)
+    ).fetchall()
+    prev = base_id = None
+    segment_len = 0
+    for row in rows:
+        text = _decode_data(row['data'])
+        content = json.loads(text)
+        delta = None
+        if prev is not None and segment_len < VERSION_KEYFRAME_INTERVAL:
+            delta = json.dumps(_json_diff(prev, content), separators=(',', ':'))
+            if len(delta) > len(text) * VERSION_DELTA_MAX_RATIO:
+                delta = None
+        if delta is None:
+            base_id = row['id']
+            segment_len = 1
+        else:
+            conn.execute('UPDATE map_versions SET data = ?, base_id = ? WHERE id = ?', (_encode_data(delta), base_id, row['id']))
+            segment_len += 1
+        prev = content
+
+
+# =============================================================================
+# CONDITIONAL REQUESTS
+# =============================================================================
+
+# Map reads are revalidated on every use (no-cache) but a matching
+# If-None-Match is answered with 304 before the data column is read.
+PRIVATE_CACHE_CONTROL = 'private, no-cache'
+SHARED_CACHE_CONTROL = 'public, no-cache'
+
+
+def _make_etag(*parts):
+    """Strong ETag over the values a response is built from."""
+    digest = hashlib.sha256('\x1f'.join(map(str, parts)).encode('utf-8')).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def _not_modified(etag, cache_control):
+    """304 response when the request's If-None-Match matches etag, else None.
+
+    Compressed responses carry the ETag with an encoding suffix (see
+    _compress_response), which matches as well.
+    """
+    tag = etag.strip('"')
+    for candidate in (tag, *(f'{tag}-{encoding}' for encoding in _COMPRESSORS)):
+        if request.if_none_match.contains(candidate):
+            return Response(status=304, headers={'ETag': f'"{candidate}"', 'Cache-Control': cache_control})
+    return None
+
+
+def _with_validators(response, etag, cache_control):
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
 # =============================================================================
 # MAP API ROUTES
 # =============================================================================
 
+# Listings are ordered by (updated_at, id), newest first. With `limit` or
+# `cursor` they are paged by keyset: the X-Next-Cursor header of a page is
+# the `cursor` of the next one, so a page costs the same however many maps
+# precede it. Without either the whole list comes back, as it always did.
+MAP_PAGE_SIZE = 100
+MAP_MAX_PAGE_SIZE = 500
+MAP_LIST_FIELDS = {'id': 'id', 'title': 'title', 'updatedAt': 'updated_at', 'folderId': 'folder_id'}
+
+
+def _encode_cursor(updated_at, map_id):
+    return base64.urlsafe_b64encode(json.dumps([updated_at, map_id]).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """(updated_at, id) from a cursor, or None if it is not one of ours."""
+    try:
+        updated_at, map_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if not isinstance(updated_at, int) or not isinstance(map_id, str):
+        return None
+    return updated_at, map_id
+
+
+def _list_maps(conn, user):
+    """GET /api/maps?id=0: the user's maps, filtered by folder_id, trashed
+    and title (case-insensitive substring), projected on fields=."""
+    args = request.args
+    fields = [f for f in (args.get('fields') or ','.join(MAP_LIST_FIELDS)).split(',') if f]
+    unknown = [f for f in fields if f not in MAP_LIST_FIELDS]
+    if unknown:
+        return jsonify({'error': f'Champ inconnu : {unknown[0]}'}), 400
+    paged = 'limit' in args or 'cursor' in args
+    try:
+        limit = min(max(int(args.get('limit', MAP_PAGE_SIZE)), 1), MAP_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'limit doit être un entier'}), 400
+    after = None
+    if args.get('cursor'):
+        after = _decode_cursor(args['cursor'])
+        if after is None:
+            return jsonify({'error': 'Curseur invalide'}), 400
+
+    where, params = ['user_id = ?'], [user['id']]
+    folder_id = args.get('folder_id')
+    if args.get('trashed') == '1':
+        where.append('trashed = 1')
+    else:
+        where.append('(trashed IS NULL OR trashed = 0)')
+        if folder_id == 'root':
+            where.append('folder_id IS NULL')
+        elif folder_id:
+            where.append('folder_id = ?')
+            params.append(folder_id)
+    title = args.get('title', '').strip()
+    if title:
+        where.append("title LIKE ? ESCAPE '\\'")
+        params.append('%' + re.sub(r'([\\%_])', r'\\\1', title) + '%')
+    filters = ' AND '.join(where)
+
+    # The total is only worked out for the first page; counters cover the
+    # common cases, a COUNT over the covering index the rest
+    total = None
+    with timing_span('db'):
+        if after is None:
+            if title or args.get('trashed') == '1' or folder_id == 'root':
+                total = conn.execute(f'SELECT COUNT(*) FROM maps WHERE {filters}', params).fetchone()[0]
+            elif folder_id:
+                row = conn.execute('SELECT map_count FROM folders WHERE id = ? AND user_id = ?', (folder_id, user['id'])).fetchone()
+                total = row[0] if row else 0
+            else:
+                row = conn.execute('SELECT map_count FROM user_stats WHERE user_id = ?', (user['id'],)).fetchone()
+                total = row[0] if row else 0
+
+    if after is not None:
+        filters += ' AND (updated_at, id) < (?, ?)'
+        params += after
+    columns = ', '.join(dict.fromkeys(['id', 'updated_at'] + [MAP_LIST_FIELDS[f] for f in fields]))
+    sql = f'SELECT {columns} FROM maps WHERE {filters} ORDER BY updated_at DESC, id DESC'
+    if paged:
+        sql += ' LIMIT ?'
+        params.append(limit + 1)
+    with timing_span('db'):
+        rows = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if paged and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]['updated_at'], rows[-1]['id'])
+    maps = [{f: row[MAP_LIST_FIELDS[f]] for f in fields} for row in rows]
+
+    etag = _make_etag(user['id'], request.query_string.decode('latin-1'), total, next_cursor,
+                      *(value for item in maps for value in item.values()))
+    not_modified = _not_modified(etag, PRIVATE_CACHE_CONTROL)
+    if not_modified:
+        return not_modified
+    with timing_span('encode'):
+        response = _with_validators(jsonify(maps), etag, PRIVATE_CACHE_CONTROL)
+    if total is not None:
+        response.headers['X-Total-Count'] = str(total)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
 @app.route('/api/maps', methods=['GET'])
 @requires_login
 def get_maps():
     """Get map list or single map."""
     user = request.current_user
     map_id = request.args.get('id')
-    print(f"[API] GET /api/maps?id={map_id} user={user['username']}", flush=True)
-    conn = get_db()
+    listing = map_id == '0' or map_id is None
+    if not listing:
+        g.access_map_id = map_id
+    conn = get_db(_user_shard(user) if listing else _map_shard(map_id, user))
     try:
-        if map_id == '0' or map_id is None:
-            folder_id = request.args.get('folder_id')
-            trashed = request.args.get('trashed')
-            if trashed == '1':
-                cursor = conn.execute(
-                    'SELECT id, title, updated_at, folder_id FROM maps WHERE user_id = ? AND trashed = 1 ORDER BY updated_at DESC',
-                    (user['id'],)
-                )
-            elif folder_id == 'root':
-                cursor = conn.execute(
-                    'SELECT id, title, updated_at, folder_id FROM maps WHERE user_id = ? AND folder_id IS NULL AND (trashed IS NULL OR trashed = 0) ORDER BY updated_at DESC',
-                    (user['id'],)
-                )
-            elif folder_id:
-                cursor = conn.execute(
-                    'SELECT id, title, updated_at, folder_id FROM maps WHERE user_id = ? AND folder_id = ? AND (trashed IS NULL OR trashed = 0) ORDER BY updated_at DESC',
-                    (user['id'], folder_id)
-                )
-            else:
-                cursor = conn.execute(
-                    'SELECT id, title, updated_at, folder_id FROM maps WHERE user_id = ? AND (trashed IS NULL OR trashed = 0) ORDER BY updated_at DESC',
-                    (user['id'],)
-                )
-            maps = []
-            for row in cursor:
-                maps.append({
-                    'id': row['id'],
-                    'title': row['title'],
-                    'updatedAt': row['updated_at'],
-                    'folderId': row['folder_id']
-                })
-            return jsonify(maps)
+        if listing:
+            return _list_maps(conn, user)
         else:
-            cursor = conn.execute(
-                'SELECT id, title, data, created_at, updated_at, user_id FROM maps WHERE id = ?',
-                (map_id,)
-            )
-            row = cursor.fetchone()
+            # Check access and freshness before reading the (large) data column
+            with timing_span('db'):
+                row = conn.execute(
+                    'SELECT user_id, revision, updated_at FROM maps WHERE id = ?', (map_id,)
+                ).fetchone()
 
             if row is None:
                 return jsonify({'error': 'Map not found'}), 404
@@ -683,8 +3006,29 @@ def get_maps():
             if row['user_id'] != user['id'] and not user.get('is_admin'):
                 return jsonify({'error': 'Accès refusé'}), 403
 
-            map_data = _load_map_data(row['data'])
-            return jsonify({'map': map_data})
+            inline = request.args.get('inline_blobs') == '1'
+            etag = _make_etag(map_id, row['revision'], row['updated_at'], inline)
+            not_modified = _not_modified(etag, PRIVATE_CACHE_CONTROL)
+            if not_modified:
+                return not_modified
+
+            # Re-read the validators with the data in case a save landed in between
+            with timing_span('db'):
+                row = conn.execute('SELECT data, revision, updated_at FROM maps WHERE id = ?', (map_id,)).fetchone()
+            if row is None:
+                return jsonify({'error': 'Map not found'}), 404
+            etag = _make_etag(map_id, row['revision'], row['updated_at'], inline)
+            if inline:
+                with timing_span('decode'):
+                    map_data = _load_map_data(row['data'])
+                    _inline_blobs(map_data)
+                with timing_span('encode'):
+                    response = jsonify({'map': map_data, 'revision': row['revision']})
+            else:
+                # Copies the stored JSON into the envelope: decompression only
+                with timing_span('decode'):
+                    response = _map_response(row['data'], revision=row['revision'])
+            return _with_validators(response, etag, PRIVATE_CACHE_CONTROL)
     finally:
         conn.close()
 
@@ -694,71 +3038,391 @@ def get_maps():
 def save_map():
     """Save or update a map."""
     user = request.current_user
-    print(f"[API] POST /api/maps user={user['username']}", flush=True)
-    data = request.get_json()
+    with timing_span('decode'):
+        data = request.get_json()
     if not data:
         return jsonify({'error': 'Invalid JSON'}), 400
 
     map_id = data.get('id')
     title = data.get('title', 'Sans titre')
     map_content = data.get('map', {})
+    if isinstance(map_content, str):
+        # Some clients send the map as a JSON string: store the map itself
+        try:
+            map_content = json.loads(map_content)
+        except ValueError:
+            return jsonify({'error': 'Invalid JSON'}), 400
+    base_revision = data.get('baseRevision')
     now = int(time.time() * 1000)
 
-    conn = get_db()
-    try:
-        # Prevent duplicate titles when creating a new map
-        if not map_id:
-            dup = conn.execute(
-                'SELECT id FROM maps WHERE title = ? AND user_id = ? AND (trashed IS NULL OR trashed = 0)',
-                (title, user['id'])
-            ).fetchone()
-            if dup:
-                conn.close()
-                return jsonify({'error': f'Une carte "{title}" existe déjà', 'existing_id': dup['id']}), 409
-
-        if map_id:
-            cursor = conn.execute('SELECT id, user_id FROM maps WHERE id = ?', (map_id,))
-            existing = cursor.fetchone()
-
-            if existing:
-                # Only allow updating own maps
-                if existing['user_id'] != user['id'] and not user.get('is_admin'):
-                    return jsonify({'error': 'Accès refusé'}), 403
-                conn.execute(
-                    'UPDATE maps SET title = ?, data = ?, updated_at = ? WHERE id = ?',
-                    (title, json.dumps(map_content), now, map_id)
-                )
-            else:
-                conn.execute(
-                    'INSERT INTO maps (id, title, data, created_at, updated_at, user_id) VALUES (?, ?, ?, ?, ?, ?)',
-                    (map_id, title, json.dumps(map_content), now, now, user['id'])
-                )
+    with timing_span('blobs'):
+        blobs = _extract_blobs(map_content, now)
+    with timing_span('serialize'):
+        serialized = _json_dumps(map_content)
+        stored = _encode_data(serialized)
+    shard = _map_shard(map_id, user) if map_id else _user_shard(user)
+    save = _PendingSave(user, map_id, title, map_content, serialized, stored, base_revision, now, shard)
+    with timing_span('index'):
+        save.search_docs = _search_docs(title, map_content)
+
+    if SAVE_GROUP_COMMIT_MS > 0:
+        # Waiting for the batch, writing it and its commit in one span
+        with timing_span('write'):
+            body, status = _group_commit(save)
+    else:
+        # Only database work here: the write slot is held until close()
+        with timing_span('lock'):
+            conn = get_write_db(shard)
+        try:
+            with timing_span('write'):
+                body, status = _apply_save(conn, save)
+            if status == 200:
+                with timing_span('commit'):
+                    conn.commit()
+        finally:
+            conn.close()
+    if save.created:
+        _index_map(body['id'], user['id'])
+    g.access_map_id = body.get('id') or map_id
+    body = dict(body)
+    if status == 200 and blobs:
+        body['blobs'] = blobs
+    with timing_span('encode'):
+        return jsonify(body), status
+
+
+class _PendingSave:
+    """A parsed POST /api/maps waiting for the database."""
+
+    __slots__ = ('user', 'map_id', 'title', 'content', 'serialized', 'stored', 'base_revision', 'now',
+                 'shard', 'created', 'search_docs', 'done', 'result')
+
+    def __init__(self, user, map_id, title, content, serialized, stored, base_revision, now, shard=None):
+        self.user = user
+        self.map_id = map_id
+        self.title = title
+        self.content = content
+        self.serialized = serialized
+        self.stored = stored
+        self.base_revision = base_revision
+        self.now = now
+        self.shard = shard
+        self.created = False  # set once committed as a new map
+        self.search_docs = {}
+        self.done = None
+        self.result = None
+
+
+def _apply_save(conn, save):
+    """Write one save inside the caller's transaction. Returns (body, status)."""
+    user, map_id, title, stored, now = save.user, save.map_id, save.title, save.stored, save.now
+    # Prevent duplicate titles when creating a new map
+    if not map_id:
+        dup = conn.execute(
+            'SELECT id FROM maps WHERE title = ? AND user_id = ? AND (trashed IS NULL OR trashed = 0)',
+            (title, user['id'])
+        ).fetchone()
+        if dup:
+            return {'error': f'Une carte "{title}" existe déjà', 'existing_id': dup['id']}, 409
+
+    previous = None
+    revision = 1
+    owner = user['id']
+    if map_id:
+        cursor = conn.execute('SELECT id, user_id, data, updated_at, revision FROM maps WHERE id = ?', (map_id,))
+        existing = cursor.fetchone()
+
+        if existing:
+            # Only allow updating own maps
+            if existing['user_id'] != user['id'] and not user.get('is_admin'):
+                return {'error': 'Accès refusé'}, 403
+            if save.base_revision is not None and save.base_revision != existing['revision']:
+                return _conflict_body(existing['revision']), 409
+            previous = (existing['data'], existing['updated_at'])
+            revision = existing['revision'] + 1
+            owner = existing['user_id']
+            conn.execute(
+                'UPDATE maps SET title = ?, data = ?, updated_at = ?, revision = ? WHERE id = ?',
+                (title, stored, now, revision, map_id)
+            )
         else:
-            map_id = f'map-{uuid.uuid4().hex[:12]}'
             conn.execute(
-                'INSERT INTO maps (id, title, data, created_at, updated_at, user_id) VALUES (?, ?, ?, ?, ?, ?)',
-                (map_id, title, json.dumps(map_content), now, now, user['id'])
+                'INSERT INTO maps (id, title, data, created_at, updated_at, user_id, revision) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (map_id, title, stored, now, now, user['id'], revision)
             )
-
-        # Save version snapshot (keep last N per map; configurable via MAP_VERSIONS_KEEP)
-        versions_keep = int(os.environ.get('MAP_VERSIONS_KEEP', 10))
+            save.created = True
+    else:
+        map_id = f'map-{uuid.uuid4().hex[:12]}'
         conn.execute(
-            'INSERT INTO map_versions (map_id, data, created_at) VALUES (?, ?, ?)',
-            (map_id, json.dumps(map_content), now)
+            'INSERT INTO maps (id, title, data, created_at, updated_at, user_id, revision) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (map_id, title, stored, now, now, user['id'], revision)
         )
-        conn.execute('''
-            DELETE FROM map_versions WHERE map_id = ? AND id NOT IN (
-                SELECT id FROM map_versions WHERE map_id = ? ORDER BY created_at DESC LIMIT ?
-            )
-        ''', (map_id, map_id, versions_keep))
+        save.created = True
+
+    # Save version snapshot (keep last N per map; configurable via MAP_VERSIONS_KEEP)
+    versions_keep = int(os.environ.get('MAP_VERSIONS_KEEP', 50))
+    if _record_version(conn, map_id, save.content, save.serialized, now, previous, stored):
+        _thin_versions(conn, map_id, now)
+        _trim_versions(conn, map_id, versions_keep)
+    _update_search_index(conn, map_id, owner, save.search_docs)
+
+    return {'id': map_id, 'title': title, 'updatedAt': now, 'revision': revision}, 200
+
+
+# Group commit (SAVE_GROUP_COMMIT_MS > 0): the first save to arrive waits
+# that long for others, then applies the whole batch in one transaction per
+# database with a single commit (one fsync under SQLITE_SYNCHRONOUS=FULL) and wakes
+# the requests that joined. Within a batch the last save of a map without
+# baseRevision wins and the earlier ones are answered with its result;
+# saves with a baseRevision are all applied in arrival order, so a stale
+# one gets 409 as it would without group commit.
+SAVE_GROUP_COMMIT_MS = float(os.environ.get('SAVE_GROUP_COMMIT_MS', 0))
+
+_save_batch = []
+_save_batch_lock = threading.Lock()
+
+
+def _take_save_batch():
+    with _save_batch_lock:
+        batch = _save_batch[:]
+        _save_batch.clear()
+    return batch
+
+
+def _group_commit(save):
+    """Queue save for the next batch and return its (body, status)."""
+    save.done = threading.Event()
+    with _save_batch_lock:
+        _save_batch.append(save)
+        leader = len(_save_batch) == 1
+    if leader:
+        time.sleep(SAVE_GROUP_COMMIT_MS / 1000)
+        _commit_save_batch()
+    else:
+        save.done.wait()
+    if isinstance(save.result, BaseException):
+        raise save.result
+    return save.result
+
+
+def _commit_save_batch():
+    batch = _take_save_batch()
+    by_shard = {}
+    for save in batch:
+        by_shard.setdefault(save.shard, []).append(save)
+    maps = 0
+    # One transaction per database: with per-user files, users don't share a commit
+    for shard, saves in by_shard.items():
+        maps += _commit_shard_saves(shard, saves)
+    for save in batch:
+        save.done.set()
+    if len(batch) > 1:
+        _log_event('group_commit', saves=len(batch), written=maps)
+
+
+def _batch_key(save):
+    if save.base_revision is not None:
+        return id(save)  # guarded by its revision: never collapsed
+    return (save.map_id or id(save), save.user['id'])
+
+
+def _commit_shard_saves(shard, batch):
+    """Apply batch in one transaction on shard. Returns the number of saves written."""
+    try:
+        conn = get_write_db(shard)
+    except Exception as e:
+        for save in batch:
+            save.result = e
+        return 0
+    winners = {}
+    for save in batch:
+        key = _batch_key(save)
+        winners.pop(key, None)  # re-insert so batch order follows the last save
+        winners[key] = save
+    try:
+        for save in winners.values():
+            conn.execute('SAVEPOINT pending_save')
+            try:
+                save.result = _apply_save(conn, save)
+            except Exception as e:
+                conn.execute('ROLLBACK TO pending_save')
+                save.result = e
+            conn.execute('RELEASE pending_save')
+        conn.commit()
+    except Exception as e:
+        for save in batch:
+            save.result = e
+    finally:
+        conn.close()
+    for save in batch:
+        if save.result is None:
+            save.result = winners[_batch_key(save)].result
+    return len(winners)
+
+
+# Incremental saves: PATCH /api/maps/<id> carries only what changed since
+# baseRevision. nodes, links and frames are {id: item} upserts where null
+# deletes the item; settings replaces the settings object; fields sets (or,
+# with null, removes) other top-level keys. A stale baseRevision gets 409
+# with the current revision so the client can reload instead of overwriting.
+MAP_PATCH_COLLECTIONS = ('links', 'frames')
+
+
+def _current_revision(conn, map_id):
+    row = conn.execute('SELECT revision FROM maps WHERE id = ?', (map_id,)).fetchone()
+    return row['revision'] if row else None
+
+
+def _conflict_body(revision):
+    return {
+        'error': 'Carte modifiée ailleurs — rechargez-la',
+        'conflict': True,
+        'revision': revision
+    }
+
+
+def _revision_conflict(revision):
+    return jsonify(_conflict_body(revision)), 409
+
+
+def _apply_map_patch(map_data, patch):
+    """Apply a PATCH body to map_data in place.
+
+    Returns the equivalent history ops (see VERSION HISTORY), or raises
+    ValueError on a malformed patch before touching map_data.
+    """
+    nodes = patch.get('nodes') or {}
+    fields = patch.get('fields') or {}
+    if not isinstance(nodes, dict) or not isinstance(fields, dict):
+        raise ValueError('nodes et fields doivent être des objets')
+    if any(value is not None and not isinstance(value, dict) for value in nodes.values()):
+        raise ValueError('nœud invalide')
+    for name in MAP_PATCH_COLLECTIONS:
+        items = patch.get(name)
+        if items is not None and (not isinstance(items, dict) or any(
+                value is not None and not isinstance(value, dict) for value in items.values())):
+            raise ValueError(f'{name} invalide')
+    if 'settings' in patch and not isinstance(patch['settings'], dict):
+        raise ValueError('settings invalide')
+    if any(key in ('nodes', 'settings', *MAP_PATCH_COLLECTIONS) for key in fields):
+        raise ValueError('fields ne peut pas remplacer nodes, settings, links ou frames')
+
+    ops = []
+    all_nodes = map_data.get('nodes')
+    if not isinstance(all_nodes, dict):
+        all_nodes = {}
+        if any(node is not None for node in nodes.values()):
+            # Creating the container is a change too: history replays it
+            map_data['nodes'] = all_nodes
+            ops.append([['nodes'], {}])
+    for node_id, node in nodes.items():
+        if node is None:
+            if all_nodes.pop(node_id, None) is not None:
+                ops.append([['nodes', node_id]])
+        else:
+            all_nodes[node_id] = node
+            ops.append([['nodes', node_id], node])
+    for name in MAP_PATCH_COLLECTIONS:
+        items = patch.get(name)
+        if not items:
+            continue
+        current = []
+        for item in map_data.get(name) or []:
+            item_id = item.get('id')
+            if item_id not in items:
+                current.append(item)
+            elif items[item_id] is not None:
+                current.append(items[item_id])
+        known = {item.get('id') for item in map_data.get(name) or []}
+        current.extend(item for item_id, item in items.items() if item is not None and item_id not in known)
+        map_data[name] = current
+        ops.append([[name], current])
+    if 'settings' in patch:
+        map_data['settings'] = patch['settings']
+        ops.append([['settings'], patch['settings']])
+    for key, value in fields.items():
+        if value is None:
+            if map_data.pop(key, None) is not None:
+                ops.append([[key]])
+        else:
+            map_data[key] = value
+            ops.append([[key], value])
+    return ops
+
+
+@app.route('/api/maps/<map_id>', methods=['PATCH'])
+@requires_login
+def patch_map(map_id):
+    """Apply an incremental change to a map, guarded by its revision."""
+    user = request.current_user
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Invalid JSON'}), 400
+    base_revision = data.get('baseRevision')
+    if not isinstance(base_revision, int):
+        return jsonify({'error': 'baseRevision requis'}), 400
+    now = int(time.time() * 1000)
+
+    shard = _map_shard(map_id, user)
+    conn = get_db(shard)
+    row = conn.execute(
+        'SELECT title, data, updated_at, user_id, revision FROM maps WHERE id = ?', (map_id,)
+    ).fetchone()
+    conn.close()
+    if row is None:
+        return jsonify({'error': 'Map not found'}), 404
+    if row['user_id'] != user['id'] and not user.get('is_admin'):
+        return jsonify({'error': 'Accès refusé'}), 403
+    if base_revision != row['revision']:
+        return _revision_conflict(row['revision'])
 
+    map_data = _load_json(row['data'])
+    double_encoded = isinstance(map_data, str)
+    if double_encoded:
+        map_data = json.loads(map_data)
+    try:
+        ops = _apply_map_patch(map_data, data)
+    except ValueError as e:
+        return jsonify({'error': f'Patch invalide : {e}'}), 400
+    # Only the patched nodes can carry new base64 media
+    blobs = _extract_blobs({'nodes': data.get('nodes') or {}}, now)
+
+    title = data.get('title') or row['title']
+    serialized = _json_dumps(map_data)
+    stored = _encode_data(serialized)
+    revision = row['revision'] + 1
+    search_docs = _search_docs(title, map_data)
+
+    # The row was read outside the write slot: the UPDATE only applies if
+    # nobody saved in between, which also keeps row['data'] valid as previous
+    conn = get_write_db(shard)
+    try:
+        cursor = conn.execute(
+            'UPDATE maps SET title = ?, data = ?, updated_at = ?, revision = ? WHERE id = ? AND revision = ?',
+            (title, stored, now, revision, map_id, row['revision'])
+        )
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return _revision_conflict(_current_revision(conn, map_id))
+
+        versions_keep = int(os.environ.get('MAP_VERSIONS_KEEP', 50))
+        # A double-encoded row was versioned as a string: let the history diff it
+        if _record_version(conn, map_id, map_data, serialized, now,
+                           (row['data'], row['updated_at']), stored, None if double_encoded else ops):
+            _thin_versions(conn, map_id, now)
+            _trim_versions(conn, map_id, versions_keep)
+        _update_search_index(conn, map_id, row['user_id'], search_docs)
         conn.commit()
 
-        return jsonify({
+        result = {
             'id': map_id,
             'title': title,
-            'updatedAt': now
-        })
+            'updatedAt': now,
+            'revision': revision
+        }
+        if blobs:
+            result['blobs'] = blobs
+        return jsonify(result)
     finally:
         conn.close()
 
@@ -768,7 +3432,7 @@ def save_map():
 def list_versions(map_id):
     """List version history for a map."""
     user = request.current_user
-    conn = get_db()
+    conn = get_db(_map_shard(map_id, user))
     try:
         map_row = conn.execute('SELECT user_id FROM maps WHERE id = ?', (map_id,)).fetchone()
         if not map_row:
@@ -790,7 +3454,7 @@ def list_versions(map_id):
 def get_version(map_id, version_id):
     """Get a specific version of a map."""
     user = request.current_user
-    conn = get_db()
+    conn = get_db(_map_shard(map_id, user))
     try:
         map_row = conn.execute('SELECT user_id FROM maps WHERE id = ?', (map_id,)).fetchone()
         if not map_row:
@@ -798,12 +3462,15 @@ def get_version(map_id, version_id):
         if map_row['user_id'] != user['id'] and not user.get('is_admin'):
             return jsonify({'error': 'Accès refusé'}), 403
         version = conn.execute(
-            'SELECT data, created_at FROM map_versions WHERE id = ? AND map_id = ?',
+            'SELECT created_at FROM map_versions WHERE id = ? AND map_id = ?',
             (version_id, map_id)
         ).fetchone()
         if not version:
             return jsonify({'error': 'Version introuvable'}), 404
-        return jsonify({'map': _load_map_data(version['data']), 'createdAt': version['created_at']})
+        content = _load_version(conn, map_id, version_id)
+        if isinstance(content, str):
+            content = json.loads(content)
+        return jsonify({'map': content, 'createdAt': version['created_at']})
     finally:
         conn.close()
 
@@ -813,17 +3480,20 @@ def get_version(map_id, version_id):
 def delete_map(map_id):
     """Permanently delete a map."""
     user = request.current_user
-    conn = get_db()
+    conn = get_write_db(_map_shard(map_id, user))
     try:
         row = conn.execute('SELECT user_id FROM maps WHERE id = ?', (map_id,)).fetchone()
         if row and row['user_id'] != user['id'] and not user.get('is_admin'):
             return jsonify({'error': 'Accès refusé'}), 403
         conn.execute('DELETE FROM map_versions WHERE map_id = ?', (map_id,))
         conn.execute('DELETE FROM maps WHERE id = ?', (map_id,))
+        _drop_search_docs(conn, 'map_id = ?', (map_id,))
         conn.commit()
-        return jsonify({'success': True})
     finally:
         conn.close()
+    if row:
+        _unindex_map(map_id)
+    return jsonify({'success': True})
 
 
 @app.route('/api/maps/<map_id>/trash', methods=['PUT'])
@@ -831,7 +3501,7 @@ def delete_map(map_id):
 def trash_map(map_id):
     """Move a map to trash (soft delete)."""
     user = request.current_user
-    conn = get_db()
+    conn = get_write_db(_user_shard(user))
     conn.execute('UPDATE maps SET trashed = 1 WHERE id = ? AND user_id = ?', (map_id, user['id']))
     conn.commit()
     conn.close()
@@ -843,7 +3513,7 @@ def trash_map(map_id):
 def restore_map(map_id):
     """Restore a map from trash."""
     user = request.current_user
-    conn = get_db()
+    conn = get_write_db(_user_shard(user))
     conn.execute('UPDATE maps SET trashed = 0 WHERE id = ? AND user_id = ?', (map_id, user['id']))
     conn.commit()
     conn.close()
@@ -859,7 +3529,7 @@ def move_map(map_id):
     if not data:
         return jsonify({'error': 'Invalid JSON'}), 400
     folder_id = data.get('folderId')
-    conn = get_db()
+    conn = get_write_db(_user_shard(user))
     conn.execute('UPDATE maps SET folder_id = ? WHERE id = ? AND user_id = ?', (folder_id, map_id, user['id']))
     conn.commit()
     conn.close()
@@ -875,18 +3545,16 @@ def move_map(map_id):
 def get_folders():
     """List user's folders."""
     user = request.current_user
-    conn = get_db()
-    cursor = conn.execute('SELECT id, name, created_at, updated_at FROM folders WHERE user_id = ? ORDER BY name', (user['id'],))
+    conn = get_db(_user_shard(user))
+    cursor = conn.execute(
+        'SELECT id, name, map_count, created_at, updated_at FROM folders WHERE user_id = ? ORDER BY name', (user['id'],)
+    )
     folders = []
     for row in cursor:
-        count = conn.execute(
-            'SELECT COUNT(*) FROM maps WHERE folder_id = ? AND user_id = ? AND (trashed IS NULL OR trashed = 0)',
-            (row['id'], user['id'])
-        ).fetchone()[0]
         folders.append({
             'id': row['id'],
             'name': row['name'],
-            'mapCount': count,
+            'mapCount': row['map_count'],
             'createdAt': row['created_at'],
             'updatedAt': row['updated_at']
         })
@@ -903,7 +3571,7 @@ def create_folder():
     name = data.get('name', 'Nouveau dossier')
     now = int(time.time() * 1000)
     folder_id = f'folder-{uuid.uuid4().hex[:12]}'
-    conn = get_db()
+    conn = get_write_db(_user_shard(user))
     conn.execute(
         'INSERT INTO folders (id, name, created_at, updated_at, user_id) VALUES (?, ?, ?, ?, ?)',
         (folder_id, name, now, now, user['id'])
@@ -921,7 +3589,7 @@ def rename_folder(folder_id):
     data = request.get_json()
     name = data.get('name', '')
     now = int(time.time() * 1000)
-    conn = get_db()
+    conn = get_write_db(_user_shard(user))
     conn.execute('UPDATE folders SET name = ?, updated_at = ? WHERE id = ? AND user_id = ?', (name, now, folder_id, user['id']))
     conn.commit()
     conn.close()
@@ -933,7 +3601,7 @@ def rename_folder(folder_id):
 def delete_folder(folder_id):
     """Delete a folder. Maps in the folder are moved to root."""
     user = request.current_user
-    conn = get_db()
+    conn = get_write_db(_user_shard(user))
     conn.execute('UPDATE maps SET folder_id = NULL WHERE folder_id = ? AND user_id = ?', (folder_id, user['id']))
     conn.execute('DELETE FROM folders WHERE id = ? AND user_id = ?', (folder_id, user['id']))
     conn.commit()
@@ -950,7 +3618,7 @@ def delete_folder(folder_id):
 def share_map(map_id):
     """Generate or get a share token for a map."""
     user = request.current_user
-    conn = get_db()
+    conn = get_write_db(_map_shard(map_id, user))
     row = conn.execute('SELECT user_id, share_token FROM maps WHERE id = ?', (map_id,)).fetchone()
     if not row:
         conn.close()
@@ -964,6 +3632,7 @@ def share_map(map_id):
         conn.execute('UPDATE maps SET share_token = ? WHERE id = ?', (token, map_id))
         conn.commit()
     conn.close()
+    _index_map(map_id, row['user_id'], token)
     return jsonify({'token': token})
 
 
@@ -972,7 +3641,7 @@ def share_map(map_id):
 def unshare_map(map_id):
     """Remove share token (revoke sharing)."""
     user = request.current_user
-    conn = get_db()
+    conn = get_write_db(_map_shard(map_id, user))
     row = conn.execute('SELECT user_id FROM maps WHERE id = ?', (map_id,)).fetchone()
     if not row:
         conn.close()
@@ -983,19 +3652,392 @@ def unshare_map(map_id):
     conn.execute('UPDATE maps SET share_token = NULL WHERE id = ?', (map_id,))
     conn.commit()
     conn.close()
+    _index_map(map_id, row['user_id'])
     return jsonify({'success': True})
 
 
 @app.route('/api/shared/<token>', methods=['GET'])
 def get_shared_map(token):
     """Get a shared map by token (no auth required)."""
+    shard = None
+    if DB_SHARD_DIR:
+        conn = get_db()
+        owner = conn.execute('SELECT user_id FROM map_index WHERE share_token = ?', (token,)).fetchone()
+        conn.close()
+        if not owner:
+            return jsonify({'error': 'Carte introuvable ou partage désactivé'}), 404
+        shard = owner['user_id']
+    conn = get_db(shard)
+    try:
+        row = conn.execute(
+            'SELECT id, title, revision, updated_at FROM maps WHERE share_token = ? AND (trashed IS NULL OR trashed = 0)',
+            (token,)
+        ).fetchone()
+        if not row:
+            return jsonify({'error': 'Carte introuvable ou partage désactivé'}), 404
+        etag = _make_etag(token, row['revision'], row['updated_at'], row['title'])
+        not_modified = _not_modified(etag, SHARED_CACHE_CONTROL)
+        if not_modified:
+            return not_modified
+        row = conn.execute('SELECT title, data, revision, updated_at FROM maps WHERE id = ?', (row['id'],)).fetchone()
+        if not row:
+            return jsonify({'error': 'Carte introuvable ou partage désactivé'}), 404
+        etag = _make_etag(token, row['revision'], row['updated_at'], row['title'])
+    finally:
+        conn.close()
+    return _with_validators(_map_response(row['data'], title=row['title']), etag, SHARED_CACHE_CONTROL)
+
+
+# =============================================================================
+# FULL-TEXT SEARCH
+# =============================================================================
+# search_index (FTS5) has one row per node (text, note body, tag names) and
+# one per map (its title, node id ''), in the same database as the map.
+# search_docs maps each FTS rowid to its map, node and owner, with a digest of
+# the indexed text: a save only rewrites the rows whose text changed. Maps
+# saved before the index existed need rebuild_search_index().
+#
+# bm25 has to score every match before it can sort, which for a word found in
+# most nodes costs ~100 ms per 100k hits. Hits are therefore ranked among the
+# SEARCH_RANK_WINDOW most recently indexed ones (newest rowids = last edited
+# nodes). Every page ranks that same set, so paging neither repeats nor skips
+# hits, and the results end with the window. Snippets are cut here from the page's rows rather than with FTS5's
+# snippet(): with a prefix term that re-expands the prefix for every row.
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_RANK_WINDOW = int(os.environ.get('SEARCH_RANK_WINDOW', 5000))
+SEARCH_SNIPPET_WORDS = 12
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+_SEARCH_TERM_RE = re.compile(r'\w+')
+_WORD_SPLIT_RE = re.compile(r'(\w+)')
+
+
+def _plain_text(value, markup=False):
+    """Indexable text of a node field; markup=True for rich-text (HTML) fields."""
+    if not isinstance(value, str):
+        return ''
+    if markup:
+        value = html.unescape(_HTML_TAG_RE.sub(' ', value))
+    return ' '.join(value.split())
+
+
+def _search_docs(title, map_data):
+    """{node_id: (digest, (title, text, body, tags))} to index for one map."""
+    docs = {}
+
+    def add(node_id, fields):
+        if any(fields):
+            digest = hashlib.sha1('\x1f'.join(fields).encode('utf-8')).hexdigest()
+            docs[node_id] = (digest, fields)
+
+    add('', (title or '', '', '', ''))
+    if not isinstance(map_data, dict):
+        return docs
+    settings = map_data.get('settings')
+    tag_names = {
+        tag.get('id'): tag.get('name') for tag in (settings.get('tags') or [])
+        if isinstance(tag, dict) and isinstance(tag.get('id'), str)
+    } if isinstance(settings, dict) else {}
+    for node_id, node in (map_data.get('nodes') or {}).items():
+        if not isinstance(node, dict):
+            continue
+        tags = ' '.join(
+            str(tag_names.get(tag) or tag) for tag in (node.get('tags') or []) if isinstance(tag, str)
+        )
+        add(node_id, ('', _plain_text(node.get('text')), _plain_text(node.get('body') or node.get('note'), markup=True), tags))
+    return docs
+
+
+def _update_search_index(conn, map_id, user_id, docs):
+    """Bring map_id's index rows in line with docs (see _search_docs), inside
+    the caller's transaction."""
+    indexed = {
+        row['node_id']: (row['rowid'], row['digest'])
+        for row in conn.execute('SELECT rowid, node_id, digest FROM search_docs WHERE map_id = ?', (map_id,))
+    }
+    stale = [(rowid,) for node_id, (rowid, digest) in indexed.items()
+             if node_id not in docs or docs[node_id][0] != digest]
+    if stale:
+        conn.executemany('DELETE FROM search_index WHERE rowid = ?', stale)
+        conn.executemany('DELETE FROM search_docs WHERE rowid = ?', stale)
+    for node_id, (digest, fields) in docs.items():
+        if node_id in indexed and indexed[node_id][1] == digest:
+            continue
+        rowid = conn.execute(
+            'INSERT INTO search_docs (map_id, node_id, user_id, digest) VALUES (?, ?, ?, ?)',
+            (map_id, node_id, user_id, digest)
+        ).lastrowid
+        conn.execute('INSERT INTO search_index (rowid, title, text, body, tags) VALUES (?, ?, ?, ?, ?)', (rowid, *fields))
+
+
+def _drop_search_docs(conn, where, params):
+    conn.execute(f'DELETE FROM search_index WHERE rowid IN (SELECT rowid FROM search_docs WHERE {where})', params)
+    conn.execute(f'DELETE FROM search_docs WHERE {where}', params)
+
+
+@timed_job('search_rebuild')
+def rebuild_search_index(batch_size=100):
+    """Reindex every map from scratch and drop rows of maps that no longer
+    exist. One write transaction per batch, like reencode_map_data."""
+    stats = {'maps': 0, 'rows': 0}
+    for shard in _data_shards():
+        last = 0
+        while True:
+            conn = get_write_db(shard)
+            try:
+                rows = conn.execute(
+                    'SELECT rowid, id, title, data, user_id FROM maps WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last, batch_size)
+                ).fetchall()
+                for row in rows:
+                    docs = _search_docs(row['title'], _load_map_data(row['data']) if row['data'] else None)
+                    _drop_search_docs(conn, 'map_id = ?', (row['id'],))
+                    _update_search_index(conn, row['id'], row['user_id'], docs)
+                    stats['maps'] += 1
+                    stats['rows'] += len(docs)
+                if not rows:
+                    _drop_search_docs(conn, 'map_id NOT IN (SELECT id FROM maps)', ())
+                conn.commit()
+            finally:
+                conn.close()
+            if not rows:
+                break
+            last = rows[-1]['rowid']
+            time.sleep(0.001)  # let queued writers take the slot
+    return stats
+
+
+def _search_query(terms):
+    """FTS5 query for the words of a search: every word must match, the last
+    one as a prefix (search as you type)."""
+    return ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+
+
+def _fold(word):
+    """Case- and accent-insensitive form, like the index's tokenizer."""
+    return ''.join(c for c in unicodedata.normalize('NFKD', word.casefold()) if not unicodedata.combining(c))
+
+
+def _search_snippet(fields, terms):
+    """HTML excerpt of the first field matching terms, hits wrapped in <mark>.
+
+    Like _search_query, the last term matches as a prefix.
+    """
+    exact, prefix = {_fold(term) for term in terms[:-1]}, _fold(terms[-1])
+
+    def is_hit(word):
+        folded = _fold(word)
+        return folded in exact or folded.startswith(prefix)
+
+    for text in fields:
+        parts = _WORD_SPLIT_RE.split(text or '')
+        words = parts[1::2]  # split() puts the words at odd indexes
+        first = next((i for i, word in enumerate(words) if is_hit(word)), None)
+        if first is None:
+            continue
+        start = max(0, first - SEARCH_SNIPPET_WORDS // 3)
+        end = min(len(words), start + SEARCH_SNIPPET_WORDS)
+        out = ['…' if start else html.escape(parts[0])]
+        for i in range(start, end):
+            word = html.escape(words[i])
+            out.append(f'<mark>{word}</mark>' if is_hit(words[i]) else word)
+            if i + 1 < end:
+                out.append(html.escape(parts[2 * i + 2]))
+        out.append('…' if end < len(words) else html.escape(parts[-1]))
+        return ''.join(out)
+    return ''
+
+
+@app.route('/api/search', methods=['GET'])
+@requires_login
+def search_maps():
+    """Ranked search over the current user's maps: titles, node text, notes and tags."""
+    user = request.current_user
+    terms = _SEARCH_TERM_RE.findall(request.args.get('q') or '')
+    if not terms:
+        return jsonify({'error': 'Paramètre q requis'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({'error': 'limit et offset doivent être des entiers'}), 400
+    conn = get_db(_user_shard(user))
+    try:
+        rows = conn.execute(
+            """WITH recent AS (
+                   SELECT search_index.rowid AS rowid, d.map_id, d.node_id, m.title,
+                          bm25(search_index, 10.0, 4.0, 1.0, 2.0) AS score
+                   FROM search_index
+                   JOIN search_docs d ON d.rowid = search_index.rowid
+                   JOIN maps m ON m.id = d.map_id
+                   WHERE search_index MATCH ? AND d.user_id = ? AND (m.trashed IS NULL OR m.trashed = 0)
+                   ORDER BY search_index.rowid DESC LIMIT ?
+               )
+               SELECT rowid, map_id, node_id, title FROM recent ORDER BY score, rowid DESC LIMIT ? OFFSET ?""",
+            (_search_query(terms), user['id'], SEARCH_RANK_WINDOW, limit + 1, offset)
+        ).fetchall()
+        page = [row['rowid'] for row in rows[:limit]]
+        fields = {
+            row[0]: row[1:] for row in conn.execute(
+                f'SELECT rowid, title, text, body, tags FROM search_index WHERE rowid IN ({", ".join("?" * len(page))})',
+                page
+            )
+        } if page else {}
+    finally:
+        conn.close()
+    results = [{
+        'mapId': row['map_id'],
+        'nodeId': row['node_id'] or None,
+        'title': row['title'],
+        'snippet': _search_snippet(fields.get(row['rowid'], ()), terms),
+    } for row in rows[:limit]]
+    return jsonify({
+        'results': results,
+        'nextOffset': offset + limit if len(rows) > limit else None,
+    })
+
+
+# =============================================================================
+# IMAGE BLOBS
+# =============================================================================
+# Image payloads are pulled out of map JSON on save into a content-addressed
+# blobs table. In the stored map, node.media.dataUrl / originalDataUrl then
+# hold a reference URL (/api/blobs/<sha256>) instead of a base64 data: URL.
+# Blobs are immutable and public: the hash is unguessable without the image.
+
+BLOB_URL_PREFIX = '/api/blobs/'
+BLOB_MEDIA_FIELDS = ('dataUrl', 'originalDataUrl')
+BLOB_GC_GRACE_MS = 24 * 3600 * 1000  # never collect blobs younger than this
+# Raster types only: anything scriptable (SVG, HTML) stays inline in the map
+BLOB_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/avif', 'image/bmp'}
+_DATA_URL_RE = re.compile(r'^data:([\w.+/-]+)?(?:;[\w=.+-]+)*;base64,', re.ASCII)
+_BLOB_REF_RE = re.compile(re.escape(BLOB_URL_PREFIX) + r'([0-9a-f]{64})')
+
+
+def _extract_blobs(map_content, now):
+    """Move base64 media out of map_content (in place) into the blobs table.
+
+    Blobs are committed right away, in their own short write transaction:
+    storing one that ends up unused is harmless (see collect_blob_garbage).
+    Returns {node_id: {field: reference_url}} for the fields that were replaced.
+    """
+    extracted = {}
+    rows = []
+    if not isinstance(map_content, dict):
+        return extracted
+    for node_id, node in (map_content.get('nodes') or {}).items():
+        media = node.get('media') if isinstance(node, dict) else None
+        if not isinstance(media, dict):
+            continue
+        for field in BLOB_MEDIA_FIELDS:
+            value = media.get(field)
+            match = _DATA_URL_RE.match(value) if isinstance(value, str) else None
+            if not match or match.group(1) not in BLOB_MIME_TYPES:
+                continue
+            try:
+                payload = base64.b64decode(value[match.end():], validate=True)
+            except (binascii.Error, ValueError):
+                continue
+            blob_hash = hashlib.sha256(payload).hexdigest()
+            rows.append((blob_hash, match.group(1), payload, len(payload), now))
+            media[field] = BLOB_URL_PREFIX + blob_hash
+            extracted.setdefault(node_id, {})[field] = media[field]
+    if rows:
+        conn = get_write_db()
+        try:
+            conn.executemany(
+                'INSERT INTO blobs (hash, mime, data, size, created_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(hash) DO UPDATE SET created_at = excluded.created_at', rows
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    return extracted
+
+
+def _inline_blobs(map_content):
+    """Replace blob references in map_content (in place) with data: URLs, for exports."""
+    if not isinstance(map_content, dict):
+        return map_content
+    conn = get_db()  # blobs live in the catalog
+    try:
+        for node in (map_content.get('nodes') or {}).values():
+            media = node.get('media') if isinstance(node, dict) else None
+            if not isinstance(media, dict):
+                continue
+            for field in BLOB_MEDIA_FIELDS:
+                value = media.get(field)
+                match = _BLOB_REF_RE.fullmatch(value) if isinstance(value, str) else None
+                if not match:
+                    continue
+                row = conn.execute('SELECT mime, data FROM blobs WHERE hash = ?', (match.group(1),)).fetchone()
+                if row:
+                    media[field] = f"data:{row['mime']};base64,{base64.b64encode(row['data']).decode('ascii')}"
+    finally:
+        conn.close()
+    return map_content
+
+
+def _collect_blob_refs(conn, referenced):
+    for table in ('maps', 'map_versions'):
+        for (raw,) in conn.execute(f'SELECT data FROM {table}'):
+            if raw is not None:
+                referenced.update(_BLOB_REF_RE.findall(_decode_data(raw)))
+
+
+@timed_job('blob_gc')
+def collect_blob_garbage(now=None):
+    """Delete blobs referenced by no map or version. Returns the number removed."""
+    now = now if now is not None else int(time.time() * 1000)
+    referenced = set()
+    # Per-user files are scanned before taking the catalog's write slot. A
+    # blob a save starts using meanwhile is safe: _extract_blobs refreshes
+    # created_at even when the blob already exists (grace period), or
+    # re-inserts it after this transaction
+    for shard in _data_shards()[1:]:
+        conn = get_db(shard)
+        try:
+            _collect_blob_refs(conn, referenced)
+        finally:
+            conn.close()
+    conn = get_write_db()
+    try:
+        _collect_blob_refs(conn, referenced)
+        stale = [
+            row['hash'] for row in conn.execute(
+                'SELECT hash FROM blobs WHERE created_at < ?', (now - BLOB_GC_GRACE_MS,)
+            )
+            if row['hash'] not in referenced
+        ]
+        conn.executemany('DELETE FROM blobs WHERE hash = ?', [(h,) for h in stale])
+        conn.commit()
+        return len(stale)
+    finally:
+        conn.close()
+
+
+@app.route('/api/blobs/<blob_hash>', methods=['GET'])
+def get_blob(blob_hash):
+    """Serve an image blob (no auth required; content-addressed and immutable)."""
+    if not re.fullmatch(r'[0-9a-f]{64}', blob_hash):
+        return jsonify({'error': 'Not found'}), 404
+    etag = f'"{blob_hash}"'
+    cache_control = 'public, max-age=31536000, immutable'
+    not_modified = _not_modified(etag, cache_control)
+    if not_modified:
+        return not_modified
     conn = get_db()
-    row = conn.execute('SELECT data, title FROM maps WHERE share_token = ? AND (trashed IS NULL OR trashed = 0)', (token,)).fetchone()
+    row = conn.execute('SELECT mime, data FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()
     conn.close()
     if not row:
-        return jsonify({'error': 'Carte introuvable ou partage désactivé'}), 404
-    map_data = _load_map_data(row['data'])
-    return jsonify({'map': map_data, 'title': row['title']})
+        return jsonify({'error': 'Not found'}), 404
+    return Response(row['data'], mimetype=row['mime'], headers={
+        'ETag': etag,
+        'Cache-Control': cache_control,
+        'X-Content-Type-Options': 'nosniff',
+        'Content-Security-Policy': "default-src 'none'",
+    })
 
 
 @app.route('/s/<token>')
@@ -1171,9 +4213,77 @@ def _delete_node_recursive(map_data, node_id):
     del map_data['nodes'][node_id]
 
 
+# =============================================================================
+# MAP DATA ENCODING
+# =============================================================================
+# maps.data and map_versions.data hold either plain JSON text (rows written
+# before compression, or too small to be worth it) or a BLOB whose first byte
+# is the marker of the codec that produced the rest. Reads accept every
+# registered codec, writes use MAP_DATA_CODEC ('none' keeps plain text).
+
+MAP_DATA_CODEC = os.environ.get('MAP_DATA_CODEC', 'zlib')
+MAP_DATA_ZLIB_LEVEL = int(os.environ.get('MAP_DATA_ZLIB_LEVEL', 6))
+MAP_DATA_MIN_COMPRESS = 256  # bytes; smaller payloads (most deltas) stay plain
+
+_CODECS = {}  # name -> (marker, compress)
+_DECOMPRESSORS = {}  # marker -> decompress
+
+
+def register_codec(name, marker, compress, decompress):
+    """Make a codec available for MAP_DATA_CODEC. Markers must never be reused."""
+    _CODECS[name] = (marker, compress)
+    _DECOMPRESSORS[marker] = decompress
+
+
+register_codec('zlib', 0x01, lambda b: zlib.compress(b, MAP_DATA_ZLIB_LEVEL), zlib.decompress)
+register_codec('lzma', 0x02, lzma.compress, lzma.decompress)
+try:
+    from compression import zstd  # Python 3.14+
+    register_codec('zstd', 0x03, zstd.compress, zstd.decompress)
+except ImportError:
+    pass
+
+
+def _encode_data(text):
+    """Encode JSON text for a data column."""
+    codec = _CODECS.get(MAP_DATA_CODEC)
+    if codec is None or len(text) < MAP_DATA_MIN_COMPRESS:
+        return text
+    marker, compress = codec
+    return bytes((marker,)) + compress(text.encode('utf-8'))
+
+
+def _decode_data(raw):
+    """Return the JSON text stored in a data column, whatever its encoding."""
+    if isinstance(raw, bytes):
+        return _decode_data_bytes(raw).decode('utf-8')
+    return raw
+
+
+def _decode_data_bytes(raw):
+    """Same as _decode_data but UTF-8 encoded, as a response body wants it."""
+    if isinstance(raw, bytes):
+        decompress = _DECOMPRESSORS.get(raw[0])
+        if decompress is None:
+            raise ValueError(f'Unknown map data codec marker 0x{raw[0]:02x}')
+        return decompress(raw[1:])
+    return raw.encode('utf-8')
+
+
+def _stored_size(raw):
+    return len(raw) if isinstance(raw, bytes) else len(raw.encode('utf-8'))
+
+
+def _load_json(raw):
+    return _json_loads(_decode_data(raw))
+
+
 def _load_map_data(raw_data):
-    """Load map data from DB, handling both dict and double-encoded string formats."""
-    data = json.loads(raw_data)
+    """Load map data from DB, handling both dict and double-encoded string formats.
+
+    Double-encoded rows only predate schema version 8 (normalize_map_data).
+    """
+    data = _load_json(raw_data)
     if isinstance(data, str):
         data = json.loads(data)
     return data
@@ -1181,7 +4291,307 @@ def _load_map_data(raw_data):
 
 def _save_map_data(map_data, original_raw=None):
     """Serialize map data for DB storage. Always uses single encoding."""
-    return json.dumps(map_data)
+    return _encode_data(_json_dumps(map_data))
+
+
+def _map_response(raw, **fields):
+    """JSON response {"map": <stored map>, **fields} without parsing the map.
+
+    The stored text is already the JSON of the map object, so it is copied
+    into the envelope as is. A row that is still double-encoded goes
+    through _load_map_data instead.
+    """
+    body = _decode_data_bytes(raw)
+    if body[:1] != b'{':
+        body = json.dumps(_load_map_data(raw)).encode('utf-8')
+    parts = [b'{"map":', body]
+    for key, value in fields.items():
+        parts.append(f',{json.dumps(key)}:{json.dumps(value)}'.encode('utf-8'))
+    parts.append(b'}')
+    return Response(b''.join(parts), mimetype='application/json')
+
+
+def normalize_map_data(conn, batch_size=200):
+    """Rewrite double-encoded maps rows (a JSON string holding the map JSON)
+    as the map JSON itself. Returns the number of rows rewritten."""
+    rewritten = 0
+    last = 0
+    while True:
+        rows = conn.execute(
+            'SELECT rowid, data FROM maps WHERE rowid > ? ORDER BY rowid LIMIT ?', (last, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        for rowid, raw in rows:
+            if raw is None or _decode_data_bytes(raw)[:1] == b'{':
+                continue
+            data = _load_map_data(raw)
+            if not isinstance(data, dict):
+                continue
+            conn.execute('UPDATE maps SET data = ? WHERE rowid = ?', (_save_map_data(data), rowid))
+            rewritten += 1
+        last = rows[-1][0]
+    return rewritten
+
+
+def normalize_version_data(conn, batch_size=200):
+    """Rewrite the history of maps whose version keyframes are double-encoded.
+
+    Every version of such a map is rebuilt, its value decoded to the map
+    object, and the history re-encoded as keyframes + deltas, so that new
+    deltas (diffs between map objects) apply to it. Returns the number of
+    maps rewritten.
+    """
+    stale = set()
+    last = 0
+    while True:
+        rows = conn.execute(
+            'SELECT id, map_id, data FROM map_versions WHERE base_id IS NULL AND id > ? ORDER BY id LIMIT ?',
+            (last, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        for version_id, map_id, raw in rows:
+            if raw is not None and _decode_data_bytes(raw)[:1] != b'{':
+                stale.add(map_id)
+        last = rows[-1][0]
+    for map_id in sorted(stale):
+        content = None
+        for row in conn.execute(
+            'SELECT id, base_id, data FROM map_versions WHERE map_id = ? ORDER BY id', (map_id,)
+        ).fetchall():
+            data = _load_json(row['data'])
+            content = data if row['base_id'] is None else _json_patch(content, data)
+            value = json.loads(content) if isinstance(content, str) else content
+            serialized = _json_dumps(value)
+            conn.execute(
+                'UPDATE map_versions SET data = ?, base_id = NULL, content_hash = ? WHERE id = ?',
+                (_encode_data(serialized), _content_hash(serialized), row['id'])
+            )
+        _encode_version_history(conn, map_id)
+    return len(stale)
+
+
+@timed_job('reencode')
+def reencode_map_data(batch_size=200):
+    """Rewrite every data column with the current MAP_DATA_CODEC.
+
+    Works in small batches, each its own write transaction, so it can run
+    next to live traffic.
+    """
+    stats = {'rows': 0, 'rewritten': 0, 'bytes_before': 0, 'bytes_after': 0}
+    for shard, table in ((shard, table) for shard in _data_shards() for table in ('maps', 'map_versions')):
+        last = 0
+        while True:
+            # One write slot per batch so saves get their turn in between
+            conn = get_write_db(shard)
+            try:
+                rows = conn.execute(
+                    f'SELECT rowid, data FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last, batch_size)
+                ).fetchall()
+                for rowid, raw in rows:
+                    if raw is None:
+                        continue
+                    encoded = _encode_data(_decode_data(raw))
+                    stats['rows'] += 1
+                    stats['bytes_before'] += _stored_size(raw)
+                    if encoded != raw:
+                        conn.execute(f'UPDATE {table} SET data = ? WHERE rowid = ?', (encoded, rowid))
+                        stats['rewritten'] += 1
+                        raw = encoded
+                    stats['bytes_after'] += _stored_size(raw)
+                conn.commit()
+            finally:
+                conn.close()
+            if not rows:
+                break
+            last = rows[-1][0]
+            time.sleep(0.001)  # let queued writers take the slot
+    return stats
+
+
+# Inject reads and edits the map outside the write slot, like PATCH, then
+# writes it only if the revision is still the one it read. Automation sends
+# no baseRevision, so on a concurrent save the operations are applied again
+# to the new content, up to INJECT_RETRIES times, before answering 409.
+INJECT_RETRIES = 3
+
+
+def _apply_inject_operations(map_data, operations):
+    """Apply inject operations to map_data in place.
+
+    Returns (applied, skipped, errors, node_ids).
+    """
+    applied = 0
+    skipped = 0
+    errors = []
+    node_ids = {}
+
+    for i, op_data in enumerate(operations):
+        try:
+            op = op_data.get('op')
+
+            if op == 'add_child':
+                parent_id = op_data['parent']
+                if parent_id not in map_data.get('nodes', {}):
+                    raise ValueError(f"Parent '{parent_id}' not found")
+                node_id = op_data.get('id') or _generate_node_id(map_data)
+                if node_id in map_data['nodes']:
+                    skipped += 1
+                    continue
+                map_data['nodes'][node_id] = {
+                    'id': node_id,
+                    'parentId': parent_id,
+                    'text': op_data.get('text', 'Node'),
+                    'children': [],
+                    'color': op_data.get('color'),
+                    'tags': op_data.get('tags', [])
+                }
+                map_data['nodes'][parent_id].setdefault('children', []).append(node_id)
+                node_ids[node_id] = node_id
+
+            elif op == 'add_sibling':
+                ref_id = op_data['sibling_of']
+                ref_node = map_data['nodes'].get(ref_id)
+                if not ref_node or not ref_node.get('parentId'):
+                    raise ValueError(f"Node '{ref_id}' not found or is root")
+                parent_id = ref_node['parentId']
+                node_id = op_data.get('id') or _generate_node_id(map_data)
+                if node_id in map_data['nodes']:
+                    skipped += 1
+                    continue
+                map_data['nodes'][node_id] = {
+                    'id': node_id,
+                    'parentId': parent_id,
+                    'text': op_data.get('text', 'Node'),
+                    'children': [],
+                    'color': op_data.get('color'),
+                    'tags': op_data.get('tags', [])
+                }
+                siblings = map_data['nodes'][parent_id].setdefault('children', [])
+                idx = siblings.index(ref_id) + 1 if ref_id in siblings else len(siblings)
+                siblings.insert(idx, node_id)
+                node_ids[node_id] = node_id
+
+            elif op == 'add_free_bubble':
+                node_id = op_data.get('id') or _generate_node_id(map_data)
+                if node_id in map_data.get('nodes', {}):
+                    skipped += 1
+                    continue
+                map_data['nodes'][node_id] = {
+                    'id': node_id,
+                    'parentId': None,
+                    'text': op_data.get('text', 'Note'),
+                    'children': [],
+                    'nodeType': 'bubble',
+                    'placement': 'free',
+                    'fx': op_data.get('fx', 0),
+                    'fy': op_data.get('fy', 0),
+                    'color': op_data.get('color', '#fef3c7'),
+                    'tags': op_data.get('tags', [])
+                }
+                node_ids[node_id] = node_id
+
+            elif op == 'add_card':
+                node_id = op_data.get('id') or _generate_node_id(map_data)
+                if node_id in map_data.get('nodes', {}):
+                    skipped += 1
+                    continue
+                map_data['nodes'][node_id] = {
+                    'id': node_id,
+                    'parentId': None,
+                    'text': op_data.get('text', 'Sans titre'),
+                    'children': [],
+                    'nodeType': 'card',
+                    'placement': 'free',
+                    'fx': op_data.get('fx', 0),
+                    'fy': op_data.get('fy', 0),
+                    'color': op_data.get('color', '#ffffff'),
+                    'body': op_data.get('body', ''),
+                    'cardWidth': op_data.get('cardWidth', 280),
+                    'cardExpanded': bool(op_data.get('cardExpanded', False)),
+                    'tags': op_data.get('tags', [])
+                }
+                node_ids[node_id] = node_id
+
+            elif op == 'add_link':
+                if 'links' not in map_data:
+                    map_data['links'] = []
+                from_id = op_data['from']
+                to_id = op_data['to']
+                if any(l['from'] == from_id and l['to'] == to_id for l in map_data['links']):
+                    skipped += 1
+                    continue
+                link_id = f'l{int(time.time() * 1000)}{i}'
+                map_data['links'].append({
+                    'id': link_id,
+                    'from': from_id,
+                    'to': to_id,
+                    'label': op_data.get('label', ''),
+                    'color': op_data.get('color', '#94a3b8'),
+                    'style': op_data.get('style', 'dashed')
+                })
+
+            elif op == 'add_frame':
+                if 'frames' not in map_data:
+                    map_data['frames'] = []
+                frame_id = op_data.get('id') or f'f{int(time.time() * 1000)}'
+                if any(f['id'] == frame_id for f in map_data['frames']):
+                    skipped += 1
+                    continue
+                map_data['frames'].append({
+                    'id': frame_id,
+                    'title': op_data.get('title', 'Zone'),
+                    'color': op_data.get('color', '#dbeafe'),
+                    'x': op_data.get('x', 0),
+                    'y': op_data.get('y', 0),
+                    'w': op_data.get('w', 400),
+                    'h': op_data.get('h', 300)
+                })
+
+            elif op == 'add_tag':
+                map_data.setdefault('settings', {}).setdefault('tags', [])
+                tag_id = op_data['id']
+                if any(t['id'] == tag_id for t in map_data['settings']['tags']):
+                    skipped += 1
+                    continue
+                map_data['settings']['tags'].append({
+                    'id': tag_id,
+                    'name': op_data.get('label', ''),
+                    'color': op_data.get('color', '#94a3b8')
+                })
+
+            elif op == 'update_node':
+                node_id = op_data['id']
+                node = map_data['nodes'].get(node_id)
+                if not node:
+                    raise ValueError(f"Node '{node_id}' not found")
+                for key in ('text', 'body', 'tags', 'color'):
+                    if key in op_data:
+                        node[key] = op_data[key]
+
+            elif op == 'delete_node':
+                node_id = op_data['id']
+                if node_id not in map_data.get('nodes', {}) or node_id == map_data.get('rootId'):
+                    skipped += 1
+                    continue
+                _delete_node_recursive(map_data, node_id)
+                if 'links' in map_data:
+                    map_data['links'] = [l for l in map_data['links']
+                                         if l['from'] != node_id and l['to'] != node_id]
+
+            else:
+                raise ValueError(f"Unknown operation '{op}'")
+
+            applied += 1
+
+        except Exception as e:
+            skipped += 1
+            err_msg = f'{type(e).__name__}: {e}'
+            errors.append({'index': i, 'op': op_data.get('op'), 'error': err_msg})
+
+    return applied, skipped, errors, node_ids
 
 
 @app.route('/api/maps/<map_id>/inject', methods=['POST'])
@@ -1189,9 +4599,17 @@ def _save_map_data(map_data, original_raw=None):
 def inject_operations(map_id):
     """Batch operations on a map (for AI injection)."""
     user = request.current_user
-    conn = get_db()
-    try:
-        row = conn.execute('SELECT data, user_id FROM maps WHERE id = ?', (map_id,)).fetchone()
+    shard = _map_shard(map_id, user)
+    operations = None
+    for _ in range(INJECT_RETRIES + 1):
+        conn = get_db(shard)
+        try:
+            with timing_span('db'):
+                row = conn.execute(
+                    'SELECT title, data, updated_at, user_id, revision FROM maps WHERE id = ?', (map_id,)
+                ).fetchone()
+        finally:
+            conn.close()
 
         if not row:
             return jsonify({'error': 'Map not found'}), 404
@@ -1199,196 +4617,60 @@ def inject_operations(map_id):
         if row['user_id'] != user['id'] and not user.get('is_admin'):
             return jsonify({'error': 'Accès refusé'}), 403
 
-        raw_data = row['data']
-        map_data = _load_map_data(raw_data)
-        operations = request.get_json().get('operations', [])
-
-        applied = 0
-        skipped = 0
-        errors = []
-        node_ids = {}
-
-        for i, op_data in enumerate(operations):
-            try:
-                op = op_data.get('op')
-
-                if op == 'add_child':
-                    parent_id = op_data['parent']
-                    if parent_id not in map_data.get('nodes', {}):
-                        raise ValueError(f"Parent '{parent_id}' not found")
-                    node_id = op_data.get('id') or _generate_node_id(map_data)
-                    if node_id in map_data['nodes']:
-                        skipped += 1
-                        continue
-                    map_data['nodes'][node_id] = {
-                        'id': node_id,
-                        'parentId': parent_id,
-                        'text': op_data.get('text', 'Node'),
-                        'children': [],
-                        'color': op_data.get('color'),
-                        'tags': op_data.get('tags', [])
-                    }
-                    map_data['nodes'][parent_id].setdefault('children', []).append(node_id)
-                    node_ids[node_id] = node_id
-
-                elif op == 'add_sibling':
-                    ref_id = op_data['sibling_of']
-                    ref_node = map_data['nodes'].get(ref_id)
-                    if not ref_node or not ref_node.get('parentId'):
-                        raise ValueError(f"Node '{ref_id}' not found or is root")
-                    parent_id = ref_node['parentId']
-                    node_id = op_data.get('id') or _generate_node_id(map_data)
-                    if node_id in map_data['nodes']:
-                        skipped += 1
-                        continue
-                    map_data['nodes'][node_id] = {
-                        'id': node_id,
-                        'parentId': parent_id,
-                        'text': op_data.get('text', 'Node'),
-                        'children': [],
-                        'color': op_data.get('color'),
-                        'tags': op_data.get('tags', [])
-                    }
-                    siblings = map_data['nodes'][parent_id].setdefault('children', [])
-                    idx = siblings.index(ref_id) + 1 if ref_id in siblings else len(siblings)
-                    siblings.insert(idx, node_id)
-                    node_ids[node_id] = node_id
-
-                elif op == 'add_free_bubble':
-                    node_id = op_data.get('id') or _generate_node_id(map_data)
-                    if node_id in map_data.get('nodes', {}):
-                        skipped += 1
-                        continue
-                    map_data['nodes'][node_id] = {
-                        'id': node_id,
-                        'parentId': None,
-                        'text': op_data.get('text', 'Note'),
-                        'children': [],
-                        'nodeType': 'bubble',
-                        'placement': 'free',
-                        'fx': op_data.get('fx', 0),
-                        'fy': op_data.get('fy', 0),
-                        'color': op_data.get('color', '#fef3c7'),
-                        'tags': op_data.get('tags', [])
-                    }
-                    node_ids[node_id] = node_id
-
-                elif op == 'add_card':
-                    node_id = op_data.get('id') or _generate_node_id(map_data)
-                    if node_id in map_data.get('nodes', {}):
-                        skipped += 1
-                        continue
-                    map_data['nodes'][node_id] = {
-                        'id': node_id,
-                        'parentId': None,
-                        'text': op_data.get('text', 'Sans titre'),
-                        'children': [],
-                        'nodeType': 'card',
-                        'placement': 'free',
-                        'fx': op_data.get('fx', 0),
-                        'fy': op_data.get('fy', 0),
-                        'color': op_data.get('color', '#ffffff'),
-                        'body': op_data.get('body', ''),
-                        'cardWidth': op_data.get('cardWidth', 280),
-                        'cardExpanded': bool(op_data.get('cardExpanded', False)),
-                        'tags': op_data.get('tags', [])
-                    }
-                    node_ids[node_id] = node_id
-
-                elif op == 'add_link':
-                    if 'links' not in map_data:
-                        map_data['links'] = []
-                    from_id = op_data['from']
-                    to_id = op_data['to']
-                    if any(l['from'] == from_id and l['to'] == to_id for l in map_data['links']):
-                        skipped += 1
-                        continue
-                    link_id = f'l{int(time.time() * 1000)}{i}'
-                    map_data['links'].append({
-                        'id': link_id,
-                        'from': from_id,
-                        'to': to_id,
-                        'label': op_data.get('label', ''),
-                        'color': op_data.get('color', '#94a3b8'),
-                        'style': op_data.get('style', 'dashed')
-                    })
-
-                elif op == 'add_frame':
-                    if 'frames' not in map_data:
-                        map_data['frames'] = []
-                    frame_id = op_data.get('id') or f'f{int(time.time() * 1000)}'
-                    if any(f['id'] == frame_id for f in map_data['frames']):
-                        skipped += 1
-                        continue
-                    map_data['frames'].append({
-                        'id': frame_id,
-                        'title': op_data.get('title', 'Zone'),
-                        'color': op_data.get('color', '#dbeafe'),
-                        'x': op_data.get('x', 0),
-                        'y': op_data.get('y', 0),
-                        'w': op_data.get('w', 400),
-                        'h': op_data.get('h', 300)
-                    })
-
-                elif op == 'add_tag':
-                    map_data.setdefault('settings', {}).setdefault('tags', [])
-                    tag_id = op_data['id']
-                    if any(t['id'] == tag_id for t in map_data['settings']['tags']):
-                        skipped += 1
-                        continue
-                    map_data['settings']['tags'].append({
-                        'id': tag_id,
-                        'name': op_data.get('label', ''),
-                        'color': op_data.get('color', '#94a3b8')
-                    })
-
-                elif op == 'update_node':
-                    node_id = op_data['id']
-                    node = map_data['nodes'].get(node_id)
-                    if not node:
-                        raise ValueError(f"Node '{node_id}' not found")
-                    for key in ('text', 'body', 'tags', 'color'):
-                        if key in op_data:
-                            node[key] = op_data[key]
-
-                elif op == 'delete_node':
-                    node_id = op_data['id']
-                    if node_id not in map_data.get('nodes', {}) or node_id == map_data.get('rootId'):
-                        skipped += 1
-                        continue
-                    _delete_node_recursive(map_data, node_id)
-                    if 'links' in map_data:
-                        map_data['links'] = [l for l in map_data['links']
-                                             if l['from'] != node_id and l['to'] != node_id]
-
-                else:
-                    raise ValueError(f"Unknown operation '{op}'")
+        with timing_span('decode'):
+            map_data = _load_map_data(row['data'])
+            if operations is None:
+                operations = request.get_json().get('operations', [])
 
-                applied += 1
+        applied, skipped, errors, node_ids = _apply_inject_operations(map_data, operations)
 
-            except Exception as e:
-                skipped += 1
-                err_msg = f'{type(e).__name__}: {e}'
-                print(f'[INJECT] op#{i} ({op_data.get("op")}) failed: {err_msg}', flush=True)
-                errors.append({'index': i, 'op': op_data.get('op'), 'error': err_msg})
-
-        # Save
-        map_data['updatedAt'] = int(time.time() * 1000)
-        serialized = _save_map_data(map_data, raw_data)
-        conn.execute('UPDATE maps SET data = ?, updated_at = ? WHERE id = ?',
-                     (serialized, map_data['updatedAt'], map_id))
-        conn.commit()
+        now = int(time.time() * 1000)
+        map_data['updatedAt'] = now
+        with timing_span('serialize'):
+            serialized = _json_dumps(map_data)
+            stored = _encode_data(serialized)
+            search_docs = _search_docs(row['title'], map_data)
+        revision = row['revision'] + 1
+
+        with timing_span('lock'):
+            conn = get_write_db(shard)
+        try:
+            with timing_span('write'):
+                cursor = conn.execute(
+                    'UPDATE maps SET data = ?, updated_at = ?, revision = ? WHERE id = ? AND revision = ?',
+                    (stored, now, revision, map_id, row['revision'])
+                )
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    continue  # saved meanwhile: apply the operations to the new content
+                versions_keep = int(os.environ.get('MAP_VERSIONS_KEEP', 50))
+                if _record_version(conn, map_id, map_data, serialized, now, (row['data'], row['updated_at']), stored):
+                    _thin_versions(conn, map_id, now)
+                    _trim_versions(conn, map_id, versions_keep)
+                _update_search_index(conn, map_id, row['user_id'], search_docs)
+            with timing_span('commit'):
+                conn.commit()
+        finally:
+            conn.close()
 
+        if errors:
+            _log_event('inject_errors', map=map_id, errors=errors)
         result = {
             'ok': True,
             'map_id': map_id,
+            'revision': revision,
             'operations_applied': applied,
             'operations_skipped': skipped,
             'node_ids': node_ids
         }
         if errors:
             result['errors'] = errors
-        return jsonify(result)
+        with timing_span('encode'):
+            return jsonify(result)
+
+    conn = get_db(shard)
+    try:
+        return _revision_conflict(_current_revision(conn, map_id))
     finally:
         conn.close()
 
@@ -1398,9 +4680,10 @@ def inject_operations(map_id):
 def map_outline(map_id):
     """Return a simplified outline view of a map (for AI context)."""
     user = request.current_user
-    conn = get_db()
+    conn = get_db(_map_shard(map_id, user))
     try:
-        row = conn.execute('SELECT data, title, user_id FROM maps WHERE id = ?', (map_id,)).fetchone()
+        with timing_span('db'):
+            row = conn.execute('SELECT data, title, user_id FROM maps WHERE id = ?', (map_id,)).fetchone()
 
         if not row:
             return jsonify({'error': 'Map not found'}), 404
@@ -1410,7 +4693,8 @@ def map_outline(map_id):
     finally:
         conn.close()
 
-    map_data = _load_map_data(row['data'])
+    with timing_span('decode'):
+        map_data = _load_map_data(row['data'])
     nodes = map_data.get('nodes', {})
 
     # Build indented tree outline
@@ -1425,7 +4709,8 @@ def map_outline(map_id):
         return line
 
     root_id = map_data.get('rootId', '')
-    tree_text = build_tree(root_id).strip()
+    with timing_span('outline'):
+        tree_text = build_tree(root_id).strip()
 
     # Collect free bubbles and cards
     free_bubbles = []
@@ -1446,15 +4731,110 @@ def map_outline(map_id):
         else:
             free_bubbles.append(entry)
 
-    return jsonify({
-        'map_id': map_id,
-        'title': row['title'],
-        'tree': tree_text,
-        'free_bubbles': free_bubbles,
-        'cards': cards,
-        'frames': map_data.get('frames', []),
-        'tags': map_data.get('settings', {}).get('tags', [])
-    })
+    with timing_span('encode'):
+        return jsonify({
+            'map_id': map_id,
+            'title': row['title'],
+            'tree': tree_text,
+            'free_bubbles': free_bubbles,
+            'cards': cards,
+            'frames': map_data.get('frames', []),
+            'tags': map_data.get('settings', {}).get('tags', [])
+        })
+
+
+# =============================================================================
+# RESPONSE COMPRESSION
+# =============================================================================
+# JSON responses above COMPRESS_MIN_SIZE are compressed on the way out with
+# the best encoding the client accepts. Levels are kept low so a large map
+# costs milliseconds, not the worker. Static text files are compressed once
+# at maximum level into .br/.gz files next to the original, refreshed when
+# the original changes.
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 5))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+COMPRESSIBLE_TYPES = ('application/json',)
+STATIC_COMPRESSIBLE = ('.js', '.css', '.html', '.svg', '.json', '.md')
+
+# encoding -> (response compressor, static file compressor, file suffix), in order of preference
+_COMPRESSORS = {}
+if brotli is not None:
+    _COMPRESSORS['br'] = (
+        lambda data: brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY),
+        lambda data: brotli.compress(data, quality=11),
+        '.br',
+    )
+_COMPRESSORS['gzip'] = (
+    lambda data: gzip.compress(data, COMPRESS_GZIP_LEVEL, mtime=0),
+    lambda data: gzip.compress(data, 9, mtime=0),
+    '.gz',
+)
+
+
+def _accepted_encoding():
+    """Best encoding from _COMPRESSORS allowed by Accept-Encoding, or None."""
+    encoding = request.accept_encodings.best_match(list(_COMPRESSORS))
+    return encoding if encoding in _COMPRESSORS else None
+
+
+@app.after_request
+def _compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _accepted_encoding()
+    if encoding is None:
+        return response
+    response.set_data(_COMPRESSORS[encoding][0](data))
+    response.headers['Content-Encoding'] = encoding
+    # Each encoding is a different representation: give it its own strong ETag
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+
+def _precompressed_variant(path, encoding):
+    """Path (relative to the static folder) of an up-to-date compressed copy
+    of path, creating it if needed; None if it cannot be written."""
+    source = safe_join(app.static_folder, path)
+    if source is None or not os.path.isfile(source):
+        return None
+    target = source + _COMPRESSORS[encoding][2]
+    try:
+        if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(source):
+            with open(source, 'rb') as f:
+                compressed = _COMPRESSORS[encoding][1](f.read())
+            tmp = f'{target}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp, target)
+    except OSError as e:
+        print(f"[STATIC] Cannot precompress {path}: {e}", flush=True)
+        return None
+    return path + _COMPRESSORS[encoding][2]
+
+
+def _send_static(path):
+    """send_from_directory, preferring a precompressed variant of text files."""
+    if not path.endswith(STATIC_COMPRESSIBLE):
+        return send_from_directory(app.static_folder, path)
+    encoding = _accepted_encoding()
+    variant = _precompressed_variant(path, encoding) if encoding else None
+    if variant is None:
+        response = send_from_directory(app.static_folder, path)
+    else:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        response = send_from_directory(app.static_folder, variant, mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 # =============================================================================
@@ -1465,7 +4845,7 @@ def map_outline(map_id):
 @requires_login
 def index():
     """Serve the main application."""
-    return send_from_directory(app.static_folder, 'index.html')
+    return _send_static('index.html')
 
 
 @app.route('/<path:path>')
@@ -1474,21 +4854,23 @@ def static_files(path):
     # Don't serve files from api/ path
     if path.startswith('api/'):
         return jsonify({'error': 'Not found'}), 404
-    # Block access to server directory and dotfiles
+    # Block access to server directory, dotfiles and request profiles
     if path.startswith('server/') or path.startswith('.'):
         return jsonify({'error': 'Not found'}), 404
+    if os.path.realpath(os.path.join(app.static_folder, path)).startswith(os.path.realpath(PROFILE_DIR) + os.sep):
+        return jsonify({'error': 'Not found'}), 404
     # Login page and its assets are public
     if path in ('login.html', 'shared.html'):
-        return send_from_directory(app.static_folder, path)
+        return _send_static(path)
     # Static assets — allowlist of known public directories/files
     ALLOWED_STATIC = ('src/', 'styles.css', 'favicon.svg', 'favicon.ico')
     if any(path == a or path.startswith(a) for a in ALLOWED_STATIC):
-        return send_from_directory(app.static_folder, path)
+        return _send_static(path)
     # Everything else requires login
     user = get_current_user()
     if not user:
         return redirect('/login')
-    return send_from_directory(app.static_folder, path)
+    return _send_static(path)
 
 
 # ── R2 Backup (serverless-compatible) ─────────────────────────
@@ -1514,12 +4896,23 @@ def _maybe_backup_r2():
     if now - _last_backup_time < BACKUP_INTERVAL:
         return
     _last_backup_time = now  # reserve slot immediately
+    # Only one worker per interval: the others see the claim and skip
+    if not _claim_job('r2_backup', min_interval_ms=BACKUP_INTERVAL * 1000):
+        return
     _backup_running = True
-    t = threading.Thread(target=_run_r2_backup, daemon=True)
+    t = threading.Thread(target=_run_claimed_r2_backup, daemon=True)
     t.start()
 
+
+def _run_claimed_r2_backup():
+    try:
+        _run_r2_backup()
+    finally:
+        _finish_job('r2_backup', {'finished': True})
+
+@timed_job('r2_backup')
 def _run_r2_backup():
-    """Execute R2 backup in background thread."""
+    """Execute R2 backup in background thread. False if it failed or was skipped."""
     global _backup_running
     try:
         import boto3
@@ -1527,7 +4920,7 @@ def _run_r2_backup():
     except ImportError:
         print('[R2 BACKUP] boto3 not installed, skipping', flush=True)
         _backup_running = False
-        return
+        return False
 
     r2_endpoint = os.environ.get('R2_ENDPOINT_URL')
     r2_access_key = os.environ.get('R2_ACCESS_KEY_ID')
@@ -1538,10 +4931,9 @@ def _run_r2_backup():
     if not r2_access_key or not r2_secret_key:
         print('[R2 BACKUP] Missing R2 credentials, skipping', flush=True)
         _backup_running = False
-        return
+        return False
 
     try:
-        import tempfile
         db_path = os.path.abspath(DB_PATH)
         tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
         tmp.close()
@@ -1558,6 +4950,8 @@ def _run_r2_backup():
             dst_conn.close()
         src_conn.close()
 
+        if DB_SHARD_DIR:
+            _merge_shards_into(tmp.name)
         _strip_versions_from_backup(tmp.name)
 
         s3 = boto3.client(
@@ -1591,6 +4985,7 @@ def _run_r2_backup():
         _cleanup_old_backups(s3, r2_bucket, base, retention_days)
     except Exception as e:
         print(f'[R2 BACKUP] Error: {e}', flush=True)
+        return False
     finally:
         _backup_running = False
 
@@ -1614,5 +5009,14 @@ def _cleanup_old_backups(s3, bucket, prefix, retention_days):
 init_db()
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate-shards']:
+        print(f"[SHARDS] Done: {migrate_to_shards()}", flush=True)
+        sys.exit(0)
+    if sys.argv[1:] == ['rebuild-search']:
+        print(f"[SEARCH] Rebuilt: {rebuild_search_index()}", flush=True)
+        sys.exit(0)
+    if sys.argv[1:] == ['check-counters']:
+        print(f"[COUNTERS] Done: {check_all_counters()}", flush=True)
+        sys.exit(0)
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -116,7 +116,7 @@ function injectExportStyles(svg) {
 /**
  * Export map as PNG image
  */
-export function exportImage(svgElement, map, pan) {
+export async function exportImage(svgElement, map, pan) {
     const svg = svgElement.cloneNode(true);
     const viewport = svg.querySelector('#viewport');
 
@@ -156,6 +156,8 @@ export function exportImage(svgElement, map, pan) {
     injectExportStyles(svg);
     // Remove selection highlight
     svg.querySelectorAll('.selected').forEach(el => el.classList.remove('selected'));
+    // Server-stored images must be embedded: an SVG rendered as an image can't fetch them
+    await inlineSvgImages(svg);
     // Strip any non-data-URL image hrefs — they taint the canvas and cause toBlob to return null
     svg.querySelectorAll('image').forEach(el => {
         const href = el.getAttribute('href') || el.getAttribute('xlink:href') || '';
@@ -201,7 +203,7 @@ export function exportImage(svgElement, map, pan) {
 /**
  * Export map as PDF
  */
-export function exportPdf(svgElement, map, pan) {
+export async function exportPdf(svgElement, map, pan) {
     const svg = svgElement.cloneNode(true);
     const viewport = svg.querySelector('#viewport');
 
@@ -241,6 +243,8 @@ export function exportPdf(svgElement, map, pan) {
     injectExportStyles(svg);
     // Remove selection highlight
     svg.querySelectorAll('.selected').forEach(el => el.classList.remove('selected'));
+    // Server-stored images must be embedded: an SVG rendered as an image can't fetch them
+    await inlineSvgImages(svg);
     // Strip any non-data-URL image hrefs — they taint the canvas and cause toBlob to return null
     svg.querySelectorAll('image').forEach(el => {
         const href = el.getAttribute('href') || el.getAttribute('xlink:href') || '';
@@ -409,6 +413,54 @@ function createPrintablePdf(imgDataUrl, pageWidth, pageHeight, x, y, imgWidth, i
 }
 
 // Helper functions
+// ── Image blobs ──
+// Saved maps reference images stored on the server (/api/blobs/<sha256>)
+// instead of embedding them; exports put the data: URLs back.
+const BLOB_URL_PREFIX = '/api/blobs/';
+const BLOB_MEDIA_FIELDS = ['dataUrl', 'originalDataUrl'];
+
+function isBlobRef(value) {
+    return typeof value === 'string' && value.startsWith(BLOB_URL_PREFIX);
+}
+
+async function fetchAsDataUrl(url) {
+    const resp = await fetch(url, { credentials: 'include' });
+    if (!resp.ok) throw new Error(`Image introuvable (${resp.status})`);
+    const blob = await resp.blob();
+    return new Promise((resolve, reject) => {
+        const reader = new FileReader();
+        reader.onload = () => resolve(reader.result);
+        reader.onerror = () => reject(reader.error);
+        reader.readAsDataURL(blob);
+    });
+}
+
+export async function inlineBlobs(map) {
+    const copy = JSON.parse(JSON.stringify(map));
+    const pending = [];
+    Object.values(copy.nodes || {}).forEach(n => {
+        BLOB_MEDIA_FIELDS.forEach(field => {
+            if (!isBlobRef(n.media?.[field])) return;
+            pending.push(fetchAsDataUrl(n.media[field])
+                .then(dataUrl => { n.media[field] = dataUrl; })
+                .catch(err => console.warn(err)));
+        });
+    });
+    await Promise.all(pending);
+    return copy;
+}
+
+async function inlineSvgImages(svg) {
+    const cache = new Map();
+    await Promise.all([...svg.querySelectorAll('image')].map(async el => {
+        const href = el.getAttribute('href') || el.getAttribute('xlink:href') || '';
+        if (!isBlobRef(href)) return;
+        if (!cache.has(href)) cache.set(href, fetchAsDataUrl(href).catch(() => null));
+        const dataUrl = await cache.get(href);
+        if (dataUrl) el.setAttribute('href', dataUrl);
+    }));
+}
+
 function downloadText(content, filename, mimeType) {
     const blob = new Blob([content], { type: mimeType });
     downloadBlob(blob, filename);
@@ -27,11 +27,12 @@ import {
     addTask,
     toggleTask,
     deleteTask,
-    getAllTasks
+    getAllTasks,
+    diffMap
 } from './model.js';
 import { layout } from './layout.js';
 import { render, clearRenderCache, setSelectedLinkId, setSelectedFrameId } from './render.js';
-import { exportMarkdown, exportImage, exportPdf } from './export.js';
+import { exportMarkdown, exportImage, exportPdf, inlineBlobs } from './export.js';
 import { initOutline, renderOutline, isMobileOutline } from './outline.js';
 import { getTemplates, buildFromTemplate } from './templates.js';
 import { initCommandPalette, openCommandPalette } from './command-palette.js';
@@ -43,6 +44,7 @@ function sanitizeHtml(html) {
 }
 
 const MAPS_ENDPOINT = '/api/maps';
+const MAP_LIST_PAGE_SIZE = 100;
 let LAST_MAP_STORAGE_KEY = 'mindmap:lastMapId';
 
 const viewport = document.getElementById('viewport');
@@ -121,6 +123,11 @@ let autosavePending = false;
 let autosaveInFlight = false;
 let lastSaveError = null;
 let lastSaveConflictExistingId = null;
+let lastSaveRevisionConflict = false;
+// Last state the server acknowledged and its revision: autosave sends only
+// the difference (PATCH) when both are known, the whole map (POST) otherwise
+let savedBaseline = null;
+let savedRevision = null;
 
 let clipboard = null; // Stores copied subtree
 let selectedLinkId = null; // Currently selected free link
@@ -464,9 +471,9 @@ function wireUI() {
     });
 
     if (saveBtn) {
-        saveBtn.onclick = () => {
+        saveBtn.onclick = async () => {
             if (!map) return;
-            const json = JSON.stringify(map, null, 2);
+            const json = JSON.stringify(await inlineBlobs(map), null, 2);
             const blob = new Blob([json], { type: 'application/json' });
             const a = document.createElement('a');
             a.href = URL.createObjectURL(blob);
@@ -1465,7 +1472,7 @@ async function loadInitialMap() {
     if (lastId && await loadMapById(lastId, { silentError: true })) {
         return;
     }
-    const summaries = await fetchMapSummaries();
+    const { maps: summaries } = await fetchMapSummaries(undefined, { limit: 1, fields: 'id' });
     if (summaries && summaries.length) {
         const first = summaries.find(item => item.id) || summaries[0];
         if (first?.id) {
@@ -1483,6 +1490,9 @@ function setCurrentMap(newMap, { center = true, remember = true } = {}) {
     const cloned = typeof structuredClone === 'function'
         ? structuredClone(newMap)
         : JSON.parse(JSON.stringify(newMap));
+    // Restoring a version keeps the map id: its revision still applies
+    if (!map || !newMap.id || newMap.id !== map.id) savedRevision = null;
+    savedBaseline = null;
     map = ensureSettings(cloned);
     selectedId = map.rootId;
     pan = { x: 0, y: 0, scale: 1 };
@@ -1491,6 +1501,7 @@ function setCurrentMap(newMap, { center = true, remember = true } = {}) {
     autosavePending = false;
     lastSaveError = null;
     lastSaveConflictExistingId = null;
+    lastSaveRevisionConflict = false;
     selectLink(null);
     selectFrame(null);
     clearRenderCache();
@@ -3308,7 +3319,7 @@ async function refreshMapList() {
         return;
     }
 
-    const [folders, maps] = await Promise.all([
+    const [folders, page] = await Promise.all([
         fetchFolders(),
         fetchMapSummaries(currentFolderId)
     ]);
@@ -3318,7 +3329,7 @@ async function refreshMapList() {
         return;
     }
     updateBreadcrumb();
-    renderMapList(folders, maps);
+    renderMapList(folders, page.maps, page.nextCursor);
 }
 
 function updateBreadcrumb() {
@@ -3362,7 +3373,82 @@ function navigateToFolder(folderId, folderName) {
     refreshMapList();
 }
 
-function renderMapList(folders, maps) {
+function createMapListItem(item) {
+    const btn = document.createElement('button');
+    btn.type = 'button';
+
+    const left = document.createElement('div');
+    left.className = 'map-info';
+
+    const title = document.createElement('span');
+    title.className = 'map-title';
+    title.textContent = item.title || 'Sans titre';
+
+    const meta = document.createElement('span');
+    meta.className = 'map-meta';
+    meta.textContent = item.updatedAt ? new Date(item.updatedAt).toLocaleString() : '';
+
+    left.appendChild(title);
+    left.appendChild(meta);
+    btn.appendChild(left);
+
+    // Action buttons
+    const actions = document.createElement('div');
+    actions.className = 'map-item-actions';
+
+    const moveBtn = document.createElement('span');
+    moveBtn.className = 'map-action-btn';
+    moveBtn.textContent = 'Deplacer';
+    moveBtn.addEventListener('click', e => {
+        e.stopPropagation();
+        showMoveDialog(item);
+    });
+    actions.appendChild(moveBtn);
+
+    const trashBtn = document.createElement('span');
+    trashBtn.className = 'map-action-btn trash-btn';
+    trashBtn.textContent = 'Supprimer';
+    trashBtn.addEventListener('click', async e => {
+        e.stopPropagation();
+        await fetch(`/api/maps/${item.id}/trash`, {
+            method: 'PUT',
+            headers: getAuthHeaders(),
+            credentials: 'include'
+        });
+        refreshMapList();
+    });
+    actions.appendChild(trashBtn);
+
+    btn.appendChild(actions);
+
+    btn.addEventListener('click', async () => {
+        if (await loadMapById(item.id)) {
+            closeMapList();
+        }
+    });
+    return btn;
+}
+
+function createLoadMoreButton(cursor) {
+    const btn = document.createElement('button');
+    btn.type = 'button';
+    btn.className = 'map-list-more';
+    btn.textContent = 'Afficher plus';
+    btn.addEventListener('click', async () => {
+        btn.disabled = true;
+        const page = await fetchMapSummaries(currentFolderId, { cursor });
+        page.maps.forEach(item => mapListContainer.insertBefore(createMapListItem(item), btn));
+        if (page.nextCursor) {
+            cursor = page.nextCursor;
+            btn.disabled = false;
+        } else {
+            btn.remove();
+        }
+    });
+    return btn;
+}
+
+function renderMapList(folders, maps, nextCursor = null) {
     mapListContainer.innerHTML = '';
 
     // Show folders (only at root level)
@@ -3404,61 +3490,10 @@ function renderMapList(folders, maps) {
         empty.textContent = 'Ce dossier est vide.';
         mapListContainer.appendChild(empty);
     } else {
-        maps.forEach(item => {
-            const btn = document.createElement('button');
-            btn.type = 'button';
-
-            const left = document.createElement('div');
-            left.className = 'map-info';
-
-            const title = document.createElement('span');
-            title.className = 'map-title';
-            title.textContent = item.title || 'Sans titre';
-
-            const meta = document.createElement('span');
-            meta.className = 'map-meta';
-            meta.textContent = item.updatedAt ? new Date(item.updatedAt).toLocaleString() : '';
-
-            left.appendChild(title);
-            left.appendChild(meta);
-            btn.appendChild(left);
-
-            // Action buttons
-            const actions = document.createElement('div');
-            actions.className = 'map-item-actions';
-
-            const moveBtn = document.createElement('span');
-            moveBtn.className = 'map-action-btn';
-            moveBtn.textContent = 'Deplacer';
-            moveBtn.addEventListener('click', e => {
-                e.stopPropagation();
-                showMoveDialog(item);
-            });
-            actions.appendChild(moveBtn);
-
-            const trashBtn = document.createElement('span');
-            trashBtn.className = 'map-action-btn trash-btn';
-            trashBtn.textContent = 'Supprimer';
-            trashBtn.addEventListener('click', async e => {
-                e.stopPropagation();
-                await fetch(`/api/maps/${item.id}/trash`, {
-                    method: 'PUT',
-                    headers: getAuthHeaders(),
-                    credentials: 'include'
-                });
-                refreshMapList();
-            });
-            actions.appendChild(trashBtn);
-
-            btn.appendChild(actions);
-
-            btn.addEventListener('click', async () => {
-                if (await loadMapById(item.id)) {
-                    closeMapList();
-                }
-            });
-            mapListContainer.appendChild(btn);
-        });
+        maps.forEach(item => mapListContainer.appendChild(createMapListItem(item)));
+        if (nextCursor) {
+            mapListContainer.appendChild(createLoadMoreButton(nextCursor));
+        }
     }
 
     // Show Corbeille at bottom (only at root level)
@@ -3736,6 +3771,10 @@ async function loadMapById(id, { silentError = false } = {}) {
         }
         ensureSettings(loadedMap);
         setCurrentMap(loadedMap, { center: true, remember: true });
+        if (Number.isInteger(data.revision)) {
+            savedBaseline = JSON.parse(JSON.stringify(loadedMap));
+            savedRevision = data.revision;
+        }
         return true;
     } catch (err) {
         console.error(err);
@@ -3749,41 +3788,51 @@ async function loadMapById(id, { silentError = false } = {}) {
     }
 }
 
-async function fetchMapSummaries(folderId) {
-    if (!ensureRemoteEnabled({ silent: true })) return [];
+// One page of map summaries, newest first: { maps, nextCursor, total }.
+// total is only known on the first page (no cursor).
+async function fetchMapSummaries(folderId, { cursor = null, limit = MAP_LIST_PAGE_SIZE, fields = null } = {}) {
+    const empty = { maps: [], nextCursor: null, total: null };
+    if (!ensureRemoteEnabled({ silent: true })) return empty;
     try {
-        let url = `${MAPS_ENDPOINT}?id=0`;
+        let url = `${MAPS_ENDPOINT}?id=0&limit=${limit}`;
         if (folderId) {
             url += `&folder_id=${encodeURIComponent(folderId)}`;
         } else if (folderId === null) {
             url += '&folder_id=root';
         }
+        if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+        if (fields) url += `&fields=${encodeURIComponent(fields)}`;
         const resp = await fetch(url, {
             headers: getAuthHeaders(),
             credentials: 'include'
         });
         if (resp.status === 401) {
             window.location.href = '/login';
-            return [];
+            return empty;
         }
         if (resp.status === 403) {
             disableRemote('Acces refuse.');
-            return [];
+            return empty;
         }
         if (resp.status === 404) {
             disableRemote('Endpoint distant introuvable.');
-            return [];
+            return empty;
         }
-        if (!resp.ok) return [];
+        if (!resp.ok) return empty;
         enableRemote();
         const data = await resp.json();
-        return Array.isArray(data) ? data : (data?.maps || []);
+        const total = resp.headers.get('X-Total-Count');
+        return {
+            maps: Array.isArray(data) ? data : (data?.maps || []),
+            nextCursor: resp.headers.get('X-Next-Cursor'),
+            total: total === null ? null : Number(total)
+        };
     } catch (err) {
         console.error(err);
         if (isNetworkError(err)) {
             disableRemote('Impossible de contacter l\'API distante.');
         }
-        return [];
+        return empty;
     }
 }
 
@@ -3835,20 +3884,40 @@ async function runAutosave() {
         delete n.depth;
         delete n.direction;
     });
+    const patch = savedBaseline && savedRevision !== null && mapSnapshot.id === savedBaseline.id
+        ? diffMap(savedBaseline, mapSnapshot)
+        : undefined;
     lastSaveError = null;
     lastSaveConflictExistingId = null;
+    lastSaveRevisionConflict = false;
     updateSaveStatus();
     try {
-        const payload = {
-            id: mapSnapshot.id || null,
-            title: mapSnapshot.title,
-            map: mapSnapshot
-        };
-        const resp = await fetch(MAPS_ENDPOINT, {
-            method: 'POST',
+        if (patch === null) {
+            // Nothing differs from what the server already has
+            autosavePending = false;
+            return;
+        }
+        const request = patch
+            ? {
+                url: `${MAPS_ENDPOINT}/${encodeURIComponent(mapSnapshot.id)}`,
+                method: 'PATCH',
+                body: { ...patch, baseRevision: savedRevision, title: mapSnapshot.title }
+            }
+            : {
+                url: MAPS_ENDPOINT,
+                method: 'POST',
+                body: {
+                    id: mapSnapshot.id || null,
+                    title: mapSnapshot.title,
+                    map: mapSnapshot,
+                    ...(savedRevision !== null ? { baseRevision: savedRevision } : {})
+                }
+            };
+        const resp = await fetch(request.url, {
+            method: request.method,
             headers: getAuthHeaders(),
             credentials: 'include',
-            body: JSON.stringify(payload)
+            body: JSON.stringify(request.body)
         });
         if (resp.status === 401) {
             window.location.href = '/login';
@@ -3856,8 +3925,14 @@ async function runAutosave() {
         }
         if (resp.status === 409) {
             const errData = await resp.json().catch(() => ({}));
-            lastSaveError = new Error(errData.error || 'Carte en doublon — renommez-la');
-            lastSaveConflictExistingId = errData.existing_id || null;
+            if (errData.conflict) {
+                // Saved from another tab or device since we loaded it
+                lastSaveError = new Error(errData.error || 'Carte modifiée ailleurs — rechargez-la');
+                lastSaveRevisionConflict = true;
+            } else {
+                lastSaveError = new Error(errData.error || 'Carte en doublon — renommez-la');
+                lastSaveConflictExistingId = errData.existing_id || null;
+            }
             autosavePending = false;
             return;
         }
@@ -3884,6 +3959,17 @@ async function runAutosave() {
         if (data?.updatedAt && map === savingMap) {
             map.updatedAt = data.updatedAt;
         }
+        if (data?.blobs && map === savingMap) {
+            applyBlobRefs(map, mapSnapshot, data.blobs);
+        }
+        if (map === savingMap && Number.isInteger(data?.revision)) {
+            for (const [nodeId, fields] of Object.entries(data.blobs || {})) {
+                const media = mapSnapshot.nodes?.[nodeId]?.media;
+                if (media) Object.assign(media, fields);
+            }
+            savedBaseline = { ...mapSnapshot, id: data.id || mapSnapshot.id };
+            savedRevision = data.revision;
+        }
         autosavePending = false;
         update();
     } catch (err) {
@@ -3901,6 +3987,23 @@ async function runAutosave() {
     }
 }
 
+// The server moves base64 images into its blob store and answers with
+// reference URLs; swap them in so later saves stop re-sending the payload.
+// Skip fields the user changed while the save was in flight.
+function applyBlobRefs(target, sent, blobs) {
+    for (const [nodeId, fields] of Object.entries(blobs)) {
+        const media = target.nodes?.[nodeId]?.media;
+        const sentMedia = sent.nodes?.[nodeId]?.media;
+        if (!media || !sentMedia) continue;
+        for (const [field, url] of Object.entries(fields)) {
+            if (media[field] === sentMedia[field]) {
+                media[field] = url;
+                if (field === 'originalDataUrl') originalDataUrlCache.set(nodeId, url);
+            }
+        }
+    }
+}
+
 function getAutosaveDelay() {
     if (!map) return DEFAULTS.autosaveDelay;
     const delay = Number(map.settings?.autosaveDelay);
@@ -3927,7 +4030,9 @@ function updateSaveStatus() {
         const isConflict = !!lastSaveConflictExistingId;
         saveStatusEl.textContent = isConflict
             ? `${lastSaveError.message} — renommez la carte pour la sauvegarder`
-            : 'Erreur de sauvegarde. Nouvelle tentative…';
+            : lastSaveRevisionConflict
+                ? lastSaveError.message
+                : 'Erreur de sauvegarde. Nouvelle tentative…';
         saveStatusEl.classList.add('error');
         return;
     }
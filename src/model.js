@@ -456,3 +456,46 @@ export function getNodesInFrame(map, frameId) {
             && cy >= frame.y && cy <= frame.y + frame.h;
     });
 }
+
+// Changes between two saved states of a map, in the shape accepted by
+// PATCH /api/maps/<id>: nodes, links and frames as {id: item|null}, settings
+// whole, other top-level keys under fields. Returns null when nothing changed.
+const PATCH_COLLECTIONS = ['links', 'frames'];
+
+function diffById(baseItems, nextItems) {
+    const changes = {};
+    const baseJson = new Map(Object.entries(baseItems).map(([id, item]) => [id, JSON.stringify(item)]));
+    for (const [id, item] of Object.entries(nextItems)) {
+        if (baseJson.get(id) !== JSON.stringify(item)) changes[id] = item;
+        baseJson.delete(id);
+    }
+    for (const id of baseJson.keys()) changes[id] = null;
+    return changes;
+}
+
+function indexById(items) {
+    return Object.fromEntries((items || []).map(item => [item.id, item]));
+}
+
+export function diffMap(base, next) {
+    const patch = {};
+    const nodes = diffById(base.nodes || {}, next.nodes || {});
+    if (Object.keys(nodes).length) patch.nodes = nodes;
+    for (const name of PATCH_COLLECTIONS) {
+        const changes = diffById(indexById(base[name]), indexById(next[name]));
+        if (Object.keys(changes).length) patch[name] = changes;
+    }
+    if (JSON.stringify(base.settings) !== JSON.stringify(next.settings)) {
+        patch.settings = next.settings || {};
+    }
+    const fields = {};
+    const skip = new Set(['id', 'nodes', 'settings', ...PATCH_COLLECTIONS]);
+    for (const key of new Set([...Object.keys(base), ...Object.keys(next)])) {
+        if (skip.has(key)) continue;
+        if (JSON.stringify(base[key]) !== JSON.stringify(next[key])) {
+            fields[key] = next[key] === undefined ? null : next[key];
+        }
+    }
+    if (Object.keys(fields).length) patch.fields = fields;
+    return Object.keys(patch).length ? patch : null;
+}
@@ -0,0 +1,47 @@
+import { describe, it, expect } from 'vitest';
+import { createEmptyMap, addChild, addLink, addFrame, deleteNode, diffMap } from '../src/model.js';
+
+const clone = (value) => JSON.parse(JSON.stringify(value));
+
+describe('diffMap', () => {
+    it('renvoie null sans modification', () => {
+        const map = createEmptyMap();
+        expect(diffMap(map, clone(map))).toBeNull();
+    });
+
+    it('ne contient que les nœuds modifiés ou supprimés', () => {
+        const map = createEmptyMap();
+        const a = addChild(map, 'n1');
+        const b = addChild(map, 'n1');
+        const base = clone(map);
+        map.nodes[a].text = 'Modifié';
+        deleteNode(map, b);
+        const patch = diffMap(base, map);
+        expect(patch.nodes[a].text).toBe('Modifié');
+        expect(patch.nodes[b]).toBeNull();
+        expect(patch.nodes.n1.children).toEqual([a]);
+        expect(Object.keys(patch.nodes)).toHaveLength(3);
+    });
+
+    it('indexe liens et cadres par id', () => {
+        const map = createEmptyMap();
+        const a = addChild(map, 'n1');
+        const base = clone(map);
+        const link = addLink(map, 'n1', a);
+        const frame = addFrame(map, 0, 0);
+        const patch = diffMap(base, map);
+        expect(patch.links).toEqual({ [link.id]: link });
+        expect(patch.frames).toEqual({ [frame.id]: frame });
+    });
+
+    it('place les autres clés dans fields', () => {
+        const map = createEmptyMap();
+        const base = clone(map);
+        map.title = 'Nouveau titre';
+        map.settings.fontSize = 20;
+        const patch = diffMap(base, map);
+        expect(patch.fields).toMatchObject({ title: 'Nouveau titre' });
+        expect(patch.settings.fontSize).toBe(20);
+        expect(patch.nodes).toBeUndefined();
+    });
+});
@@ -3,6 +3,7 @@ import json
 import os
 import tempfile
 import sys
+import time
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'server'))
 
@@ -243,6 +244,29 @@ class TestInjectAPI:
         assert loaded['nodes']['ai_1']['parentId'] == 'n1'
         assert 'ai_1' in loaded['nodes']['n1']['children']
 
+    def test_inject_reapplies_after_a_concurrent_save(self, app, authed_client, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'VERSION_COALESCE_SECONDS', 0)
+        map_id = self._create_map(authed_client)
+        search_docs = app_module._search_docs
+        saved = []
+
+        def save_meanwhile(title, map_data):
+            # Another client saves between inject's read and its write
+            if not saved:
+                saved.append(True)
+                content = json.loads(make_map_json())
+                content['nodes']['n1']['text'] = 'Renamed'
+                authed_client.post('/api/maps', json={'id': map_id, 'title': 'Inject test', 'map': content})
+            return search_docs(title, map_data)
+        monkeypatch.setattr(app_module, '_search_docs', save_meanwhile)
+        resp = authed_client.post(f'/api/maps/{map_id}/inject', json={'operations': [
+            {'op': 'add_child', 'parent': 'n1', 'id': 'ai_1', 'text': 'Test'}]})
+        assert resp.status_code == 200 and resp.get_json()['revision'] == 3
+        loaded = authed_client.get(f'/api/maps?id={map_id}').get_json()['map']
+        assert loaded['nodes']['n1']['text'] == 'Renamed' and 'ai_1' in loaded['nodes']
+        assert len(authed_client.get(f'/api/maps/{map_id}/versions').get_json()) == 3
+
     def test_inject_cascade_references(self, authed_client):
         """Operations can reference nodes created in the same batch."""
         map_id = self._create_map(authed_client)
@@ -561,3 +585,1416 @@ class TestSharing:
     def test_shared_nonexistent_token_404(self, client):
         resp = client.get('/api/shared/doesnotexist123456')
         assert resp.status_code in (404, 500)
+
+
+class TestConnectionPool:
+    def test_connections_are_reused(self, app):
+        import app as app_module
+        first = app_module.get_db()
+        raw = first._conn
+        first.close()
+        second = app_module.get_db()
+        assert second._conn is raw
+        second.close()
+
+    def test_release_rolls_back_uncommitted_work(self, app):
+        import app as app_module
+        conn = app_module.get_db()
+        conn.execute("INSERT INTO folders (id, name) VALUES ('f-leak', 'x')")
+        conn.close()
+        conn = app_module.get_db()
+        assert conn.execute("SELECT COUNT(*) FROM folders WHERE id = 'f-leak'").fetchone()[0] == 0
+        conn.close()
+
+    def test_double_close_is_harmless(self, app):
+        import app as app_module
+        conn = app_module.get_db()
+        conn.close()
+        conn.close()
+        a, b = app_module.get_db(), app_module.get_db()
+        assert a._conn is not b._conn
+        a.close()
+        b.close()
+
+    def test_pragmas_applied(self, app):
+        import app as app_module
+        conn = app_module.get_db()
+        assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == app_module.SQLITE_PRAGMAS['busy_timeout']
+        assert conn.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+        conn.close()
+
+    def test_pool_dropped_after_fork(self, app, monkeypatch):
+        import app as app_module
+        conn = app_module.get_db()
+        raw = conn._conn
+        conn.close()
+        monkeypatch.setattr(app_module, '_pool_pid', -1)
+        conn = app_module.get_db()
+        assert conn._conn is not raw
+        conn.close()
+
+
+HOT_QUERIES = [
+    ('SELECT id, updated_at, title, folder_id FROM maps WHERE user_id = ? AND (trashed IS NULL OR trashed = 0) ORDER BY updated_at DESC, id DESC', ('u',)),
+    ('SELECT id, updated_at, title, folder_id FROM maps WHERE user_id = ? AND trashed = 1 ORDER BY updated_at DESC, id DESC', ('u',)),
+    ('SELECT id, updated_at, title, folder_id FROM maps WHERE user_id = ? AND (trashed IS NULL OR trashed = 0) AND folder_id = ? ORDER BY updated_at DESC, id DESC', ('u', 'f')),
+    ('SELECT id, updated_at, title, folder_id FROM maps WHERE user_id = ? AND (trashed IS NULL OR trashed = 0) AND folder_id IS NULL ORDER BY updated_at DESC, id DESC', ('u',)),
+    ('SELECT id, updated_at, title, folder_id FROM maps WHERE user_id = ? AND (trashed IS NULL OR trashed = 0) AND (updated_at, id) < (?, ?) ORDER BY updated_at DESC, id DESC LIMIT ?', ('u', 1, 'm', 100)),
+    ('SELECT id, updated_at, title, folder_id FROM maps WHERE user_id = ? AND trashed = 1 AND (updated_at, id) < (?, ?) ORDER BY updated_at DESC, id DESC LIMIT ?', ('u', 1, 'm', 100)),
+    ('SELECT id, created_at FROM map_versions WHERE map_id = ? ORDER BY created_at DESC', ('m',)),
+    ('SELECT data, title FROM maps WHERE share_token = ? AND (trashed IS NULL OR trashed = 0)', ('t',)),
+    ('SELECT k.id AS api_key_id, k.key_hash, u.id, u.username, u.display_name, u.is_admin FROM api_keys k JOIN users u ON u.id = k.user_id WHERE k.prefix = ?', ('k',)),
+    ('SELECT id, name, map_count, created_at, updated_at FROM folders WHERE user_id = ? ORDER BY name', ('u',)),
+]
+
+
+class TestSchemaMigrations:
+    def test_fresh_db_at_latest_version(self, app):
+        import app as app_module
+        conn = app_module.get_db()
+        assert app_module.get_schema_version(conn) == app_module.MIGRATIONS[-1][0]
+        conn.close()
+
+    def test_migrate_is_idempotent(self, app):
+        import app as app_module
+        conn = app_module.get_db()
+        before = conn.execute('SELECT COUNT(*) FROM schema_version').fetchone()[0]
+        app_module.migrate(conn)
+        assert conn.execute('SELECT COUNT(*) FROM schema_version').fetchone()[0] == before
+        conn.close()
+
+    def test_legacy_db_is_upgraded(self, app):
+        """A database from before schema_version existed replays every step safely."""
+        import sqlite3
+        import app as app_module
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            legacy = sqlite3.connect(path)
+            legacy.execute('CREATE TABLE maps (id TEXT PRIMARY KEY, title TEXT, data TEXT, created_at INTEGER, updated_at INTEGER)')
+            legacy.execute('CREATE TABLE users (id TEXT PRIMARY KEY, username TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL, display_name TEXT, is_admin INTEGER DEFAULT 0, created_at INTEGER, updated_at INTEGER)')
+            legacy.execute('ALTER TABLE maps ADD COLUMN folder_id TEXT')
+            legacy.execute("INSERT INTO maps (id, title, data) VALUES ('m1', 'Old', '{}')")
+            legacy.commit()
+            legacy.row_factory = sqlite3.Row
+            app_module.migrate(legacy)
+            assert app_module._has_column(legacy, 'maps', 'share_token')
+            assert app_module._has_column(legacy, 'users', 'api_key')
+            assert legacy.execute("SELECT title FROM maps WHERE id = 'm1'").fetchone()[0] == 'Old'
+            legacy.close()
+        finally:
+            os.unlink(path)
+
+    @pytest.mark.parametrize('sql,params', HOT_QUERIES)
+    def test_hot_queries_use_indexes(self, app, sql, params):
+        import app as app_module
+        conn = app_module.get_db()
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        conn.close()
+        assert not any(step.startswith('SCAN') for step in plan), plan
+        assert not any('TEMP B-TREE' in step for step in plan), plan
+
+
+def make_big_map(count=40, **text_overrides):
+    nodes = {'n1': {'id': 'n1', 'parentId': None, 'text': 'Root',
+                    'children': [f'n{i}' for i in range(2, count + 1)]}}
+    for i in range(2, count + 1):
+        nodes[f'n{i}'] = {'id': f'n{i}', 'parentId': 'n1', 'text': f'Node {i}',
+                          'children': [], 'body': 'Lorem ipsum dolor sit amet ' * 4}
+    for node_id, text in text_overrides.items():
+        nodes[node_id]['text'] = text
+    return {'rootId': 'n1', 'nodes': nodes, 'settings': {'fontSize': 14}}
+
+
+class TestVersionHistory:
+    @pytest.fixture(autouse=True)
+    def _no_coalescing(self, app, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'VERSION_COALESCE_SECONDS', 0)
+
+    def _save(self, client, map_id, content):
+        resp = client.post('/api/maps', json={'id': map_id, 'title': 'History', 'map': content})
+        return resp.get_json()['id']
+
+    def _versions(self, client, map_id):
+        return client.get(f'/api/maps/{map_id}/versions').get_json()
+
+    def test_diff_patch_roundtrip(self, app):
+        import copy
+        import app as app_module
+        old = {'a': 1, 'b': {'c': None, 'd': [1, 2]}, 'e': 'x', 'f': True}
+        new = {'a': 1, 'b': {'c': 'set', 'd': [2]}, 'g': {'h': None}, 'f': 1}
+        ops = app_module._json_diff(old, new)
+        assert app_module._json_patch(copy.deepcopy(old), ops) == new
+        assert type(app_module._json_patch(copy.deepcopy(old), ops)['f']) is int
+
+    def test_versions_rebuild_exactly(self, authed_client):
+        contents = [make_big_map(), make_big_map(n2='Edited'), make_big_map(n2='Edited', n3='Again')]
+        del contents[2]['nodes']['n40']
+        contents[2]['nodes']['n1']['children'].remove('n40')
+        map_id = None
+        for content in contents:
+            map_id = self._save(authed_client, map_id, content)
+        versions = self._versions(authed_client, map_id)
+        assert len(versions) == 3
+        for version, expected in zip(reversed(versions), contents):
+            resp = authed_client.get(f'/api/maps/{map_id}/versions/{version["id"]}')
+            assert resp.get_json()['map'] == expected
+
+    def test_small_edits_stored_as_deltas(self, app, authed_client):
+        import app as app_module
+        map_id = self._save(authed_client, None, make_big_map())
+        self._save(authed_client, map_id, make_big_map(n5='Changed'))
+        conn = app_module.get_db()
+        rows = conn.execute('SELECT base_id, LENGTH(data) AS size FROM map_versions WHERE map_id = ? ORDER BY id', (map_id,)).fetchall()
+        conn.close()
+        assert rows[0]['base_id'] is None
+        assert rows[1]['base_id'] is not None
+        assert rows[1]['size'] * 10 < rows[0]['size']
+
+    def test_keyframe_interval_and_trim(self, app, authed_client, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'VERSION_KEYFRAME_INTERVAL', 3)
+        monkeypatch.setenv('MAP_VERSIONS_KEEP', '4')
+        map_id = None
+        for i in range(10):
+            map_id = self._save(authed_client, map_id, make_big_map(n2=f'Edit {i}'))
+        conn = app_module.get_db()
+        rows = conn.execute('SELECT id, base_id FROM map_versions WHERE map_id = ? ORDER BY id', (map_id,)).fetchall()
+        conn.close()
+        # Segments of 3; the newest 4 versions span the last two segments
+        assert 4 <= len(rows) < 4 + 3
+        assert rows[0]['base_id'] is None
+        versions = self._versions(authed_client, map_id)
+        oldest = authed_client.get(f'/api/maps/{map_id}/versions/{versions[-1]["id"]}').get_json()['map']
+        assert oldest['nodes']['n2']['text'] == f'Edit {10 - len(rows)}'
+
+    def test_full_copy_history_is_converted(self, app):
+        import app as app_module
+        conn = app_module.get_db()
+        contents = [make_big_map(n2=f'v{i}') for i in range(5)]
+        for i, content in enumerate(contents):
+            conn.execute('INSERT INTO map_versions (map_id, data, created_at) VALUES (?, ?, ?)',
+                         ('legacy', json.dumps(content), i))
+        app_module._encode_version_history(conn, 'legacy')
+        conn.commit()
+        ids = [row['id'] for row in conn.execute("SELECT id FROM map_versions WHERE map_id = 'legacy' ORDER BY id")]
+        deltas = conn.execute("SELECT COUNT(*) FROM map_versions WHERE map_id = 'legacy' AND base_id IS NOT NULL").fetchone()[0]
+        assert deltas == 4
+        assert [app_module._load_version(conn, 'legacy', vid) for vid in ids] == contents
+        conn.close()
+
+
+class TestSnapshotPolicy:
+    def _save(self, client, map_id, content):
+        resp = client.post('/api/maps', json={'id': map_id, 'title': 'Policy', 'map': content})
+        return resp.get_json()['id']
+
+    def _rows(self, map_id):
+        import app as app_module
+        conn = app_module.get_db()
+        rows = conn.execute('SELECT id, base_id, created_at FROM map_versions WHERE map_id = ? ORDER BY id', (map_id,)).fetchall()
+        conn.close()
+        return rows
+
+    def test_identical_save_adds_no_version(self, app, authed_client, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'VERSION_COALESCE_SECONDS', 0)
+        map_id = self._save(authed_client, None, make_big_map())
+        self._save(authed_client, map_id, make_big_map())
+        assert len(self._rows(map_id)) == 1
+
+    def test_saves_in_same_slot_are_merged(self, app, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'VERSION_COALESCE_SECONDS', 3600)
+        conn = app_module.get_db()
+        saves = [(3000000, make_big_map()), (9000000, make_big_map(n2='First')),
+                 (9100000, make_big_map(n2='Second', n3='Also'))]
+        for now, content in saves:
+            app_module._record_version(conn, 'm', content, json.dumps(content), now)
+        rows = conn.execute("SELECT id, created_at FROM map_versions WHERE map_id = 'm' ORDER BY id").fetchall()
+        assert len(rows) == 2
+        assert rows[1]['created_at'] == 9100000
+        assert app_module._load_version(conn, 'm', rows[1]['id']) == saves[2][1]
+        conn.close()
+
+    def test_old_history_is_thinned(self, app):
+        import app as app_module
+        hour = 3600 * 1000
+        conn = app_module.get_db()
+        contents = []
+        for i in range(6):
+            content = make_big_map(n2=f'v{i}')
+            contents.append(content)
+            conn.execute('INSERT INTO map_versions (map_id, data, created_at) VALUES (?, ?, ?)',
+                         ('m', json.dumps(content), i * hour // 4))
+        app_module._encode_version_history(conn, 'm')
+        # Two quarter-hour versions per half-hour slot -> one survives in each
+        app_module._thin_versions(conn, 'm', now=10 * hour, tiers=[(hour, hour // 2)])
+        conn.commit()
+        ids = [r['id'] for r in conn.execute("SELECT id FROM map_versions WHERE map_id = 'm' ORDER BY id")]
+        assert len(ids) == 3
+        assert [app_module._load_version(conn, 'm', vid) for vid in ids] == [contents[1], contents[3], contents[5]]
+        conn.close()
+
+    def test_dropping_keyframe_promotes_next_version(self, app):
+        import app as app_module
+        conn = app_module.get_db()
+        contents = [make_big_map(n2=f'v{i}') for i in range(3)]
+        for i, content in enumerate(contents):
+            conn.execute('INSERT INTO map_versions (map_id, data, created_at) VALUES (?, ?, ?)',
+                         ('m', json.dumps(content), i))
+        app_module._encode_version_history(conn, 'm')
+        first = conn.execute("SELECT MIN(id) FROM map_versions WHERE map_id = 'm'").fetchone()[0]
+        app_module._drop_version(conn, 'm', first)
+        rows = conn.execute("SELECT id, base_id FROM map_versions WHERE map_id = 'm' ORDER BY id").fetchall()
+        assert rows[0]['base_id'] is None
+        assert rows[1]['base_id'] == rows[0]['id']
+        assert [app_module._load_version(conn, 'm', r['id']) for r in rows] == contents[1:]
+        conn.close()
+
+
+class TestMapDataCompression:
+    def _raw(self, map_id):
+        import app as app_module
+        conn = app_module.get_db()
+        raw = conn.execute('SELECT data FROM maps WHERE id = ?', (map_id,)).fetchone()[0]
+        conn.close()
+        return raw
+
+    def test_saved_maps_are_compressed(self, authed_client):
+        content = make_big_map()
+        map_id = authed_client.post('/api/maps', json={'title': 'Zip', 'map': content}).get_json()['id']
+        raw = self._raw(map_id)
+        assert isinstance(raw, bytes) and raw[0] == 0x01
+        assert len(raw) < len(json.dumps(content)) / 3
+        assert authed_client.get(f'/api/maps?id={map_id}').get_json()['map'] == content
+
+    def test_plain_text_rows_still_load(self, app, authed_client):
+        import app as app_module
+        content = make_big_map()
+        map_id = authed_client.post('/api/maps', json={'title': 'Old', 'map': content}).get_json()['id']
+        conn = app_module.get_db()
+        conn.execute('UPDATE maps SET data = ? WHERE id = ?', (json.dumps(content), map_id))
+        conn.commit()
+        conn.close()
+        assert authed_client.get(f'/api/maps?id={map_id}').get_json()['map'] == content
+
+    def test_codec_roundtrip(self, app, monkeypatch):
+        import app as app_module
+        text = json.dumps(make_big_map())
+        for codec in ('zlib', 'lzma', 'none'):
+            monkeypatch.setattr(app_module, 'MAP_DATA_CODEC', codec)
+            assert app_module._decode_data(app_module._encode_data(text)) == text
+        with pytest.raises(ValueError):
+            app_module._decode_data(b'\xfe' + b'garbage')
+
+    def test_reencode_existing_rows(self, app, authed_client, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'MAP_DATA_CODEC', 'none')
+        content = make_big_map()
+        map_id = authed_client.post('/api/maps', json={'title': 'Later', 'map': content}).get_json()['id']
+        assert isinstance(self._raw(map_id), str)
+        monkeypatch.setattr(app_module, 'MAP_DATA_CODEC', 'lzma')
+        stats = app_module.reencode_map_data(batch_size=1)
+        assert stats['rewritten'] >= 2  # the map and its first version
+        assert stats['bytes_after'] < stats['bytes_before']
+        assert self._raw(map_id)[0] == 0x02
+        assert authed_client.get(f'/api/maps?id={map_id}').get_json()['map'] == content
+
+    def test_reencode_endpoint_requires_admin(self, client):
+        assert client.post('/api/admin/reencode').status_code == 401
+
+
+PNG_PIXEL = ('data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk'
+             '+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==')
+
+
+def make_image_map(data_url=PNG_PIXEL):
+    content = make_big_map(3)
+    content['nodes']['n2']['media'] = {'kind': 'image', 'dataUrl': data_url,
+                                       'originalDataUrl': data_url, 'width': 1, 'height': 1}
+    return content
+
+
+class TestImageBlobs:
+    def _save(self, client, content, title='Images'):
+        return client.post('/api/maps', json={'title': title, 'map': content}).get_json()
+
+    def test_images_are_moved_to_blob_store(self, authed_client):
+        saved = self._save(authed_client, make_image_map())
+        ref = saved['blobs']['n2']['dataUrl']
+        assert ref.startswith('/api/blobs/')
+        assert saved['blobs']['n2']['originalDataUrl'] == ref
+        loaded = authed_client.get(f'/api/maps?id={saved["id"]}').get_json()['map']
+        assert loaded['nodes']['n2']['media']['dataUrl'] == ref
+        assert 'base64' not in json.dumps(loaded)
+
+    def test_blob_is_public_and_immutable(self, authed_client, app):
+        ref = self._save(authed_client, make_image_map())['blobs']['n2']['dataUrl']
+        anon = app.test_client()
+        resp = anon.get(ref)
+        assert resp.status_code == 200
+        assert resp.mimetype == 'image/png'
+        assert resp.data.startswith(b'\x89PNG')
+        assert 'immutable' in resp.headers['Cache-Control']
+        again = anon.get(ref, headers={'If-None-Match': resp.headers['ETag']})
+        assert again.status_code == 304
+
+    def test_identical_images_are_stored_once(self, app, authed_client):
+        import app as app_module
+        self._save(authed_client, make_image_map(), 'A')
+        self._save(authed_client, make_image_map(), 'B')
+        conn = app_module.get_db()
+        assert conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0] == 1
+        conn.close()
+
+    def test_export_inlines_blobs(self, authed_client):
+        saved = self._save(authed_client, make_image_map())
+        loaded = authed_client.get(f'/api/maps?id={saved["id"]}&inline_blobs=1').get_json()['map']
+        assert loaded['nodes']['n2']['media']['dataUrl'] == PNG_PIXEL
+
+    def test_scriptable_types_stay_inline(self, authed_client):
+        svg = 'data:image/svg+xml;base64,PHN2Zz48L3N2Zz4='
+        saved = self._save(authed_client, make_image_map(svg))
+        assert 'blobs' not in saved
+
+    def test_unreferenced_blobs_are_collected(self, app, authed_client):
+        import app as app_module
+        saved = self._save(authed_client, make_image_map())
+        authed_client.delete(f'/api/maps/{saved["id"]}')
+        far_future = int(time.time() * 1000) + 2 * app_module.BLOB_GC_GRACE_MS
+        assert app_module.collect_blob_garbage(now=far_future) == 1
+        assert authed_client.get(saved['blobs']['n2']['dataUrl']).status_code == 404
+
+
+class TestIncrementalSave:
+    @pytest.fixture(autouse=True)
+    def _no_coalescing(self, app, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'VERSION_COALESCE_SECONDS', 0)
+
+    def _create(self, client, content=None):
+        content = content or make_big_map(5)
+        content['links'] = [{'id': 'l1', 'from': 'n2', 'to': 'n3'}, {'id': 'l2', 'from': 'n3', 'to': 'n4'}]
+        return client.post('/api/maps', json={'title': 'Patch', 'map': content}).get_json()
+
+    def _load(self, client, map_id):
+        return client.get(f'/api/maps?id={map_id}').get_json()
+
+    def test_patch_on_map_without_nodes_keeps_history_readable(self, authed_client):
+        saved = authed_client.post('/api/maps', json={'title': 'Empty', 'map': {'settings': {'notes': 'x' * 5000}}}).get_json()
+        node = {'id': 'n1', 'text': 'First', 'children': []}
+        resp = authed_client.patch(f'/api/maps/{saved["id"]}', json={'baseRevision': saved['revision'], 'nodes': {'n1': node}})
+        assert resp.status_code == 200
+        authed_client.patch(f'/api/maps/{saved["id"]}', json={'baseRevision': resp.get_json()['revision'],
+                                                              'nodes': {'n2': dict(node, id='n2')}})
+        versions = authed_client.get(f'/api/maps/{saved["id"]}/versions').get_json()
+        contents = [authed_client.get(f'/api/maps/{saved["id"]}/versions/{v["id"]}') for v in versions]
+        assert [r.status_code for r in contents] == [200] * len(versions) and len(versions) == 3
+        assert sorted(len(r.get_json()['map'].get('nodes', {})) for r in contents) == [0, 1, 2]
+
+    def test_revision_increments_on_save(self, authed_client):
+        saved = self._create(authed_client)
+        assert saved['revision'] == 1
+        again = authed_client.post('/api/maps', json={'id': saved['id'], 'title': 'Patch', 'map': make_big_map(5)})
+        assert again.get_json()['revision'] == 2
+        assert self._load(authed_client, saved['id'])['revision'] == 2
+
+    def test_patch_applies_changes(self, authed_client):
+        saved = self._create(authed_client)
+        resp = authed_client.patch(f'/api/maps/{saved["id"]}', json={
+            'baseRevision': saved['revision'],
+            'nodes': {'n2': {'id': 'n2', 'parentId': 'n1', 'text': 'Patched', 'children': []}, 'n5': None},
+            'links': {'l1': None, 'l3': {'id': 'l3', 'from': 'n2', 'to': 'n4'}},
+            'frames': {'f1': {'id': 'f1', 'x': 0, 'y': 0, 'w': 10, 'h': 10}},
+            'settings': {'fontSize': 18},
+            'fields': {'rootId': 'n1', 'viewport': {'zoom': 2}},
+        })
+        assert resp.status_code == 200
+        assert resp.get_json()['revision'] == 2
+        loaded = self._load(authed_client, saved['id'])
+        content = loaded['map']
+        assert content['nodes']['n2']['text'] == 'Patched'
+        assert 'n5' not in content['nodes']
+        assert [link['id'] for link in content['links']] == ['l2', 'l3']
+        assert content['frames'][0]['id'] == 'f1'
+        assert content['settings'] == {'fontSize': 18}
+        assert content['viewport'] == {'zoom': 2}
+        assert loaded['revision'] == 2
+
+    def test_stale_revision_is_rejected(self, authed_client):
+        saved = self._create(authed_client)
+        patch = {'baseRevision': saved['revision'], 'nodes': {'n2': None}}
+        assert authed_client.patch(f'/api/maps/{saved["id"]}', json=patch).status_code == 200
+        resp = authed_client.patch(f'/api/maps/{saved["id"]}', json=patch)
+        assert resp.status_code == 409
+        assert resp.get_json()['revision'] == 2
+        stale = authed_client.post('/api/maps', json={'id': saved['id'], 'title': 'Patch',
+                                                      'map': make_big_map(5), 'baseRevision': 1})
+        assert stale.status_code == 409
+        assert 'n2' not in self._load(authed_client, saved['id'])['map']['nodes']
+
+    def test_patch_is_versioned_as_delta(self, app, authed_client):
+        import app as app_module
+        saved = self._create(authed_client, make_big_map())
+        authed_client.patch(f'/api/maps/{saved["id"]}', json={
+            'baseRevision': saved['revision'],
+            'nodes': {'n7': {'id': 'n7', 'parentId': 'n1', 'text': 'Only change', 'children': []}},
+        })
+        versions = authed_client.get(f'/api/maps/{saved["id"]}/versions').get_json()
+        assert len(versions) == 2
+        latest = authed_client.get(f'/api/maps/{saved["id"]}/versions/{versions[0]["id"]}').get_json()['map']
+        assert latest == self._load(authed_client, saved['id'])['map']
+        conn = app_module.get_db()
+        row = conn.execute('SELECT base_id FROM map_versions WHERE id = ?', (versions[0]['id'],)).fetchone()
+        conn.close()
+        assert row['base_id'] is not None
+
+    def test_malformed_patch_is_rejected(self, authed_client):
+        saved = self._create(authed_client)
+        resp = authed_client.patch(f'/api/maps/{saved["id"]}', json={'baseRevision': 1, 'nodes': ['n2']})
+        assert resp.status_code == 400
+        assert self._load(authed_client, saved['id'])['revision'] == 1
+
+    def test_patch_other_users_map_forbidden(self, app, authed_client):
+        saved = self._create(authed_client)
+        authed_client.post('/api/admin/users', json={'username': 'bob', 'password': 'bobpass1'})
+        other = app.test_client()
+        other.post('/api/auth/login', json={'username': 'bob', 'password': 'bobpass1'})
+        resp = other.patch(f'/api/maps/{saved["id"]}', json={'baseRevision': 1, 'nodes': {}})
+        assert resp.status_code == 403
+
+
+class TestConditionalGet:
+    def _create(self, client):
+        return client.post('/api/maps', json={'title': 'Cache', 'map': make_big_map(5)}).get_json()
+
+    def test_map_revalidates_until_saved(self, authed_client):
+        saved = self._create(authed_client)
+        url = f'/api/maps?id={saved["id"]}'
+        first = authed_client.get(url)
+        etag = first.headers['ETag']
+        assert first.headers['Cache-Control'] == 'private, no-cache'
+        again = authed_client.get(url, headers={'If-None-Match': etag})
+        assert again.status_code == 304
+        assert again.data == b''
+        authed_client.patch(f'/api/maps/{saved["id"]}', json={'baseRevision': saved['revision'], 'nodes': {'n2': None}})
+        changed = authed_client.get(url, headers={'If-None-Match': etag})
+        assert changed.status_code == 200
+        assert changed.headers['ETag'] != etag
+        inlined = authed_client.get(url + '&inline_blobs=1', headers={'If-None-Match': changed.headers['ETag']})
+        assert inlined.status_code == 200
+
+    def test_not_modified_does_not_read_data(self, app, authed_client, monkeypatch):
+        import app as app_module
+        saved = self._create(authed_client)
+        url = f'/api/maps?id={saved["id"]}'
+        etag = authed_client.get(url).headers['ETag']
+        monkeypatch.setattr(app_module, '_load_map_data', lambda raw: pytest.fail('data was read'))
+        assert authed_client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    def test_listing_etag_follows_changes(self, authed_client):
+        self._create(authed_client)
+        etag = authed_client.get('/api/maps?id=0').headers['ETag']
+        assert authed_client.get('/api/maps?id=0', headers={'If-None-Match': etag}).status_code == 304
+        authed_client.post('/api/maps', json={'title': 'Other', 'map': make_big_map(2)})
+        assert authed_client.get('/api/maps?id=0', headers={'If-None-Match': etag}).status_code == 200
+
+    def test_shared_map_is_publicly_revalidated(self, app, authed_client):
+        saved = self._create(authed_client)
+        token = authed_client.post(f'/api/maps/{saved["id"]}/share').get_json()['token']
+        anon = app.test_client()
+        first = anon.get(f'/api/shared/{token}')
+        assert first.headers['Cache-Control'] == 'public, no-cache'
+        assert anon.get(f'/api/shared/{token}', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+        authed_client.delete(f'/api/maps/{saved["id"]}/share')
+        assert anon.get(f'/api/shared/{token}', headers={'If-None-Match': first.headers['ETag']}).status_code == 404
+
+
+class TestPassthroughReads:
+    def test_map_read_does_not_parse(self, app, authed_client, monkeypatch):
+        import app as app_module
+        content = make_big_map(5)
+        saved = authed_client.post('/api/maps', json={'title': 'Raw', 'map': content}).get_json()
+        monkeypatch.setattr(app_module, '_load_map_data', lambda raw: pytest.fail('map was parsed'))
+        resp = authed_client.get(f'/api/maps?id={saved["id"]}')
+        assert resp.mimetype == 'application/json'
+        assert resp.get_json() == {'map': content, 'revision': 1}
+
+    def test_string_payload_is_stored_normalized(self, app, authed_client):
+        import app as app_module
+        saved = authed_client.post('/api/maps', json={'title': 'Str', 'map': make_map_json()}).get_json()
+        conn = app_module.get_db()
+        raw = conn.execute('SELECT data FROM maps WHERE id = ?', (saved['id'],)).fetchone()['data']
+        conn.close()
+        assert app_module._decode_data(raw).startswith('{')
+
+    def test_double_encoded_rows_are_normalized(self, app, authed_client):
+        import app as app_module
+        saved = authed_client.post('/api/maps', json={'title': 'Legacy', 'map': make_big_map(5)}).get_json()
+        conn = app_module.get_db()
+        conn.execute('UPDATE maps SET data = ? WHERE id = ?', (json.dumps(json.dumps(make_big_map(5))), saved['id']))
+        conn.commit()
+        # Unnormalized rows still read correctly through the fallback
+        assert authed_client.get(f'/api/maps?id={saved["id"]}').get_json()['map'] == make_big_map(5)
+        assert app_module.normalize_map_data(conn) == 1
+        conn.commit()
+        raw = conn.execute('SELECT data FROM maps WHERE id = ?', (saved['id'],)).fetchone()['data']
+        conn.close()
+        assert app_module._load_json(raw) == make_big_map(5)
+
+    def test_double_encoded_history_is_normalized(self, app, authed_client, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'VERSION_COALESCE_SECONDS', 0)
+        map_id = authed_client.post('/api/maps', json={'title': 'Legacy', 'map': make_big_map(30)}).get_json()['id']
+        legacy = json.dumps(json.dumps(make_big_map(30)))
+        conn = app_module.get_write_db()
+        conn.execute('UPDATE maps SET data = ? WHERE id = ?', (legacy, map_id))
+        conn.execute('UPDATE map_versions SET data = ?, content_hash = ? WHERE map_id = ?',
+                     (legacy, app_module._content_hash(legacy), map_id))
+        conn.execute('DELETE FROM schema_version WHERE version >= 8')
+        app_module.migrate(conn)
+        conn.commit()
+        conn.close()
+        authed_client.post('/api/maps', json={'id': map_id, 'title': 'Legacy', 'map': make_big_map(30, n2='edited')})
+        versions = authed_client.get(f'/api/maps/{map_id}/versions').get_json()
+        contents = [authed_client.get(f'/api/maps/{map_id}/versions/{v["id"]}').get_json()['map'] for v in versions]
+        assert len(contents) == 2
+        assert sorted(c['nodes']['n2']['text'] for c in contents) == sorted(['edited', make_big_map(30)['nodes']['n2']['text']])
+
+
+class TestResponseCompression:
+    def _create(self, client):
+        return client.post('/api/maps', json={'title': 'Zip', 'map': make_big_map(200)}).get_json()
+
+    def test_large_json_is_gzipped(self, authed_client):
+        import gzip
+        saved = self._create(authed_client)
+        url = f'/api/maps?id={saved["id"]}'
+        plain = authed_client.get(url)
+        resp = authed_client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in plain.headers
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in resp.headers['Vary']
+        assert len(resp.data) * 3 < len(plain.data)
+        assert json.loads(gzip.decompress(resp.data)) == plain.get_json()
+        assert resp.headers['ETag'] != plain.headers['ETag']
+        again = authed_client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag']})
+        assert again.status_code == 304
+
+    def test_brotli_preferred_when_available(self, app, authed_client):
+        import app as app_module
+        if app_module.brotli is None:
+            pytest.skip('brotli not installed')
+        saved = self._create(authed_client)
+        resp = authed_client.get(f'/api/maps?id={saved["id"]}', headers={'Accept-Encoding': 'gzip, br'})
+        assert resp.headers['Content-Encoding'] == 'br'
+        assert json.loads(app_module.brotli.decompress(resp.data))['map'] == make_big_map(200)
+
+    def test_small_json_left_alone(self, authed_client):
+        resp = authed_client.get('/api/auth/me', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in resp.headers
+
+    def test_static_files_use_precompressed_variant(self, app, client, tmp_path, monkeypatch):
+        import gzip
+        (tmp_path / 'styles.css').write_text('body { color: red; }\n' * 200)
+        monkeypatch.setattr(app, 'static_folder', str(tmp_path))
+        resp = client.get('/styles.css', headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.mimetype == 'text/css'
+        assert gzip.decompress(resp.data) == (tmp_path / 'styles.css').read_bytes()
+        assert (tmp_path / 'styles.css.gz').exists()
+        plain = client.get('/styles.css')
+        assert 'Content-Encoding' not in plain.headers
+        assert plain.data == (tmp_path / 'styles.css').read_bytes()
+        resp.close()
+        plain.close()
+
+    def test_unlisted_files_require_login(self, client):
+        resp = client.get('/README.md')
+        assert resp.status_code == 302
+
+
+class TestConcurrentWrites:
+    def _clients(self, app, count):
+        clients = []
+        for _ in range(count):
+            client = app.test_client()
+            client.post('/api/auth/login', json={'username': 'test', 'password': 'testpass'})
+            clients.append(client)
+        return clients
+
+    def test_parallel_saves_do_not_fail(self, app, authed_client):
+        import threading
+        map_ids = [authed_client.post('/api/maps', json={'title': f'C{i}', 'map': make_big_map(20)}).get_json()['id']
+                   for i in range(4)]
+        statuses = []
+        errors = []
+
+        def writer(client, map_id, n):
+            try:
+                for k in range(n):
+                    resp = client.post('/api/maps', json={'id': map_id, 'title': 'C', 'map': make_big_map(20, n2=f'edit {k}')})
+                    statuses.append(resp.status_code)
+                    client.get(f'/api/maps?id={map_id}')
+            except Exception as e:  # pragma: no cover - reported below
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(client, map_ids[i % 4], 10))
+                   for i, client in enumerate(self._clients(app, 8))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert statuses == [200] * 80
+        total = sum(authed_client.get(f'/api/maps?id={m}').get_json()['revision'] for m in map_ids)
+        assert total == 4 + 80
+
+    def test_write_slot_freed_when_route_raises(self, app, authed_client, monkeypatch):
+        import app as app_module
+
+        def boom(*args, **kwargs):
+            raise RuntimeError('boom')
+
+        monkeypatch.setattr(app_module, '_extract_blobs', boom)
+        app.config['PROPAGATE_EXCEPTIONS'] = False
+        resp = authed_client.post('/api/maps', json={'title': 'X', 'map': make_big_map(3)})
+        assert resp.status_code == 500
+        assert not app_module._write_lock.locked()
+
+    def test_jobs_are_claimed_once(self, app):
+        import app as app_module
+        assert app_module._claim_job('test-job')
+        assert not app_module._claim_job('test-job')
+        app_module._finish_job('test-job', {'ok': 1})
+        state = app_module._job_state('test-job')
+        assert state['running'] is False
+        assert state['result'] == {'ok': 1}
+        assert not app_module._claim_job('test-job', min_interval_ms=60000)
+        assert app_module._claim_job('test-job')
+
+
+class TestGroupCommit:
+    def _save_concurrently(self, app, payloads):
+        import threading
+        responses = [None] * len(payloads)
+        clients = []
+        for _ in payloads:
+            client = app.test_client()
+            client.post('/api/auth/login', json={'username': 'test', 'password': 'testpass'})
+            clients.append(client)
+
+        def save(i):
+            responses[i] = clients[i].post('/api/maps', json=payloads[i])
+
+        threads = [threading.Thread(target=save, args=(i,)) for i in range(len(payloads))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return responses
+
+    def test_concurrent_saves_share_one_commit(self, app, authed_client, monkeypatch):
+        import app as app_module
+        map_ids = [authed_client.post('/api/maps', json={'title': f'G{i}', 'map': make_big_map(5)}).get_json()['id']
+                   for i in range(6)]
+        monkeypatch.setattr(app_module, 'SAVE_GROUP_COMMIT_MS', 200)
+        leases = []
+        real_get_write_db = app_module.get_write_db
+        monkeypatch.setattr(app_module, 'get_write_db', lambda *args: leases.append(1) or real_get_write_db(*args))
+        responses = self._save_concurrently(app, [
+            {'id': map_id, 'title': f'G{i}', 'map': make_big_map(5, n2=f'batch {i}')} for i, map_id in enumerate(map_ids)
+        ])
+        assert [r.status_code for r in responses] == [200] * 6
+        assert len(leases) < 6
+        for i, map_id in enumerate(map_ids):
+            assert authed_client.get(f'/api/maps?id={map_id}').get_json()['map']['nodes']['n2']['text'] == f'batch {i}'
+
+    def test_last_save_of_a_map_wins(self, app, authed_client, monkeypatch):
+        import app as app_module
+        map_id = authed_client.post('/api/maps', json={'title': 'LWW', 'map': make_big_map(5)}).get_json()['id']
+        monkeypatch.setattr(app_module, 'SAVE_GROUP_COMMIT_MS', 200)
+        responses = self._save_concurrently(app, [
+            {'id': map_id, 'title': 'LWW', 'map': make_big_map(5, n2=f'edit {i}')} for i in range(4)
+        ])
+        bodies = [r.get_json() for r in responses]
+        assert {b['revision'] for b in bodies} == {2}
+        text = authed_client.get(f'/api/maps?id={map_id}').get_json()['map']['nodes']['n2']['text']
+        assert text in {f'edit {i}' for i in range(4)}
+
+    def test_stale_base_revision_conflicts_in_a_batch(self, app, authed_client, monkeypatch):
+        import app as app_module
+        map_id = authed_client.post('/api/maps', json={'title': 'Race', 'map': make_big_map(5)}).get_json()['id']
+        monkeypatch.setattr(app_module, 'SAVE_GROUP_COMMIT_MS', 200)
+        responses = self._save_concurrently(app, [
+            {'id': map_id, 'title': 'Race', 'baseRevision': 1, 'map': make_big_map(5, n2=f'edit {i}')} for i in range(2)
+        ])
+        assert sorted(r.status_code for r in responses) == [200, 409]
+        winner = next(r.get_json() for r in responses if r.status_code == 200)
+        conflict = next(r.get_json() for r in responses if r.status_code == 409)
+        assert winner['revision'] == 2 and conflict['conflict'] and conflict['revision'] == 2
+
+    def test_failed_save_does_not_sink_the_batch(self, app, authed_client, monkeypatch):
+        import app as app_module
+        map_id = authed_client.post('/api/maps', json={'title': 'Mine', 'map': make_big_map(5)}).get_json()['id']
+        monkeypatch.setattr(app_module, 'SAVE_GROUP_COMMIT_MS', 200)
+        responses = self._save_concurrently(app, [
+            {'id': map_id, 'title': 'Mine', 'map': make_big_map(5, n2='kept')},
+            {'title': 'Mine', 'map': make_big_map(5)},  # duplicate title
+        ])
+        assert sorted(r.status_code for r in responses) == [200, 409]
+        assert authed_client.get(f'/api/maps?id={map_id}').get_json()['map']['nodes']['n2']['text'] == 'kept'
+
+
+class TestShardedStorage:
+    @pytest.fixture(autouse=True)
+    def _shard_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('DB_SHARD_DIR', str(tmp_path / 'users'))
+        self.shard_dir = tmp_path / 'users'
+
+    def _user_client(self, app, authed_client, username):
+        user_id = authed_client.post('/api/admin/users', json={'username': username, 'password': 'password1'}).get_json()['id']
+        client = app.test_client()
+        client.post('/api/auth/login', json={'username': username, 'password': 'password1'})
+        return client, user_id
+
+    def test_maps_live_in_the_owners_file(self, app, authed_client):
+        import sqlite3
+        import app as app_module
+        bob, bob_id = self._user_client(app, authed_client, 'bob')
+        map_id = bob.post('/api/maps', json={'title': 'Bob', 'map': make_big_map(5)}).get_json()['id']
+        assert bob.get(f'/api/maps?id={map_id}').get_json()['revision'] == 1
+        assert [m['id'] for m in bob.get('/api/maps').get_json()] == [map_id]
+        assert authed_client.get('/api/maps').get_json() == []
+        shard = sqlite3.connect(self.shard_dir / f'{bob_id}.db')
+        assert shard.execute('SELECT id FROM maps').fetchall() == [(map_id,)]
+        shard.close()
+        catalog = sqlite3.connect(app_module.DB_PATH)
+        assert catalog.execute('SELECT COUNT(*) FROM maps').fetchone()[0] == 0
+        assert catalog.execute('SELECT user_id FROM map_index WHERE map_id = ?', (map_id,)).fetchone() == (bob_id,)
+        catalog.close()
+        # The admin reaches it through the catalog; another user is refused
+        assert authed_client.get(f'/api/maps?id={map_id}').status_code == 200
+        eve, _ = self._user_client(app, authed_client, 'eve')
+        assert eve.get(f'/api/maps?id={map_id}').status_code == 403
+        assert eve.post('/api/maps', json={'id': map_id, 'title': 'Eve', 'map': make_big_map(3)}).status_code == 403
+
+    def test_share_patch_and_history(self, app, authed_client, client):
+        bob, _ = self._user_client(app, authed_client, 'bob')
+        saved = bob.post('/api/maps', json={'title': 'Shared', 'map': make_big_map(5)}).get_json()
+        resp = bob.patch(f'/api/maps/{saved["id"]}', json={'baseRevision': 1, 'nodes': {'n2': {'id': 'n2', 'text': 'patched'}}})
+        assert resp.status_code == 200
+        assert len(bob.get(f'/api/maps/{saved["id"]}/versions').get_json()) >= 1
+        token = bob.post(f'/api/maps/{saved["id"]}/share').get_json()['token']
+        assert client.get(f'/api/shared/{token}').get_json()['map']['nodes']['n2']['text'] == 'patched'
+        bob.delete(f'/api/maps/{saved["id"]}/share')
+        assert client.get(f'/api/shared/{token}').status_code == 404
+
+    def test_delete_user_removes_their_file(self, app, authed_client):
+        bob, bob_id = self._user_client(app, authed_client, 'bob')
+        bob.post('/api/maps', json={'title': 'Bob', 'map': make_big_map(3)})
+        assert (self.shard_dir / f'{bob_id}.db').exists()
+        assert authed_client.get(f'/api/admin/users/{bob_id}/export').status_code == 200
+        assert authed_client.delete(f'/api/admin/users/{bob_id}').status_code == 200
+        assert not (self.shard_dir / f'{bob_id}.db').exists()
+
+    def test_user_list_reads_only_the_catalog(self, app, authed_client, monkeypatch):
+        import app as app_module
+        bob, bob_id = self._user_client(app, authed_client, 'bob')
+        kept = bob.post('/api/maps', json={'title': 'Kept', 'map': make_big_map(5)}).get_json()['id']
+        gone = bob.post('/api/maps', json={'title': 'Gone', 'map': make_big_map(5)}).get_json()['id']
+        assert bob.delete(f'/api/maps/{gone}').status_code == 200
+        # Saves don't touch the catalog; the timer copies the counters later
+        catalog_writes = []
+        get_write_db = app_module.get_write_db
+
+        def tracking_get_write_db(shard=None):
+            if shard is None:
+                catalog_writes.append(shard)
+            return get_write_db(shard)
+        monkeypatch.setattr(app_module, 'get_write_db', tracking_get_write_db)
+        bob.post('/api/maps', json={'id': kept, 'title': 'Kept', 'map': make_big_map(6)})
+        assert catalog_writes == []
+        monkeypatch.setattr(app_module, 'get_write_db', get_write_db)
+        app_module.flush_user_stats()
+        opened = []
+        checkout = app_module._checkout_connection
+        monkeypatch.setattr(app_module, '_checkout_connection', lambda path=None: opened.append(path) or checkout(path))
+        users = {u['username']: u for u in authed_client.get('/api/admin/users').get_json()}
+        assert set(opened) <= {None, app_module.DB_PATH}
+        shard = app_module.get_db(bob_id)
+        expected = tuple(shard.execute('SELECT map_count, map_bytes FROM user_stats WHERE user_id = ?', (bob_id,)).fetchone())
+        shard.close()
+        assert (users['bob']['mapCount'], users['bob']['storageBytes']) == expected
+        assert expected[0] == len(bob.get('/api/maps').get_json()) == 1 and expected[1] > 0
+        assert kept in [m['id'] for m in bob.get('/api/maps').get_json()]
+
+    def test_migrate_single_file_layout(self, app, authed_client, monkeypatch):
+        import app as app_module
+        # Write a map and its history the single-file way, then move it
+        monkeypatch.setattr(app_module, 'DB_SHARD_DIR', '')
+        map_id = authed_client.post('/api/maps', json={'title': 'Legacy', 'map': make_big_map(5)}).get_json()['id']
+        authed_client.post('/api/maps', json={'id': map_id, 'title': 'Legacy', 'map': make_big_map(5, n2='v2')})
+        folder_id = authed_client.post('/api/folders', json={'name': 'Old folder'}).get_json()['id']
+        authed_client.put(f'/api/maps/{map_id}/move', json={'folderId': folder_id})
+        monkeypatch.setattr(app_module, 'DB_SHARD_DIR', str(self.shard_dir))
+        assert authed_client.get('/api/maps').get_json() == []
+
+        stats = app_module.migrate_to_shards()
+        assert stats['users'] == 1 and stats['maps'] == 1 and stats['folders'] == 1
+        assert app_module.migrate_to_shards()['users'] == 0
+        loaded = authed_client.get(f'/api/maps?id={map_id}').get_json()
+        assert loaded['map']['nodes']['n2']['text'] == 'v2'
+        versions = authed_client.get(f'/api/maps/{map_id}/versions').get_json()
+        assert authed_client.get(f'/api/maps/{map_id}/versions/{versions[-1]["id"]}').status_code == 200
+        assert [(f['name'], f['mapCount']) for f in authed_client.get('/api/folders').get_json()] == [('Old folder', 1)]
+        me = next(u for u in authed_client.get('/api/admin/users').get_json() if u['username'] == 'test')
+        assert me['mapCount'] == 1 and me['storageBytes'] > 0
+
+
+def basic_auth(username, password):
+    import base64
+    return {'Authorization': 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode()}
+
+
+class TestAuthCache:
+    def _count_kdf(self, monkeypatch):
+        import app as app_module
+        calls = []
+        real = app_module.check_password_hash
+        monkeypatch.setattr(app_module, 'check_password_hash', lambda *args: calls.append(1) or real(*args))
+        return calls
+
+    def test_basic_auth_verified_once(self, app, client, monkeypatch):
+        calls = self._count_kdf(monkeypatch)
+        for _ in range(3):
+            assert client.get('/api/auth/me', headers=basic_auth('test', 'testpass')).status_code == 200
+        assert len(calls) == 1
+        # Failures are not cached
+        for _ in range(2):
+            assert client.get('/api/auth/me', headers=basic_auth('test', 'wrong')).status_code == 401
+        assert len(calls) == 3
+
+    def test_admin_changes_invalidate(self, app, authed_client):
+        client = app.test_client()
+        user_id = authed_client.post('/api/admin/users', json={'username': 'bot', 'password': 'password1'}).get_json()['id']
+        api_key = authed_client.post(f'/api/admin/users/{user_id}/api-key').get_json()['apiKey']
+        assert client.get('/api/auth/me', headers={'X-API-Key': api_key}).status_code == 200
+        assert client.get('/api/auth/me', headers=basic_auth('bot', 'password1')).status_code == 200
+
+        authed_client.delete(f'/api/admin/users/{user_id}/api-key')
+        assert client.get('/api/auth/me', headers={'X-API-Key': api_key}).status_code == 401
+        authed_client.put(f'/api/admin/users/{user_id}', json={'password': 'password2', 'displayName': 'Robot'})
+        assert client.get('/api/auth/me', headers=basic_auth('bot', 'password1')).status_code == 401
+        assert client.get('/api/auth/me', headers=basic_auth('bot', 'password2')).get_json()['displayName'] == 'Robot'
+        authed_client.delete(f'/api/admin/users/{user_id}')
+        assert client.get('/api/auth/me', headers=basic_auth('bot', 'password2')).status_code == 401
+
+    def test_password_hashed_outside_the_write_slot(self, app, authed_client, monkeypatch):
+        import app as app_module
+        user_id = authed_client.post('/api/admin/users', json={'username': 'bot', 'password': 'password1'}).get_json()['id']
+        held = []
+        hash_password = app_module.generate_password_hash
+        monkeypatch.setattr(app_module, 'generate_password_hash',
+                            lambda password: held.append(app_module._write_lock.locked()) or hash_password(password))
+        assert authed_client.put(f'/api/admin/users/{user_id}', json={'password': 'password2'}).status_code == 200
+        assert held == [False]
+
+    def test_change_from_another_worker(self, app, client, monkeypatch):
+        import app as app_module
+        calls = self._count_kdf(monkeypatch)
+        client.get('/api/auth/me', headers=basic_auth('test', 'testpass'))
+        # Another process commits a change and bumps the stamp; this one's cache is untouched
+        stamp = time.time_ns() + 10 ** 9
+        open(app_module._auth_stamp_path(), 'a').close()
+        os.utime(app_module._auth_stamp_path(), ns=(stamp, stamp))
+        client.get('/api/auth/me', headers=basic_auth('test', 'testpass'))
+        assert len(calls) == 2 and len(app_module._auth_cache) == 1
+
+
+class TestApiKeys:
+    def _user(self, authed_client):
+        return authed_client.post('/api/admin/users', json={'username': 'bot', 'password': 'password1'}).get_json()['id']
+
+    def test_named_keys_are_hashed_and_revoked_one_by_one(self, app, authed_client):
+        import app as app_module
+        client = app.test_client()
+        user_id = self._user(authed_client)
+        ci = authed_client.post(f'/api/admin/users/{user_id}/api-keys', json={'name': 'CI'}).get_json()
+        agent = authed_client.post(f'/api/admin/users/{user_id}/api-keys', json={'name': 'Agent'}).get_json()
+        for key in (ci, agent):
+            assert client.get('/api/auth/me', headers={'X-API-Key': key['apiKey']}).get_json()['username'] == 'bot'
+
+        listed = authed_client.get(f'/api/admin/users/{user_id}/api-keys').get_json()
+        assert [(k['name'], k['preview']) for k in listed] == [('CI', ci['apiKey'][:12] + '…'), ('Agent', agent['apiKey'][:12] + '…')]
+        conn = app_module.get_db()
+        stored = conn.execute('SELECT prefix, key_hash FROM api_keys').fetchall()
+        conn.close()
+        assert all(ci['apiKey'] not in tuple(row) and agent['apiKey'] not in tuple(row) for row in stored)
+
+        authed_client.delete(f'/api/admin/users/{user_id}/api-keys/{ci["id"]}')
+        assert client.get('/api/auth/me', headers={'X-API-Key': ci['apiKey']}).status_code == 401
+        assert client.get('/api/auth/me', headers={'X-API-Key': agent['apiKey']}).status_code == 200
+        # Same prefix, wrong secret
+        assert client.get('/api/auth/me', headers={'X-API-Key': agent['apiKey'][:12] + 'x' * 35}).status_code == 401
+
+    def test_plaintext_keys_migrate(self, app, authed_client):
+        import app as app_module
+        user_id = self._user(authed_client)
+        conn = app_module.get_write_db()
+        conn.execute('UPDATE users SET api_key = ? WHERE id = ?', ('mk_legacy-plaintext-key-0123456789', user_id))
+        conn.execute('DELETE FROM schema_version WHERE version >= 14')
+        app_module.migrate(conn)
+        conn.commit()
+        assert conn.execute('SELECT COUNT(*) FROM users WHERE api_key IS NOT NULL').fetchone()[0] == 0
+        conn.close()
+        resp = app.test_client().get('/api/auth/me', headers={'X-API-Key': 'mk_legacy-plaintext-key-0123456789'})
+        assert resp.get_json()['id'] == user_id
+
+    def test_last_use_written_in_batches(self, app, authed_client, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'API_KEY_TOUCH_SECONDS', 3600)
+        monkeypatch.setattr(app_module, 'AUTH_CACHE_TTL', 0)
+        user_id = self._user(authed_client)
+        api_key = authed_client.post(f'/api/admin/users/{user_id}/api-key').get_json()['apiKey']
+        client = app.test_client()
+        for _ in range(3):
+            client.get('/api/auth/me', headers={'X-API-Key': api_key})
+        conn = app_module.get_db()
+        assert conn.execute('SELECT last_used_at FROM api_keys').fetchone()[0] is None
+        conn.close()
+        me = next(u for u in authed_client.get('/api/admin/users').get_json() if u['id'] == user_id)
+        assert me['hasApiKey'] and me['apiKeys'][0]['lastUsedAt'] is not None
+
+
+def scrape(client):
+    """Parse /metrics into {'name{labels}': value}."""
+    resp = client.get('/metrics', headers=basic_auth('test', 'testpass'))
+    assert resp.status_code == 200
+    samples = {}
+    for line in resp.get_data(as_text=True).splitlines():
+        if line and not line.startswith('#'):
+            key, value = line.rsplit(' ', 1)
+            samples[key] = float(value)
+    return samples
+
+
+class TestMetrics:
+    def test_admin_only(self, app, authed_client):
+        authed_client.post('/api/admin/users', json={'username': 'bob', 'password': 'password1'})
+        anonymous = app.test_client()
+        assert anonymous.get('/metrics').status_code == 401
+        assert anonymous.get('/metrics', headers=basic_auth('bob', 'password1')).status_code == 403
+        assert authed_client.get('/metrics').status_code == 200
+
+    def test_requests_queries_and_json(self, app, authed_client):
+        authed_client.post('/api/maps', json={'title': 'M', 'map': make_map_json()})
+        for _ in range(3):
+            authed_client.get('/api/maps?id=0')
+        samples = scrape(app.test_client())
+        assert samples['mindmap_http_requests_total{method="GET",route="/api/maps",status="200"}'] == 3
+        labels = '{method="GET",route="/api/maps"'
+        assert samples[f'mindmap_http_request_duration_seconds_bucket{labels},le="+Inf"}}'] == 3
+        assert samples[f'mindmap_http_request_duration_seconds_count{labels}}}'] == 3
+        assert samples[f'mindmap_http_response_size_bytes_count{labels}}}'] == 3
+        assert samples['mindmap_db_query_duration_seconds_count'] > 3
+        assert samples['mindmap_json_duration_seconds_count{op="decode"}'] >= 1
+        assert samples['mindmap_json_duration_seconds_count{op="encode"}'] >= 4
+
+    def test_job_durations(self, app, authed_client):
+        authed_client.post('/api/admin/vacuum')
+        assert scrape(app.test_client())['mindmap_job_duration_seconds_count{job="vacuum",outcome="ok"}'] == 1
+
+    def test_write_lock_contention(self, app, authed_client):
+        import threading
+        import app as app_module
+        held = app_module.get_write_db()
+        waiter = threading.Thread(target=lambda: app_module.get_write_db().close())
+        waiter.start()
+        time.sleep(0.05)
+        held.close()
+        waiter.join()
+        samples = scrape(app.test_client())
+        assert samples['mindmap_db_write_lock_events_total{event="slot_wait"}'] == 1
+        assert samples['mindmap_db_write_lock_wait_seconds_sum{stage="slot"}'] >= 0.04
+        assert samples['mindmap_db_write_lock_wait_seconds_count{stage="sqlite"}'] >= 2
+
+    def test_workers_are_added_up(self, app, authed_client, tmp_path, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'METRICS_DIR', str(tmp_path))
+        other = {'mindmap_http_requests_total': [[['GET', '/api/folders', '200'], 5]]}
+        (tmp_path / '1.json').write_text(json.dumps(other))
+        authed_client.get('/api/folders')
+        samples = scrape(app.test_client())
+        assert samples['mindmap_http_requests_total{method="GET",route="/api/folders",status="200"}'] == 6
+        assert (tmp_path / f'{os.getpid()}.json').exists()
+
+
+def server_timing(response):
+    """Server-Timing header as {name: milliseconds}."""
+    entries = (part.strip().split(';dur=') for part in response.headers['Server-Timing'].split(','))
+    return {name: float(ms) for name, ms in entries}
+
+
+class TestServerTiming:
+    def test_save_breakdown_for_admins(self, authed_client):
+        resp = authed_client.post('/api/maps', json={'title': 'M', 'map': make_map_json()})
+        timings = server_timing(resp)
+        for phase in ('auth', 'decode', 'serialize', 'write', 'commit', 'encode', 'total'):
+            assert phase in timings
+        assert timings['total'] >= timings['write'] + timings['commit']
+        map_id = resp.get_json()['id']
+        assert {'auth', 'db', 'decode'} <= set(server_timing(authed_client.get(f'/api/maps?id={map_id}')))
+        assert 'outline' in server_timing(authed_client.get(f'/api/maps/{map_id}/outline'))
+
+    def test_hidden_from_other_users_unless_all(self, app, authed_client, monkeypatch):
+        import app as app_module
+        authed_client.post('/api/admin/users', json={'username': 'bob', 'password': 'password1'})
+        bob = app.test_client()
+        resp = bob.get('/api/maps?id=0', headers=basic_auth('bob', 'password1'))
+        assert 'Server-Timing' not in resp.headers
+        monkeypatch.setattr(app_module, 'SERVER_TIMING', 'all')
+        resp = bob.get('/api/maps?id=0', headers=basic_auth('bob', 'password1'))
+        assert {'auth', 'db', 'encode', 'total'} <= set(server_timing(resp))
+        monkeypatch.setattr(app_module, 'SERVER_TIMING', 'off')
+        assert 'Server-Timing' not in authed_client.get('/api/maps?id=0').headers
+
+
+class TestSlowQueries:
+    def test_logs_plan_and_parameter_shapes(self, app, authed_client, monkeypatch):
+        import app as app_module
+        map_id = authed_client.post('/api/maps', json={'title': 'Secret title', 'map': make_map_json()}).get_json()['id']
+        monkeypatch.setattr(app_module, 'SLOW_QUERY_MS', 1e-9)
+        authed_client.get(f'/api/maps?id={map_id}')
+        monkeypatch.setattr(app_module, 'SLOW_QUERY_MS', 0)
+        data = authed_client.get('/api/admin/slow-queries').get_json()
+        lookup = next(q for q in data['queries'] if q['sql'].startswith('SELECT user_id, revision'))
+        assert lookup['route'] == 'GET /api/maps'
+        assert lookup['params'] == f'(str({len(map_id)}))'
+        assert any('USING' in line for line in lookup['plan'])
+        assert map_id not in json.dumps(data)
+
+    def test_written_through_the_access_log_queue(self, app, authed_client, monkeypatch, capsys):
+        import app as app_module
+        import queue
+        entries = queue.Queue()
+        monkeypatch.setattr(app_module, '_access_log_queue', lambda: entries)
+        monkeypatch.setattr(app_module, 'SLOW_QUERY_MS', 1e-9)
+        authed_client.get('/api/maps?id=0')
+        monkeypatch.setattr(app_module, 'SLOW_QUERY_MS', 0)
+        lines = [entries.get_nowait() for _ in range(entries.qsize())]
+        slow = [line for line in lines if line.get('type') == 'slow_query']
+        assert slow and all(line['route'] == 'GET /api/maps' and line['sql'] for line in slow)
+        assert '[SLOW]' not in capsys.readouterr().out
+
+    def test_threshold_and_clear(self, app, authed_client, monkeypatch):
+        import app as app_module
+        authed_client.get('/api/maps?id=0')
+        assert authed_client.get('/api/admin/slow-queries').get_json()['queries'] == []
+        monkeypatch.setattr(app_module, 'SLOW_QUERY_MS', 1e-9)
+        authed_client.get('/api/maps?id=0')
+        monkeypatch.setattr(app_module, 'SLOW_QUERY_MS', 0)
+        assert authed_client.get('/api/admin/slow-queries').get_json()['queries']
+        authed_client.delete('/api/admin/slow-queries')
+        assert authed_client.get('/api/admin/slow-queries').get_json()['queries'] == []
+
+
+class TestProfiler:
+    def test_admin_request_is_profiled(self, app, authed_client, capsys):
+        map_id = authed_client.post('/api/maps', json={'title': 'M', 'map': make_map_json()}).get_json()['id']
+        assert 'X-Profile-Id' not in authed_client.get(f'/api/maps/{map_id}/outline').headers
+        resp = authed_client.get(f'/api/maps/{map_id}/outline', headers={'X-Profile': '1'})
+        assert resp.status_code == 200
+        name = resp.headers['X-Profile-Id']
+        [profile] = authed_client.get('/api/admin/profiles').get_json()
+        assert profile['id'] == name and profile['path'] == f'/api/maps/{map_id}/outline'
+        text = authed_client.get(f'/api/admin/profiles/{name}?format=text').get_data(as_text=True)
+        assert 'map_outline' in text
+        assert authed_client.get(f'/api/admin/profiles/{name}').status_code == 200
+        assert authed_client.get('/api/admin/profiles/..%2Fapp.pstats').status_code == 404
+        assert '[PROFILE]' not in capsys.readouterr().out
+
+    def test_only_admins_and_bounded(self, app, authed_client, monkeypatch):
+        import app as app_module
+        authed_client.post('/api/admin/users', json={'username': 'bob', 'password': 'password1'})
+        resp = app.test_client().get('/api/maps?id=0&profile=1', headers=basic_auth('bob', 'password1'))
+        assert 'X-Profile-Id' not in resp.headers
+        monkeypatch.setattr(app_module, 'PROFILE_KEEP', 2)
+        for _ in range(3):
+            authed_client.get('/api/maps?id=0&profile=1')
+        assert len(authed_client.get('/api/admin/profiles').get_json()) == 2
+
+    def test_profiles_are_not_served_to_other_users(self, app, authed_client, monkeypatch, tmp_path):
+        import app as app_module
+        assert not os.path.realpath(app_module.PROFILE_DIR).startswith(os.path.realpath(app_module.PROJECT_ROOT) + os.sep)
+        # Even when configured inside the static root
+        monkeypatch.setattr(app, 'static_folder', str(tmp_path))
+        monkeypatch.setattr(app_module, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+        name = authed_client.get('/api/maps?id=0', headers={'X-Profile': '1'}).headers['X-Profile-Id']
+        authed_client.post('/api/admin/users', json={'username': 'bob', 'password': 'password1'})
+        bob = app.test_client()
+        bob.post('/api/auth/login', json={'username': 'bob', 'password': 'password1'})
+        assert bob.get(f'/profiles/{name}').status_code == 404
+        assert bob.get(f'/api/admin/profiles/{name}').status_code == 403
+        assert authed_client.get(f'/profiles/{name}').status_code == 404
+        assert authed_client.get(f'/api/admin/profiles/{name}').status_code == 200
+
+
+class TestAccessLog:
+    def _capture(self, monkeypatch, maxsize=0):
+        import app as app_module
+        import queue
+        entries = queue.Queue(maxsize=maxsize)
+        monkeypatch.setattr(app_module, '_access_log_queue', lambda: entries)
+        return entries
+
+    def test_structured_entry(self, app, authed_client, monkeypatch):
+        entries = self._capture(monkeypatch)
+        resp = authed_client.post('/api/maps', json={'title': 'M', 'map': make_map_json()})
+        entry = entries.get_nowait()
+        assert entry['method'] == 'POST' and entry['route'] == '/api/maps' and entry['status'] == 200
+        assert entry['map'] == resp.get_json()['id'] and entry['user'] is not None
+        assert entry['bytes_in'] > 0 and entry['bytes_out'] == len(resp.get_data())
+        assert entry['ms'] >= 0
+
+    def test_sampling_keeps_errors(self, app, authed_client, monkeypatch):
+        import app as app_module
+        entries = self._capture(monkeypatch)
+        monkeypatch.setattr(app_module, 'ACCESS_LOG_SAMPLE', {('GET', '/api/maps'): 0.0})
+        authed_client.get('/api/maps?id=0')
+        assert entries.empty()
+        authed_client.get('/api/maps?id=missing')
+        assert entries.get_nowait()['status'] == 404
+
+    def test_request_path_events_are_queued(self, app, authed_client, monkeypatch, capsys):
+        entries = self._capture(monkeypatch)
+        map_id = authed_client.post('/api/maps', json={'title': 'M', 'map': make_map_json()}).get_json()['id']
+        authed_client.post(f'/api/maps/{map_id}/inject', json={'operations': [{'op': 'update_node', 'id': 'nope'}]})
+        lines = [entries.get_nowait() for _ in range(entries.qsize())]
+        [event] = [line for line in lines if line.get('type') == 'inject_errors']
+        assert event['map'] == map_id and event['errors'][0]['index'] == 0
+        assert capsys.readouterr().out.count('[INJECT]') == 0
+
+    def test_full_queue_drops_and_counts(self, app, authed_client, monkeypatch, capsys):
+        import app as app_module
+        import queue
+        entries = self._capture(monkeypatch, maxsize=1)
+        authed_client.get('/api/folders')
+        authed_client.get('/api/folders')  # queue full: dropped, request unaffected
+        first = entries.get_nowait()
+        authed_client.get('/api/folders')
+        assert entries.get_nowait()['dropped'] == 1
+        pending = queue.Queue()
+        pending.put(first)
+        pending.put(None)
+        app_module._access_log_writer(pending)
+        line = capsys.readouterr().out.strip().splitlines()[-1]
+        assert json.loads(line)['route'] == '/api/folders'
+
+
+class TestMapListingPages:
+    def _make_maps(self, app, authed_client, count):
+        import app as app_module
+        ids = [authed_client.post('/api/maps', json={'title': f'Plan {i}', 'map': make_map_json()}).get_json()['id']
+               for i in range(count)]
+        # Same timestamp for all, so pages have to break ties on id
+        conn = app_module.get_write_db()
+        conn.execute('UPDATE maps SET updated_at = 1000')
+        conn.commit()
+        conn.close()
+        return ids
+
+    def test_pages_cover_every_map_once(self, app, authed_client):
+        ids = self._make_maps(app, authed_client, 7)
+        resp = authed_client.get('/api/maps?id=0&limit=3')
+        assert resp.headers['X-Total-Count'] == '7'
+        seen = [m['id'] for m in resp.get_json()]
+        while 'X-Next-Cursor' in resp.headers:
+            resp = authed_client.get('/api/maps', query_string={'id': 0, 'cursor': resp.headers['X-Next-Cursor'], 'limit': 3})
+            assert 'X-Total-Count' not in resp.headers
+            seen += [m['id'] for m in resp.get_json()]
+        assert seen == sorted(ids, reverse=True)
+        # Unpaged requests still get the whole list
+        assert len(authed_client.get('/api/maps?id=0').get_json()) == 7
+
+    def test_fields_title_filter_and_folder_total(self, app, authed_client):
+        ids = self._make_maps(app, authed_client, 3)
+        authed_client.post('/api/maps', json={'id': ids[0], 'title': '100% Budget_2024', 'map': make_map_json()})
+        folder_id = authed_client.post('/api/folders', json={'name': 'F'}).get_json()['id']
+        authed_client.put(f'/api/maps/{ids[1]}/move', json={'folderId': folder_id})
+
+        resp = authed_client.get('/api/maps?id=0&fields=id,title&title=budget_')
+        assert resp.get_json() == [{'id': ids[0], 'title': '100% Budget_2024'}]
+        assert resp.headers['X-Total-Count'] == '1'
+        assert authed_client.get('/api/maps?id=0&title=0%25 B').get_json()[0]['id'] == ids[0]
+        assert authed_client.get('/api/maps?id=0&title=%25%25').get_json() == []
+        resp = authed_client.get(f'/api/maps?id=0&folder_id={folder_id}&limit=10')
+        assert [m['id'] for m in resp.get_json()] == [ids[1]] and resp.headers['X-Total-Count'] == '1'
+
+    def test_bad_parameters_rejected(self, authed_client):
+        assert authed_client.get('/api/maps?id=0&fields=id,data').status_code == 400
+        assert authed_client.get('/api/maps?id=0&cursor=garbage').status_code == 400
+        assert authed_client.get('/api/maps?id=0&limit=ten').status_code == 400
+
+
+class TestCounters:
+    def _counts(self, authed_client):
+        folders = {f['name']: f['mapCount'] for f in authed_client.get('/api/folders').get_json()}
+        me = next(u for u in authed_client.get('/api/admin/users').get_json() if u['username'] == 'test')
+        return folders, me['mapCount'], me['storageBytes']
+
+    def test_counters_follow_every_write(self, app, authed_client):
+        import app as app_module
+        folder_id = authed_client.post('/api/folders', json={'name': 'Work'}).get_json()['id']
+        ids = [authed_client.post('/api/maps', json={'title': f'M{i}', 'map': make_map_json()}).get_json()['id']
+               for i in range(3)]
+        for map_id in ids[:2]:
+            authed_client.put(f'/api/maps/{map_id}/move', json={'folderId': folder_id})
+        assert self._counts(authed_client)[:2] == ({'Work': 2}, 3)
+
+        authed_client.put(f'/api/maps/{ids[0]}/trash')
+        assert self._counts(authed_client)[:2] == ({'Work': 1}, 2)
+        authed_client.put(f'/api/maps/{ids[0]}/restore')
+        authed_client.delete(f'/api/maps/{ids[1]}')
+        authed_client.delete(f'/api/folders/{folder_id}')
+        authed_client.post('/api/maps', json={'id': ids[2], 'title': 'Bigger', 'map': make_map_json(settings={'pad': 'x' * 500})})
+        _, count, size = self._counts(authed_client)
+        conn = app_module.get_db()
+        stored = sum(app_module._stored_size(row[0]) for row in conn.execute('SELECT data FROM maps'))
+        conn.close()
+        assert (count, size) == (2, stored)
+
+    def test_listings_do_not_count_per_row(self, app, authed_client, monkeypatch):
+        import app as app_module
+        for name in ('A', 'B', 'C'):
+            authed_client.post('/api/folders', json={'name': name})
+        statements = []
+        real_get_db = app_module.get_db
+
+        def traced(*args):
+            conn = real_get_db(*args)
+            conn._conn.set_trace_callback(statements.append)
+            return conn
+        monkeypatch.setattr(app_module, 'get_db', traced)
+        authed_client.get('/api/folders')
+        authed_client.get('/api/admin/users')
+        assert statements and not [sql for sql in statements if 'COUNT(' in sql.upper()]
+
+    def test_check_job_repairs_drift(self, app, authed_client):
+        import app as app_module
+        folder_id = authed_client.post('/api/folders', json={'name': 'Work'}).get_json()['id']
+        map_id = authed_client.post('/api/maps', json={'title': 'M', 'map': make_map_json()}).get_json()['id']
+        authed_client.put(f'/api/maps/{map_id}/move', json={'folderId': folder_id})
+        conn = app_module.get_write_db()
+        conn.execute('UPDATE folders SET map_count = 7')
+        conn.execute('UPDATE user_stats SET map_count = 0, map_bytes = 1')
+        conn.commit()
+        conn.close()
+
+        assert authed_client.post('/api/admin/counters/check').status_code == 202
+        for _ in range(100):
+            job = authed_client.get('/api/admin/counters/check').get_json()
+            if not job['running']:
+                break
+            time.sleep(0.05)
+        assert job['result'] == {'files': 1, 'folders': 1, 'users': 1}
+        folders, count, size = self._counts(authed_client)
+        assert folders == {'Work': 1} and count == 1 and size > 1
+
+
+class TestFullTextSearch:
+    def _map(self):
+        content = make_big_map(4, n2='Quarterly budget review', n3='Hiring plan')
+        content['nodes']['n3']['body'] = '<p>Interview <b>candidates</b> &amp; onboard</p>'
+        content['nodes']['n4']['tags'] = ['t1']
+        content['nodes']['n4']['text'] = 'Réunion <équipe>'
+        content['settings']['tags'] = [{'id': 't1', 'name': 'urgent', 'color': '#f00'}]
+        return content
+
+    def _search(self, client, q, **params):
+        resp = client.get('/api/search', query_string={'q': q, **params})
+        assert resp.status_code == 200
+        return resp.get_json()
+
+    def test_finds_text_notes_tags_and_titles(self, authed_client):
+        map_id = authed_client.post('/api/maps', json={'title': 'Planning 2025', 'map': self._map()}).get_json()['id']
+        hits = self._search(authed_client, 'budget')['results']
+        assert [(h['mapId'], h['nodeId']) for h in hits] == [(map_id, 'n2')]
+        assert '<mark>budget</mark>' in hits[0]['snippet'].lower()
+        hit = self._search(authed_client, 'candidates')['results'][0]
+        assert hit['nodeId'] == 'n3' and hit['snippet'] == 'Interview <mark>candidates</mark> &amp; onboard'
+        hit = self._search(authed_client, 'reunion equi')['results'][0]
+        assert hit['nodeId'] == 'n4' and hit['snippet'] == '<mark>Réunion</mark> &lt;<mark>équipe</mark>&gt;'
+        assert self._search(authed_client, 'urgent')['results'][0]['nodeId'] == 'n4'
+        assert self._search(authed_client, 'plann')['results'][0]['nodeId'] is None  # title, prefix match
+        assert authed_client.get('/api/search?q=').status_code == 400
+
+    def test_saves_reindex_only_changed_nodes(self, app, authed_client):
+        import sqlite3
+        import app as app_module
+        content = self._map()
+        map_id = authed_client.post('/api/maps', json={'title': 'Plan', 'map': content}).get_json()['id']
+        db = sqlite3.connect(app_module.DB_PATH)
+        before = dict(db.execute('SELECT node_id, rowid FROM search_docs WHERE map_id = ?', (map_id,)).fetchall())
+        content['nodes']['n2']['text'] = 'Annual forecast'
+        saved = authed_client.post('/api/maps', json={'id': map_id, 'title': 'Plan', 'map': content}).get_json()
+        after = dict(db.execute('SELECT node_id, rowid FROM search_docs WHERE map_id = ?', (map_id,)).fetchall())
+        assert after['n2'] != before['n2']
+        assert {k: v for k, v in after.items() if k != 'n2'} == {k: v for k, v in before.items() if k != 'n2'}
+        assert self._search(authed_client, 'budget')['results'] == []
+        assert self._search(authed_client, 'forecast')['results'][0]['nodeId'] == 'n2'
+
+        authed_client.patch(f'/api/maps/{map_id}', json={'baseRevision': saved['revision'],
+                                                         'nodes': {'n2': None, 'n3': dict(content['nodes']['n3'], text='Recruiting')}})
+        assert self._search(authed_client, 'forecast')['results'] == []
+        assert self._search(authed_client, 'recruiting')['results'][0]['nodeId'] == 'n3'
+        authed_client.post(f'/api/maps/{map_id}/inject', json={'operations': [{'op': 'add_child', 'parent': 'n1', 'id': 'x1', 'text': 'Offsite retreat'}]})
+        assert self._search(authed_client, 'retreat')['results'][0]['nodeId'] == 'x1'
+        db.close()
+
+    def test_scoped_to_live_maps_of_the_user(self, app, authed_client):
+        map_id = authed_client.post('/api/maps', json={'title': 'Plan', 'map': self._map()}).get_json()['id']
+        authed_client.post('/api/admin/users', json={'username': 'bob', 'password': 'bobpass1'})
+        bob = app.test_client()
+        bob.post('/api/auth/login', json={'username': 'bob', 'password': 'bobpass1'})
+        assert self._search(bob, 'budget')['results'] == []
+        authed_client.put(f'/api/maps/{map_id}/trash')
+        assert self._search(authed_client, 'budget')['results'] == []
+        authed_client.put(f'/api/maps/{map_id}/restore')
+        authed_client.delete(f'/api/maps/{map_id}')
+        assert self._search(authed_client, 'budget')['results'] == []
+
+    def test_pages_rank_the_same_window(self, app, authed_client, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'SEARCH_RANK_WINDOW', 6)
+        # Older maps have shorter text, so they would outrank the newer ones
+        for i in range(8):
+            authed_client.post('/api/maps', json={'title': f'Map {i}', 'map': make_big_map(3, n2='idea' + ' filler' * i)})
+        seen, offset = [], 0
+        while offset is not None:
+            page = self._search(authed_client, 'idea', limit=4, offset=offset)
+            seen += [h['mapId'] for h in page['results']]
+            offset = page['nextOffset']
+        assert len(seen) == len(set(seen)) == 6
+        assert seen == [h['mapId'] for h in self._search(authed_client, 'idea', limit=100)['results']]
+
+    def test_pagination_and_rebuild(self, app, authed_client):
+        import sqlite3
+        import app as app_module
+        for i in range(5):
+            authed_client.post('/api/maps', json={'title': f'Map {i}', 'map': make_big_map(3, n2=f'shared idea {i}')})
+        page = self._search(authed_client, 'idea', limit=2)
+        assert len(page['results']) == 2 and page['nextOffset'] == 2
+        last = self._search(authed_client, 'idea', limit=2, offset=4)
+        assert len(last['results']) == 1 and last['nextOffset'] is None
+
+        db = sqlite3.connect(app_module.DB_PATH)
+        db.execute('DELETE FROM search_index')
+        db.execute('DELETE FROM search_docs')
+        db.commit()
+        db.close()
+        assert self._search(authed_client, 'idea')['results'] == []
+        assert app_module.rebuild_search_index()['maps'] == 5
+        assert len(self._search(authed_client, 'idea', limit=10)['results']) == 5